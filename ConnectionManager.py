@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sqlite3
+import threading
+import time
+
+"""
+ConnectionManager.py owns the SQLite connections to a {namespace}.db file.
+Each process gets a single writer connection and one read-only connection per thread, all in WAL mode.
+The manager pickles as its configuration only, so it can be handed to thread or process workers.
+
+In snapshot mode the database is loaded into a private :memory: database when it is first used and every query runs
+against that copy.  snapshot='all' copies the whole file with the backup API; 'structure' (or a list of table names)
+copies only those tables and attaches the file as schema 'disk', so other tables are still read and written in place.
+Changes to the copy are written back only by flush().
+"""
+
+# Tables copied by snapshot='structure', as suffixes of the namespace table name.
+STRUCTURAL_SUFFIXES = ('', '_relationships', '_content_models', '_datastreams')
+
+_managers = {}
+_managers_lock = threading.Lock()
+_snapshot = None
+_snapshot_pid = None
+
+
+# Sets the snapshot mode of managers get_manager creates from now on in this process: None, 'all' or 'structure'.
+# The mode is not inherited by forked worker processes, which would otherwise each load a private copy of the
+# database and silently drop what they write.
+def use_snapshots(mode):
+    global _snapshot, _snapshot_pid
+    if mode not in (None, 'all', 'structure'):
+        raise ValueError(f"Unknown snapshot mode '{mode}'")
+    _snapshot = mode
+    _snapshot_pid = os.getpid()
+
+
+# Returns the shared manager for a namespace database in this process.
+def get_manager(namespace=None, database=None):
+    if database is None:
+        database = f'{namespace}.db'
+    key = (os.getpid(), os.path.abspath(database))
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            snapshot = _snapshot if _snapshot_pid == os.getpid() else None
+            manager = ConnectionManager(namespace, database=database, snapshot=snapshot)
+            _managers[key] = manager
+        return manager
+
+
+# Rolls back and closes every shared manager of this process, so work that failed part way through a write
+# leaves no open transaction holding the database write lock.  The next get_manager call opens a new manager.
+def close_managers():
+    with _managers_lock:
+        keys = [key for key in _managers if key[0] == os.getpid()]
+        managers = [_managers.pop(key) for key in keys]
+    for manager in managers:
+        manager.rollback()
+        manager.close()
+
+
+# Writes back every snapshot of this process.
+def flush_snapshots():
+    with _managers_lock:
+        managers = [manager for (pid, _), manager in _managers.items() if pid == os.getpid()]
+    for manager in managers:
+        manager.flush()
+
+
+class ConnectionManager:
+    def __init__(self, namespace=None, database=None, busy_timeout=30000, cache_size=-65536,
+                 mmap_size=268435456, synchronous='NORMAL', cached_statements=256, snapshot=None):
+        if database is None:
+            database = f'{namespace}.db'
+        self.database = database
+        self.namespace = namespace or os.path.splitext(os.path.basename(database))[0]
+        self.snapshot = snapshot
+        # Schemas searched for tables: a partial snapshot leaves the tables it does not copy in the attached file.
+        self.schemas = ['main', 'disk'] if snapshot not in (None, 'all') else ['main']
+        self.busy_timeout = busy_timeout
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.synchronous = synchronous
+        self.cached_statements = cached_statements
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._writer = None
+        self._readers = []
+        self._flushed_changes = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Hold while writing from worker threads that share the writer connection.
+        self.write_lock = threading.RLock()
+
+    # Connections never cross a fork; a child process opens its own.
+    def _check_process(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _configure(self, conn):
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        conn.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        return conn
+
+    # Returns the single writer connection for this process.  In snapshot mode it is the in-memory copy.
+    def writer(self):
+        self._check_process()
+        with self._lock:
+            if self._writer is None and self.snapshot:
+                self._writer = self._open_snapshot()
+            elif self._writer is None:
+                conn = sqlite3.connect(self.database, check_same_thread=False,
+                                       cached_statements=self.cached_statements)
+                self._configure(conn)
+                conn.execute("PRAGMA journal_mode = WAL")
+                conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+                self._writer = conn
+            return self._writer
+
+    # Returns a read-only connection owned by the calling thread.
+    # An in-memory snapshot exists once per process, so its readers share the writer connection.
+    def reader(self):
+        self._check_process()
+        if self.snapshot:
+            return self.writer()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # The writer creates the file and switches it to WAL before any reader opens it.
+            self.writer()
+            path = os.path.abspath(self.database)
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False,
+                                   cached_statements=self.cached_statements)
+            self._configure(conn)
+            conn.execute("PRAGMA query_only = ON")
+            self._local.conn = conn
+            with self._lock:
+                self._readers.append(conn)
+        return conn
+
+    # Tables copied by a partial snapshot.
+    def snapshot_tables(self):
+        if self.snapshot == 'structure':
+            return [f"{self.namespace}{suffix}" for suffix in STRUCTURAL_SUFFIXES]
+        return list(self.snapshot)
+
+    def _open_snapshot(self):
+        started = time.time()
+        path = os.path.abspath(self.database)
+        conn = sqlite3.connect(':memory:', check_same_thread=False, cached_statements=self.cached_statements)
+        if self.snapshot == 'all':
+            source = sqlite3.connect(path)
+            try:
+                source.backup(conn)
+            finally:
+                source.close()
+            self._configure(conn)
+        else:
+            self._configure(conn)
+            conn.execute("ATTACH DATABASE ? AS disk", (path,))
+            conn.execute("PRAGMA disk.journal_mode = WAL")
+            tables = self.snapshot_tables()
+            placeholders = ', '.join('?' for _ in tables)
+            schema = conn.execute(f"""
+                SELECT type, name, sql FROM disk.sqlite_master
+                WHERE type IN ('table', 'index') AND tbl_name IN ({placeholders}) AND sql IS NOT NULL
+                ORDER BY type = 'index'
+            """, tables).fetchall()
+            # Indexes are created after the rows are copied.
+            for kind, name, sql in schema:
+                conn.execute(sql)
+                if kind == 'table':
+                    conn.execute(f'INSERT INTO main."{name}" SELECT * FROM disk."{name}"')
+            conn.commit()
+        self._flushed_changes = conn.total_changes
+        print(f"Loaded {path} into memory in {time.time() - started:.1f}s")
+        return conn
+
+    # Writes the snapshot back to the database file.  A full snapshot replaces the whole file; a partial one
+    # replaces the tables held in memory, including tables created since it was loaded.  Either way, changes other
+    # processes made to those tables since the snapshot was loaded are overwritten.
+    def flush(self):
+        self._check_process()
+        if not self.snapshot or self._writer is None:
+            return
+        with self.write_lock:
+            conn = self._writer
+            conn.commit()
+            path = os.path.abspath(self.database)
+            if conn.total_changes == self._flushed_changes:
+                print(f"Snapshot of {path} has no changes to flush")
+                return
+            if self.snapshot == 'all':
+                target = sqlite3.connect(path)
+                try:
+                    conn.backup(target)
+                finally:
+                    target.close()
+            else:
+                schema = conn.execute("""
+                    SELECT type, name, tbl_name, sql FROM main.sqlite_master
+                    WHERE type IN ('table', 'index') AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%'
+                    ORDER BY type = 'index'
+                """).fetchall()
+                virtual = [name for kind, name, _, sql in schema if sql.upper().startswith('CREATE VIRTUAL')]
+                conn.execute("BEGIN")
+                try:
+                    for kind, name, table, sql in schema:
+                        if any(table == v or table.startswith(f"{v}_") for v in virtual):
+                            continue
+                        if kind == 'table':
+                            conn.execute(f'DROP TABLE IF EXISTS disk."{name}"')
+                        conn.execute(re.sub(r'^(CREATE\s+(?:UNIQUE\s+)?(?:TABLE|INDEX)\s+(?:IF\s+NOT\s+EXISTS\s+)?)',
+                                            r'\1disk.', sql, flags=re.IGNORECASE))
+                        if kind == 'table':
+                            conn.execute(f'INSERT INTO disk."{name}" SELECT * FROM main."{name}"')
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
+                for name in virtual:
+                    print(f"Virtual table {name} exists only in memory and was not flushed")
+            self._flushed_changes = conn.total_changes
+        print(f"Flushed snapshot to {path}")
+
+    # Discards uncommitted changes on the writer connection.
+    def rollback(self):
+        self._check_process()
+        if self._writer is not None and self._writer.in_transaction:
+            self._writer.rollback()
+
+    def close(self):
+        self._check_process()
+        if self.snapshot and self._writer is not None and self._writer.total_changes != self._flushed_changes:
+            print(f"Discarding {self._writer.total_changes - self._flushed_changes} unflushed changes "
+                  f"to the snapshot of {self.database}")
+        with self._lock:
+            for conn in self._readers:
+                conn.close()
+            if self._writer is not None:
+                self._writer.close()
+        self._reset()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_pid', '_writer', '_readers', '_local', '_lock', 'write_lock'):
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import csv
+import json
+from abc import ABC, abstractmethod
+
+"""
+FoxmlExtractors.py holds the sinks used by ImportServerUtilities.run_extractors.
+Each FOXML object is parsed once and handed to every registered extractor.
+"""
+
+
+class Extractor(ABC):
+
+    # Called once before the traversal starts.
+    def open(self, su):
+        self.su = su
+
+    # Called once for every parsed object.
+    @abstractmethod
+    def process(self, pid, nid, fw):
+        pass
+
+    # Called once after the traversal, even when it fails part way.
+    def close(self):
+        pass
+
+
+# Writes {namespace}_dc.csv, as get_all_dc does.
+class DCExtractor(Extractor):
+    def __init__(self, output_file=None):
+        self.output_file = output_file
+        self.file = None
+        self.writer = None
+
+    def open(self, su):
+        super().open(su)
+        output_file = self.output_file or f"{su.staging_dir}/{su.namespace}_dc.csv"
+        self.file = open(output_file, mode="w", newline="", encoding="utf-8")
+        self.writer = csv.DictWriter(self.file, fieldnames=['pid', 'dublin_core'])
+        self.writer.writeheader()
+
+    def process(self, pid, nid, fw):
+        self.writer.writerow({'pid': pid, 'dublin_core': fw.get_dc()})
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+# Writes {namespace}_inline.csv, as get_inline_datastreams does.
+class InlineDatastreamExtractor(Extractor):
+    def __init__(self, output_file=None):
+        self.output_file = output_file
+        self.file = None
+        self.writer = None
+
+    def open(self, su):
+        super().open(su)
+        output_file = self.output_file or f"{su.staging_dir}/{su.namespace}_inline.csv"
+        self.file = open(output_file, mode="w", newline="", encoding="utf-8")
+        self.writer = csv.DictWriter(self.file, fieldnames=['pid', 'dublin_core', 'pb_core', 'mods'])
+        self.writer.writeheader()
+
+    def process(self, pid, nid, fw):
+        self.writer.writerow({'pid': pid,
+                              'dublin_core': fw.get_dc(),
+                              'pb_core': fw.get_inline_pbcore(),
+                              'mods': fw.get_inline_mods()})
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+# Counts datastream ids across active objects and writes them as json.
+class DsidCountExtractor(Extractor):
+    def __init__(self, output_file='dsid.json'):
+        self.output_file = output_file
+        self.dsids = {}
+
+    def process(self, pid, nid, fw):
+        if fw.get_state() != 'Active':
+            return
+        for datastream in fw.get_datastream_types().keys():
+            self.dsids[datastream] = self.dsids.get(datastream, 0) + 1
+
+    def close(self):
+        with open(self.output_file, "w") as file:
+            json.dump(self.dsids, file, indent=4)
+
+
+# Writes an inline xml datastream to {nid}_{dsid}.xml in the staging directory.
+class InlineStreamStager(Extractor):
+    getters = {
+        'PBCORE': 'get_inline_pbcore',
+        'MusicXML': 'get_inline_musicXML',
+        'MODS': 'get_inline_mods',
+    }
+
+    def __init__(self, dsid):
+        if dsid not in self.getters:
+            raise ValueError(f"No inline getter for datastream '{dsid}'")
+        self.dsid = dsid
+
+    def process(self, pid, nid, fw):
+        if not nid:
+            return
+        content = getattr(fw, self.getters[self.dsid])()
+        if content:
+            destination = f"{self.su.staging_dir}/{nid}_{self.dsid}.xml"
+            with open(destination, 'w', encoding='utf-8') as f:
+                f.write(content)
+            self.su.record_media(nid, self.dsid, destination)
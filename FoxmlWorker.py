@@ -1,15 +1,125 @@
+import base64
+import os
+
 import lxml.etree as ET
 
+import Throttle as TH
+
 """
 FoxmlWorker.py encapsulates the Foxml object and provides methods to extract data from it.
 """
 
+FOXML = '{info:fedora/fedora-system:def/foxml#}'
+
+
+# Parser target that builds the FOXML tree but drops the base64 text of foxml:binaryContent.
+class SkipBinaryTarget:
+    def __init__(self):
+        self.stack = []
+        self.root = None
+        self.last = None
+        self.closed = False
+        self.skip = 0
+
+    def start(self, tag, attrib, nsmap):
+        nsmap = {prefix or None: uri for prefix, uri in nsmap.items()}
+        if self.stack:
+            element = ET.SubElement(self.stack[-1], tag, attrib, nsmap=nsmap)
+        else:
+            element = ET.Element(tag, attrib, nsmap=nsmap)
+            self.root = element
+        self.stack.append(element)
+        self.last = element
+        self.closed = False
+        if tag == f'{FOXML}binaryContent':
+            self.skip += 1
+
+    def end(self, tag):
+        self.last = self.stack.pop()
+        self.closed = True
+        if tag == f'{FOXML}binaryContent':
+            self.skip -= 1
+
+    def data(self, data):
+        if self.skip or self.last is None:
+            return
+        if self.closed:
+            self.last.tail = (self.last.tail or '') + data
+        else:
+            self.last.text = (self.last.text or '') + data
+
+    # Comments and processing instructions inside the root are kept, so serialized xmlContent matches a full parse.
+    def comment(self, text):
+        self.append_node(ET.Comment(text))
+
+    def pi(self, target, data=None):
+        self.append_node(ET.ProcessingInstruction(target, data))
+
+    def append_node(self, node):
+        if self.skip or not self.stack:
+            return
+        self.stack[-1].append(node)
+        self.last = node
+        self.closed = True
+
+    def close(self):
+        return self.root
+
+
+# Parser target that base64-decodes one datastreamVersion's binaryContent into a file as it is read.
+class BinaryContentTarget:
+    def __init__(self, version_id, out):
+        self.version_id = version_id
+        self.out = out
+        self.in_version = False
+        self.in_content = False
+        self.buffer = ''
+        self.written = 0
+
+    def start(self, tag, attrib):
+        if tag == f'{FOXML}datastreamVersion':
+            self.in_version = attrib.get('ID') == self.version_id
+        elif tag == f'{FOXML}binaryContent' and self.in_version:
+            self.in_content = True
+
+    def end(self, tag):
+        if tag == f'{FOXML}binaryContent' and self.in_content:
+            self.in_content = False
+            self.flush(final=True)
+        elif tag == f'{FOXML}datastreamVersion':
+            self.in_version = False
+
+    def data(self, data):
+        if self.in_content:
+            self.buffer += ''.join(data.split())
+            self.flush()
+
+    # Decodes every complete 4 character group, keeping the remainder for the next chunk.
+    def flush(self, final=False):
+        usable = len(self.buffer) if final else len(self.buffer) - len(self.buffer) % 4
+        if usable:
+            decoded = base64.b64decode(self.buffer[:usable])
+            self.out.write(decoded)
+            self.written += len(decoded)
+            self.buffer = self.buffer[usable:]
+
+    def close(self):
+        return self.written
+
 
 class FWorker:
-    def __init__(self, foxml_file):
+    # skip_binary leaves inline base64 payloads out of the tree; use it when only metadata is needed.
+    def __init__(self, foxml_file, skip_binary=False):
+        self.foxml_file = foxml_file
         try:
-            self.tree = ET.parse(foxml_file)
-            self.root = self.tree.getroot()
+            TH.consume(files=1, nbytes=os.path.getsize(foxml_file))
+            if skip_binary:
+                parser = ET.XMLParser(target=SkipBinaryTarget(), huge_tree=True)
+                self.root = ET.parse(foxml_file, parser)
+                self.tree = self.root.getroottree()
+            else:
+                self.tree = ET.parse(foxml_file)
+                self.root = self.tree.getroot()
         except ET.ParseError as e:
             raise ValueError(f"Error: Unable to parse FOXML file '{foxml_file}'. XML may be malformed. Details: {e}")
         except Exception as e:
@@ -69,9 +179,73 @@ class FWorker:
                 f'//foxml:datastream[@ID="{stream}"]/foxml:datastreamVersion/foxml:contentLocation',
                 namespaces=self.namespaces)
             if location:
-                mapping[stream] = {'filename': location[-1].attrib['REF'], 'mimetype': mimetype}
+                mapping[stream] = {'filename': location[-1].attrib['REF'], 'mimetype': mimetype,
+                                   'digest': self.get_content_digest(location[-1].getparent())}
+        return mapping
+
+    # Returns 'TYPE:DIGEST' for a datastreamVersion, or None when Fedora did not record one.
+    def get_content_digest(self, version):
+        digest = version.find('./foxml:contentDigest', self.namespaces)
+        if digest is None:
+            return None
+        digest_type = digest.attrib.get('TYPE', 'DISABLED')
+        value = digest.attrib.get('DIGEST', 'none')
+        if digest_type == 'DISABLED' or value == 'none':
+            return None
+        return f"{digest_type}:{value}"
+
+    # Gets current datastreams stored inline as base64 binaryContent.
+    def get_inline_binary_data(self):
+        mapping = {}
+        for datastream in self.root.findall('.//foxml:datastream', self.namespaces):
+            version = datastream.findall('./foxml:datastreamVersion', self.namespaces)[-1]
+            if version.find('./foxml:binaryContent', self.namespaces) is not None:
+                mapping[datastream.attrib['ID']] = {'version': version.attrib['ID'],
+                                                    'mimetype': version.attrib['MIMETYPE']}
         return mapping
 
+    # Gets one record per current datastream: (dsid, mimetype, control group, location, size, digest, inline).
+    # location is the datastreamStore REF of managed content and None otherwise; size is None when not recorded.
+    def get_datastream_records(self):
+        records = []
+        for datastream in self.root.findall('./foxml:datastream', self.namespaces):
+            version = datastream.findall('./foxml:datastreamVersion', self.namespaces)[-1]
+            location = version.find('./foxml:contentLocation', self.namespaces)
+            if location is not None and location.attrib.get('TYPE') != 'INTERNAL_ID':
+                location = None
+            size = version.attrib.get('SIZE', '')
+            records.append((datastream.attrib['ID'], version.attrib.get('MIMETYPE'),
+                            datastream.attrib.get('CONTROL_GROUP'),
+                            location.attrib['REF'] if location is not None else None,
+                            int(size) if size.isdigit() else None,
+                            self.get_content_digest(version),
+                            version.find('./foxml:binaryContent', self.namespaces) is not None))
+        return records
+
+    # Streams an inline binaryContent datastream to destination, decoding it chunk by chunk.
+    # Returns the number of bytes written, or None if the datastream has no inline binary content.
+    # destination is a path, or a binary file object to append to.
+    def write_binary_content(self, datastream, destination, chunk_size=65536):
+        info = self.get_inline_binary_data().get(datastream)
+        if info is None:
+            return None
+        if hasattr(destination, 'write'):
+            return self.decode_binary_content(info['version'], destination, chunk_size)
+        with open(destination, 'wb') as out:
+            return self.decode_binary_content(info['version'], out, chunk_size)
+
+    def decode_binary_content(self, version_id, out, chunk_size):
+        parser = ET.XMLParser(target=BinaryContentTarget(version_id, out), huge_tree=True)
+        with open(self.foxml_file, 'rb') as foxml:
+            TH.consume(files=1)
+            while True:
+                chunk = foxml.read(chunk_size)
+                if not chunk:
+                    break
+                TH.consume(nbytes=len(chunk))
+                parser.feed(chunk)
+        return parser.close()
+
     # Returns dc stream as XML
     def get_dc(self):
         dc_nodes = self.root.findall(
@@ -126,6 +300,25 @@ class FWorker:
                     re_values[tag] = resource.replace('info:fedora/', '')
         return re_values
 
+    # Returns (predicate, object pid, ordinal) for every resource relationship in RELS-EXT, in document order.
+    # ordinal counts repeats of the same predicate, so multi-valued relationships keep their order.
+    def get_rels_ext_edges(self):
+        edges = []
+        re_nodes = self.root.findall(
+            f'.//foxml:datastream[@ID="RELS-EXT"]/foxml:datastreamVersion/foxml:xmlContent/rdf:RDF',
+            namespaces=self.namespaces)
+        if not re_nodes:
+            return edges
+        ordinals = {}
+        for child in re_nodes[-1].iter():
+            resource = child.attrib.get('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource')
+            if resource:
+                tag = child.xpath('local-name()')
+                ordinal = ordinals.get(tag, 0)
+                ordinals[tag] = ordinal + 1
+                edges.append((tag, resource.replace('info:fedora/', ''), ordinal))
+        return edges
+
     # Older Fedora objects may kep mods inline rather than ina separate file in the dataStore.
     def get_inline_mods(self):
         retval = ''
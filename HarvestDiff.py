@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import csv
+import hashlib
+import sqlite3
+
+import ImportUtilities as IU
+
+"""
+HarvestDiff.py compares two harvests of a namespace by the row_hash of each object.
+A side is either a namespace database or a snapshot written by write_snapshot, a pid-sorted 'pid<TAB>row_hash' file.
+Both sides are read in pid order and merged in one pass, so neither is held in memory.
+"""
+
+# Columns covered by row_hash.  nid is assigned by Drupal after ingest, so it is not part of the content.
+HASH_COLUMNS = ['title', 'content_model', 'collection_pid', 'page_of', 'sequence', 'constituent_of',
+                'dublin_core', 'mods']
+
+
+# Harvests made before values were bound as parameters stored MODS with its single quotes doubled.  Quotes are
+# undoubled before hashing, so those rows are not all reported as changed against a newer harvest.
+def row_hash(row):
+    sha = hashlib.sha256()
+    for column in HASH_COLUMNS:
+        value = '' if row[column] is None else str(row[column])
+        if column == 'mods':
+            value = value.replace("''", "'")
+        sha.update(value.encode('utf-8'))
+        sha.update(b'\x1f')
+    return sha.hexdigest()
+
+
+def is_database(path):
+    with open(path, 'rb') as f:
+        return f.read(16) == b'SQLite format 3\x00'
+
+
+# Yields (pid, row_hash) in pid order.  Rows harvested before row_hash existed are hashed as they are read.
+def iter_hashes(path, table):
+    if not is_database(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                pid, _, digest = line.rstrip('\n').partition('\t')
+                yield pid, digest
+        return
+    table = IU.identifier(table)
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if not columns:
+            raise ValueError(f"{path} has no table '{table}'")
+        stored = 'row_hash' if 'row_hash' in columns else 'NULL AS row_hash'
+        # ORDER BY uses the pid primary key index, and BINARY collation matches Python string order.
+        command = f"SELECT pid, {stored}, {', '.join(HASH_COLUMNS)} FROM {table} ORDER BY pid"
+        for row in conn.execute(command):
+            yield row['pid'], row['row_hash'] or row_hash(row)
+    finally:
+        conn.close()
+
+
+# Writes the pid-sorted hashes of a namespace database to a snapshot file.
+def write_snapshot(database, table, output_file):
+    count = 0
+    with open(output_file, 'w', encoding='utf-8', newline='\n') as f:
+        for pid, digest in iter_hashes(database, table):
+            f.write(f"{pid}\t{digest}\n")
+            count += 1
+    return count
+
+
+# Sort-merge of two pid-ordered hash streams.  Yields ('added' | 'removed' | 'changed', pid).
+def diff(old, new):
+    old = iter(old)
+    new = iter(new)
+    old_row = next(old, None)
+    new_row = next(new, None)
+    while old_row is not None or new_row is not None:
+        if new_row is None or (old_row is not None and old_row[0] < new_row[0]):
+            yield 'removed', old_row[0]
+            old_row = next(old, None)
+        elif old_row is None or new_row[0] < old_row[0]:
+            yield 'added', new_row[0]
+            new_row = next(new, None)
+        else:
+            if old_row[1] != new_row[1]:
+                yield 'changed', new_row[0]
+            old_row = next(old, None)
+            new_row = next(new, None)
+
+
+class DeltaWorksheets:
+    added_fields = ['id', 'title', 'field_pid', 'field_model', 'field_member_of', 'field_weight', 'file']
+    changed_fields = ['node_id', 'title', 'field_pid', 'field_model', 'field_member_of', 'field_weight']
+    removed_fields = ['node_id', 'field_pid']
+
+    # iu reads the new harvest; old_database, when given, supplies node ids of removed objects.
+    def __init__(self, iu, table, output_prefix, old_database=None):
+        self.iu = iu
+        self.table = iu.table(table)
+        self.output_prefix = output_prefix
+        self.old = None
+        if old_database is not None and is_database(old_database):
+            self.old = sqlite3.connect(f"file:{old_database}?mode=ro", uri=True)
+        self.files = {}
+        self.writers = {}
+        self.counts = {'added': 0, 'changed': 0, 'removed': 0}
+
+    def writer(self, status):
+        if status not in self.writers:
+            fieldnames = getattr(self, f"{status}_fields")
+            self.files[status] = open(f"{self.output_prefix}_{status}.csv", 'w', newline='', encoding='utf-8')
+            self.writers[status] = csv.DictWriter(self.files[status], fieldnames=fieldnames)
+            self.writers[status].writeheader()
+        return self.writers[status]
+
+    def get_row(self, pid):
+        return self.iu.conn.execute(f"SELECT * FROM {self.table} WHERE pid = ?", (pid,)).fetchone()
+
+    # Node id of pid.  A new harvest does not hold node ids until they are added, so they come from the old database.
+    def get_nid(self, pid, nid=None):
+        if not nid and self.old is not None:
+            found = self.old.execute(f"SELECT nid FROM {self.table} WHERE pid = ?", (pid,)).fetchone()
+            nid = found[0] if found else None
+        return str(nid) if nid else ''
+
+    # Parent node ids of pid, for update rows; parents not yet ingested have no node id and are left out.
+    def get_member_nids(self, pid):
+        predicates = (*self.iu.member_predicates, 'isPageOf')
+        command = f"""
+            SELECT r.parent_pid, parent.nid FROM {self.iu.relationships(self.table)} AS r
+            LEFT JOIN {self.table} AS parent ON parent.pid = r.parent_pid
+            WHERE r.child_pid = ? AND r.predicate IN ({', '.join('?' for _ in predicates)})
+            ORDER BY r.predicate, r.ordinal
+        """
+        rows = self.iu.conn.execute(command, (pid, *predicates))
+        nids = dict.fromkeys(self.get_nid(parent, nid) for parent, nid in rows)
+        nids.pop('', None)
+        return '|'.join(nids)
+
+    def add(self, status, pid):
+        self.counts[status] += 1
+        if status == 'removed':
+            self.writer(status).writerow({'node_id': self.get_nid(pid), 'field_pid': pid})
+            return
+        current = self.get_row(pid)
+        line = self.iu.map_worksheet_values(dict(current))
+        row = {
+            'title': current['title'],
+            'field_pid': pid,
+            'field_model': line.get('field_model', ''),
+            'field_weight': line.get('field_weight', ''),
+        }
+        if status == 'added':
+            row['id'] = pid
+            row['field_member_of'] = line.get('field_member_of', '')
+        else:
+            row['node_id'] = self.get_nid(pid, current['nid'])
+            row['field_member_of'] = self.get_member_nids(pid)
+        self.writer(status).writerow(row)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        if self.old is not None:
+            self.old.close()
+        return self.counts
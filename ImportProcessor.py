@@ -3,9 +3,10 @@
 import csv
 import time
 
-import FoxmlWorker as FW
+import ConnectionManager as CM
 import ImportServerUtilities as IS
 import ImportUtilities as IU
+import Profiling as PR
 
 """
 This class is used to prepare data for ingest into the UPEI ingestion platform.
@@ -27,8 +28,9 @@ class ImportProcessor:
             'islandora:newspaperIssueCModel': ['OBJ', 'PDF'],
             'islandora:sp-audioCModel': ['OBJ'],
         }
-        self.iu = IU.ImportUtilities(namespace)
-        self.ms = IS.ImportServerUtilities(namespace)
+        self.connections = CM.get_manager(namespace)
+        self.iu = IU.ImportUtilities(namespace, self.connections)
+        self.ms = IS.ImportServerUtilities(namespace, self.connections)
         self.namespace = namespace
         self.export_dir = '/opt/islandora/upei_migration/export'
         self.mimemap = {"image/jpeg": ".jpg",
@@ -57,6 +59,7 @@ class ImportProcessor:
         self.start = time.time()
 
     # Prepares workbench sheet for collection structure
+    @PR.profiled()
     def prepare_collection_worksheet(self, output_file):
         collection_pids = self.iu.get_collection_pids(self.namespace)
         with open(output_file, 'w', newline='') as csvfile:
@@ -84,6 +87,7 @@ class ImportProcessor:
                         processed.append(row.get('id'))
 
     # Prepares ingest worksheets per collections
+    @PR.profiled()
     def prepare_collection_member_worksheet(self, collections, output_file):
         details = self.iu.get_collection_member_details(self.namespace, collections)
         with open(output_file, 'w', newline='') as csvfile:
@@ -95,43 +99,77 @@ class ImportProcessor:
                 writer.writerow(row)
 
     # Prepares worksheets for workbench ingest.
-    def prepare_initial_ingest_worksheet(self, output_file):
+    # With max_rows or max_bytes the worksheet is split into dependency-level batches instead of one file.
+    @PR.profiled()
+    def prepare_initial_ingest_worksheet(self, output_file, max_rows=None, max_bytes=None):
         details = self.iu.get_worksheet_details()
         if not details:  # Check if details is None or empty
             print("No worksheet details found.")
             return
 
+        fieldnames = ['id', 'title', 'field_title', 'field_pid', 'field_model', 'file']
+        rows = []
+        id = 1
+        for detail in details:
+            if not detail or not detail.get('field_pid'):  # Add safer checks for detail and field_pid
+                continue
+
+            # Fetch DC values and ensure it's valid
+            dc = self.iu.get_dc_values(detail['field_pid'])
+            if not dc or 'title' not in dc:  # Ensure dc is not None and has a 'title' key
+                print(f"Warning: Missing DC values for PID {detail['field_pid']}")
+                continue
+
+            # Prepare the row for CSV
+            row = {
+                'id': id,
+                'title': dc['title'],
+                'field_title': dc['title'],
+                'field_pid': detail['field_pid'],
+                'field_model': detail.get('field_model', 'Unknown')  # Use .get() with fallback for safety
+            }
+            if 'web' in detail['field_pid']:
+                rows.append(row)
+            id += 1
+
+        if max_rows or max_bytes:
+            return self.iu.write_worksheet_batches(output_file, fieldnames, rows, max_rows, max_bytes)
         with open(output_file, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile,
-                                    fieldnames=['id', 'title', 'field_title', 'field_pid', 'field_model', 'file'])
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
             writer.writeheader()
-            id = 1
-
-            for detail in details:
-                if not detail or not detail.get('field_pid'):  # Add safer checks for detail and field_pid
-                    continue
-
-                # Fetch DC values and ensure it's valid
-                dc = self.iu.get_dc_values(detail['field_pid'])
-                if not dc or 'title' not in dc:  # Ensure dc is not None and has a 'title' key
-                    print(f"Warning: Missing DC values for PID {detail['field_pid']}")
-                    continue
-
-                # Prepare the row for CSV
-                row = {
-                    'id': id,
-                    'title': dc['title'],
-                    'field_title': dc['title'],
-                    'field_pid': detail['field_pid'],
-                    'field_model': detail.get('field_model', 'Unknown')  # Use .get() with fallback for safety
-                }
+            for row in rows:
                 try:
-                    if 'web' in detail['field_pid']:
-                        writer.writerow(row)
+                    writer.writerow(row)
                 except Exception as e:
                     print(f"Failed to write row {row}: {e}")
-                id += 1
 
+    # Prepares the page worksheet for every book and newspaper issue in a collection, pages in sequence order.
+    # Parents are not rows of this worksheet, so pages point at their ingested parent node through field_member_of.
+    @PR.profiled()
+    def prepare_page_worksheet(self, collection, output_file):
+        fieldnames = ['id', 'title', 'field_pid', 'field_member_of', 'field_weight', 'field_model', 'file']
+        count = 0
+        orphans = 0
+        with open(output_file, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+            writer.writeheader()
+            for page in self.iu.get_collection_pages(self.namespace, collection):
+                writer.writerow({
+                    'id': page['pid'],
+                    'title': page['title'],
+                    'field_pid': page['pid'],
+                    'field_member_of': page['parent_nid'] or '',
+                    'field_weight': page['sequence'] if page['sequence'] is not None else '',
+                    'field_model': 'Page',
+                })
+                count += 1
+                if not page['parent_nid']:
+                    orphans += 1
+        print(f"Wrote {count} pages from {collection} to {output_file}")
+        if orphans:
+            print(f"{orphans} pages have a parent without a node id; add the parent node ids and write them again")
+
+    @PR.profiled()
     def prepare_relationship_worksheet(self, output_file):
         relationships = self.iu.get_relationships(self.namespace)
         with open(output_file, 'w', newline='') as csvfile:
@@ -149,9 +187,28 @@ class ImportProcessor:
 
 
 
+    # The stream map restricted to content_models, or all of it.
+    def get_stream_map(self, content_models=None):
+        if content_models is None:
+            return self.stream_map
+        unknown = [model for model in content_models if model not in self.stream_map]
+        if unknown:
+            raise ValueError(f"No datastreams are mapped for {', '.join(unknown)}")
+        return {model: self.stream_map[model] for model in content_models}
+
+    # Prints the staging plan totals per content model without staging anything.
+    def plan_staging(self, content_models=None):
+        return self.ms.summarize_staging_plan(self.get_stream_map(content_models))
+
+    # Stages the datastreams stream_map lists for each object's content model.
+    def stage_by_content_model(self, content_models=None, dedupe=False, journal=False, media_worksheet=None,
+                               media_rows=None):
+        self.ms.stage_planned(self.get_stream_map(content_models), dedupe, journal, media_worksheet, media_rows)
+
     def full_server_prep(self):
         self.ms.build_record_from_pids(self.namespace)
 
 
-MP = ImportProcessor('bdh')
-MP.prepare_relationship_worksheet('worksheets/new_relations.csv')
+if __name__ == '__main__':
+    MP = ImportProcessor('bdh')
+    MP.prepare_relationship_worksheet('worksheets/new_relations.csv')
@@ -2,22 +2,49 @@
 
 # Utility class for functions to be run on the server
 import csv
+import hashlib
+import itertools
+import os
 import shutil
 from pathlib import Path
 from urllib.parse import unquote
-from typing import Optional, List
-import FoxmlWorker as FW
+from typing import Optional, List, Union
+import ConnectionManager as CM
 import ImportUtilities as IU
-import json
+import Profiling as PR
+
+
+# Per-process ImportServerUtilities used by aggregate_full_text workers.
+full_text_worker = None
+
+
+def init_full_text_worker(namespace, object_store, datastream_store):
+    global full_text_worker
+    # Workers only read FOXML and datastreams, so they open the database file rather than a snapshot of it.
+    CM.use_snapshots(None)
+    full_text_worker = ImportServerUtilities(namespace)
+    full_text_worker.objectStore = object_store
+    full_text_worker.datastreamStore = datastream_store
+
+
+def aggregate_parent_text(parent_nid, page_pids, datastreams, destination):
+    return full_text_worker.write_parent_text(parent_nid, page_pids, datastreams, destination)
 
 
 class ImportServerUtilities:
-    def __init__(self, namespace):
+    def __init__(self, namespace, connections=None):
         self.namespace = namespace
         self.objectStore = '/usr/local/fedora/data/objectStore'
         self.datastreamStore = '/usr/local/fedora/data/datastreamStore'
         self.staging_dir = 'staging'
-        self.iu = IU.ImportUtilities(namespace)
+        self.staged_digests = None
+        self.manifest_rows = set()
+        self.manifest_file = None
+        self.manifest_writer = None
+        # media_use_tid per datastream for the media worksheet; None uses MediaWorksheet.MEDIA_USE.
+        self.media_use = None
+        self.media_worksheet = None
+        self.iu = IU.ImportUtilities(namespace, connections)
         self.mimemap = {"image/jpeg": ".jpg",
                         "image/jp2": ".jp2",
                         "image/png": ".png",
@@ -36,99 +63,463 @@ class ImportServerUtilities:
                         }
 
     # Retrieves FOXml object store with pid
-    def get_foxml_from_pid(self, pid):
+    def get_foxml_from_pid(self, pid, skip_binary=False):
+        import FoxmlWorker as FW
         foxml_file = self.iu.dereference(pid)
         foxml = f"{self.objectStore}/{foxml_file}"
         try:
-            return FW.FWorker(foxml)
+            return FW.FWorker(foxml, skip_binary=skip_binary)
         except:
             print(f"No results found for {pid}")
 
     # Gets PIDS, filtered by namespace directly from objectStore
+    # hash_dirs restricts the scan to the given '##' directories of the objectStore.
     @IU.ImportUtilities.timeit
-    def get_pids_from_objectstore(self, namespace=''):
-        namespace = f"info%3Afedora%2F{namespace}%3A"
-        wildcard = '*/*'
-        if namespace:
-            wildcard = f'*/{namespace}*'
-        pids = []
-        for p in Path(self.objectStore).rglob(wildcard):
-            pid = unquote(p.name).replace('info:fedora/', '')
-            pids.append(pid)
+    def get_pids_from_objectstore(self, namespace='', hash_dirs=None):
+        pids = list(self.iter_pids_from_objectstore(namespace or None, hash_dirs))
         print(f"Total number of PIDs found: {len(pids)}")
         return pids
 
-    # Gets all dc datastream from objectstore
-    def get_all_dc(self):
+    # Yields PIDS as the objectStore is scanned, so callers can start work before the scan ends.
+    # namespaces is one namespace or a set of them; None or '*' matches every namespace.
+    # content_models is a hint: only objects whose FOXML mentions one of the models are yielded.
+    # It is a byte search, not a parse, so callers that need certainty must still check the model.
+    def iter_pids_from_objectstore(self, namespaces=None, hash_dirs=None, content_models=None):
+        import Throttle as TH
+        if isinstance(namespaces, str):
+            namespaces = {namespaces}
+        if namespaces is not None and '*' in namespaces:
+            namespaces = None
+        if isinstance(content_models, str):
+            content_models = [content_models]
+        hints = [f"info:fedora/{model}".encode() for model in content_models or []]
+        prefix = 'info%3Afedora%2F'
+        if hash_dirs is None:
+            with os.scandir(self.objectStore) as entries:
+                hash_dirs = sorted(entry.name for entry in entries if entry.is_dir())
+        for hash_dir in hash_dirs:
+            TH.consume(files=1)
+            try:
+                entries = os.scandir(os.path.join(self.objectStore, hash_dir))
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    if not entry.name.startswith(prefix):
+                        continue
+                    namespace, separator, _ = entry.name[len(prefix):].partition('%3A')
+                    if not separator or (namespaces is not None and unquote(namespace) not in namespaces):
+                        continue
+                    if hints and not self.foxml_mentions(entry.path, hints):
+                        continue
+                    yield unquote(entry.name)[len('info:fedora/'):]
+
+    # Reports whether any of the needles occur in a FOXML file.  The file is searched in chunks that overlap by
+    # the longest needle, so memory stays bounded by chunk_size whatever inline binary the object holds,
+    # and reading stops at the first match.
+    def foxml_mentions(self, path, needles, chunk_size=1048576):
+        import Throttle as TH
+        overlap = max(len(needle) for needle in needles) - 1
+        read = 0
+        tail = b''
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    read += len(chunk)
+                    window = tail + chunk
+                    if any(needle in window for needle in needles):
+                        return True
+                    tail = window[-overlap:] if overlap else b''
+            return False
+        finally:
+            TH.consume(files=1, nbytes=read)
+
+    # Parses every object in table, the namespace table by default, once and fans it out to each extractor.
+    # An object that cannot be read or processed is reported and skipped, so one bad file does not end the pass.
+    @PR.profiled()
+    @IU.ImportUtilities.timeit
+    def run_extractors(self, extractors, table=None):
+        import FoxmlWorker as FW
         cursor = self.iu.conn.cursor()
-        statement = f"select pid from {self.namespace}"
-        headers = 'pid', 'dublin_core'
-        csv_file_path = f"{self.staging_dir}/{self.namespace}_dc.csv"
-        with open(csv_file_path, mode="w", newline="", encoding="utf-8") as file:
-            writer = csv.DictWriter(file, fieldnames=headers)  # Pass the file object here
-            writer.writeheader()
+        statement = f"select pid, nid from {self.iu.table(table or self.namespace)}"
+        for extractor in extractors:
+            extractor.open(self)
+        try:
             for row in cursor.execute(statement):
                 pid = row['pid']
-                foxml_file = self.iu.dereference(pid)
-                foxml = f"{self.objectStore}/{foxml_file}"
                 try:
-                    fw = FW.FWorker(foxml)
-                except:
-                    print(f"No record found for {pid}")
-                    continue
-                dc = fw.get_dc()
-                writer.writerow({'pid': pid, 'dublin_core': dc})
+                    fw = FW.FWorker(f"{self.objectStore}/{self.iu.dereference(pid)}", skip_binary=True)
+                    for extractor in extractors:
+                        extractor.process(pid, row['nid'], fw)
+                except (OSError, ValueError, RuntimeError) as e:
+                    print(f"Skipping {pid}: {e}")
+        finally:
+            for extractor in extractors:
+                extractor.close()
+
+    # Gets all dc datastream from objectstore
+    def get_all_dc(self):
+        import FoxmlExtractors as FE
+        self.run_extractors([FE.DCExtractor()])
+
+    # Copies the requested datastreams of one object to the staging directory.
+    # Managed files are copied from the datastreamStore; inline base64 binaryContent is decoded as it is read.
+    # With dedupe, content already staged under another name is hardlinked instead of copied again.
+    # With a journal, datastreams it records as staged are skipped and every copy is recorded.
+    def stage_pid(self, pid, nid, datastreams, dedupe=False, journal=None):
+        if journal is not None:
+            datastreams = [datastream for datastream in datastreams
+                           if not self.skip_staged(journal, pid, nid, datastream)]
+            if not datastreams:
+                return
+        fw = self.get_foxml_from_pid(pid, skip_binary=True)
+        if fw is None:
+            return
+        all_files = fw.get_file_data()
+        inline_files = fw.get_inline_binary_data()
+        for datastream in datastreams:
+            if datastream in all_files:
+                file_info = all_files[datastream]
+                source = f"{self.datastreamStore}/{self.iu.dereference(file_info['filename'])}"
+                digest = file_info['digest']
+            elif datastream in inline_files:
+                file_info = inline_files[datastream]
+                source = None
+                digest = None
+            else:
+                print(f"Datastream not found for {nid}")
+                if journal is not None:
+                    journal.mark_missing(pid, datastream)
+                continue
+            self.stage_task(pid, nid, datastream, file_info['mimetype'], source, digest, fw, dedupe, journal)
+
+    # True when the journal has already staged the datastream or knows the object lacks it.  Files staged by an
+    # earlier run go into the media worksheet again, so the worksheet of a resumed run lists every staged file.
+    def skip_staged(self, journal, pid, nid, datastream):
+        destination = journal.staged_destination(pid, datastream)
+        if destination is not None:
+            self.record_media(nid, datastream, destination)
+            return True
+        return journal.is_missing(pid, datastream)
+
+    # Stages one datastream of an object, recording it in the journal and media worksheet when they are open.
+    # fw is only needed for inline content, where source is None.  A datastream that cannot be staged, because
+    # its mimetype is unknown, its file is unreadable or its inline content does not decode, is reported and skipped.
+    def stage_task(self, pid, nid, datastream, mimetype, source, digest, fw, dedupe=False, journal=None):
+        extension = self.mimemap.get(mimetype)
+        destination = f"{self.staging_dir}/{nid}_{datastream}{extension}" if extension else None
+        if journal is not None:
+            journal.start(pid, datastream, source or fw.foxml_file, destination, digest)
+        try:
+            if destination is None:
+                raise ValueError(f"no file extension for mimetype '{mimetype}'")
+            self.unlink_shared(destination, dedupe)
+            digest = self.stage_datastream(pid, fw, datastream, source, destination, digest, dedupe)
+        except (OSError, ValueError, SyntaxError) as e:
+            # binascii.Error from the base64 decode is a ValueError and lxml's XMLSyntaxError a SyntaxError.
+            print(f"Failed to stage {datastream} for {pid}: {e}")
+            if destination is not None and os.path.exists(f"{destination}.part"):
+                os.remove(f"{destination}.part")
+            if journal is not None:
+                journal.fail(pid, datastream, str(e))
+            return
+        if journal is not None:
+            journal.finish(pid, datastream, os.path.getsize(destination), digest)
+        self.record_media(nid, datastream, destination)
+
+    # Writes one datastream to destination through a .part file, so destination is only ever complete.
+    # source is None for inline binaryContent.  Returns the digest used for dedupe, if any.
+    def stage_datastream(self, pid, fw, datastream, source, destination, digest, dedupe):
+        import Throttle as TH
+        if dedupe and source is not None:
+            digest = self.dedupe_digest(digest, source)
+            if self.link_duplicate(digest, destination):
+                return digest
+        part = f"{destination}.part"
+        if source is not None:
+            TH.copy(source, part)
+        else:
+            fw.write_binary_content(datastream, part)
+            if dedupe:
+                digest = self.hash_file(part)
+                if self.link_duplicate(digest, destination):
+                    os.remove(part)
+                    return digest
+        os.replace(part, destination)
+        print(f"{pid} {destination}")
+        if dedupe:
+            self.record_staged_digest(digest, destination, destination)
+        return digest
+
+    # Starts writing the media worksheet for everything staged until close_media_worksheet is called.
+    def open_media_worksheet(self, output_file, rows_per_file=None):
+        import MediaWorksheet as MW
+        self.close_media_worksheet()
+        self.media_worksheet = MW.MediaWorksheet(output_file, self.media_use, rows_per_file)
+
+    def close_media_worksheet(self):
+        if self.media_worksheet is not None:
+            files = self.media_worksheet.close()
+            self.media_worksheet = None
+            print(f"Media worksheet written to {', '.join(files) or 'no files'}")
+
+    # Adds a staged file to the open media worksheet, if there is one, by its name within the staging directory.
+    def record_media(self, nid, datastream, destination):
+        if self.media_worksheet is not None:
+            self.media_worksheet.add(nid, datastream, os.path.basename(destination))
+
+    # Opens the staging journal for this namespace.
+    def open_staging_journal(self):
+        import StagingJournal as SJ
+        return SJ.StagingJournal(f"{self.namespace}_staging_journal.db")
 
     #  Copies digital assets from dataStream store to staging directory
-    @IU.ImportUtilities.timeit
-    def stage_files(self, content_model: Optional[str] = None, datastreams: Optional[List] = None) -> None:
+    #  With media_worksheet, a media worksheet row is written for each staged file, rotating every media_rows rows.
+    #  Timed by stage_files_from_list, which does the work.
+    @PR.profiled()
+    def stage_files(self, content_model: Optional[Union[str, List]] = None, datastreams: Optional[List] = None,
+                    dedupe: bool = False, journal: bool = False, media_worksheet: Optional[str] = None,
+                    media_rows: Optional[int] = None) -> None:
         if datastreams is None:
             datastreams = ['OBJ']
         if content_model is None:
-            pids = self.get_pids_from_objectstore(self.namespace)
+            pids = self.iter_pids_from_objectstore(self.namespace)
         else:
             pids = self.iu.get_pids_by_content_model(self.namespace, content_model)
-        for pid in pids:
-            nid = self.iu.get_nid_from_pid(self.namespace, pid)
-            if nid == '':
-                continue
-            fw = self.get_foxml_from_pid(pid)
-            all_files = fw.get_file_data()
-            for datastream in datastreams:
-                if datastream in all_files:
-                    file_info = all_files[datastream]
-                    source = f"{self.datastreamStore}/{self.iu.dereference(file_info['filename'])}"
-                    extension = self.mimemap[file_info['mimetype']]
-                    destination = f"{self.staging_dir}/{nid}_{datastream}{extension}"
-                    shutil.copy(source, destination)
-                    print(f"{nid} {pid} {destination}")
-                else:
-                    print(f"Datastream not found for {nid}")
+        self.stage_files_from_list(datastreams, pids, dedupe, journal, media_worksheet, media_rows)
 
     # Stages list of files.
+    @PR.profiled()
     @IU.ImportUtilities.timeit
-    def stage_files_from_list(self, datastreams, pids) -> None:
-        for pid in pids:
-            nid = self.iu.get_nid_from_pid(self.namespace, pid)
-            if nid == '':
-                continue
-            fw = self.get_foxml_from_pid(pid)
-            all_files = fw.get_file_data()
-            for datastream in datastreams:
-                if datastream in all_files:
-                    file_info = all_files[datastream]
-                    source = f"{self.datastreamStore}/{self.iu.dereference(file_info['filename'])}"
-                    extension = self.mimemap[file_info['mimetype']]
-                    destination = f"{self.staging_dir}/{nid}_{datastream}{extension}"
-                    shutil.copy(source, destination)
-                    print(f"{nid} {pid} {destination}")
+    def stage_files_from_list(self, datastreams, pids, dedupe=False, journal=False, media_worksheet=None,
+                              media_rows=None) -> None:
+        staging_journal = self.open_staging_journal() if journal else None
+        if media_worksheet:
+            self.open_media_worksheet(media_worksheet, media_rows)
+        try:
+            for pid in pids:
+                nid = self.iu.get_nid_from_pid(self.namespace, pid)
+                if nid == '':
+                    continue
+                self.stage_pid(pid, nid, datastreams, dedupe, staging_journal)
+        finally:
+            if media_worksheet:
+                self.close_media_worksheet()
+            if staging_journal is not None:
+                staging_journal.close()
+            self.close_dedupe_manifest()
+
+    # Prints the totals of the staging plan for stream_map, {content_model: [dsid, ...]}, and returns them.
+    def summarize_staging_plan(self, stream_map):
+        totals = self.iu.get_staging_totals(self.namespace, stream_map)
+        print(f"{'Content model':<40} {'Objects':>8} {'Tasks':>8} {'MiB':>10} {'Unsized':>8} {'Missing':>8}")
+        for row in totals:
+            print(f"{row['content_model']:<40} {row['objects']:>8} {row['tasks']:>8} {row['bytes'] / 1048576:>10.1f} "
+                  f"{row['unsized']:>8} {row['missing']:>8}")
+        return totals
+
+    # Stages exactly the tasks of the staging plan for stream_map.  Managed datastreams are copied straight from
+    # the datastreamStore locations recorded at harvest, so only objects with inline content are parsed.
+    @PR.profiled()
+    @IU.ImportUtilities.timeit
+    def stage_planned(self, stream_map, dedupe=False, journal=False, media_worksheet=None, media_rows=None):
+        self.summarize_staging_plan(stream_map)
+        staging_journal = self.open_staging_journal() if journal else None
+        if media_worksheet:
+            self.open_media_worksheet(media_worksheet, media_rows)
+        fw = None
+        try:
+            for task in self.iu.get_staging_tasks(self.namespace, stream_map):
+                pid = task['pid']
+                if staging_journal is not None and self.skip_staged(staging_journal, pid, task['nid'], task['dsid']):
+                    continue
+                if task['location'] is not None:
+                    source = f"{self.datastreamStore}/{self.iu.dereference(task['location'])}"
                 else:
-                    print(f"Datastream not found for {nid}")
+                    source = None
+                    if fw is None or fw.get_pid() != pid:
+                        fw = self.get_foxml_from_pid(pid, skip_binary=True)
+                        if fw is None:
+                            continue
+                self.stage_task(pid, task['nid'], task['dsid'], task['mimetype'], source, task['digest'], fw, dedupe,
+                                staging_journal)
+        finally:
+            if media_worksheet:
+                self.close_media_worksheet()
+            if staging_journal is not None:
+                staging_journal.close()
+            self.close_dedupe_manifest()
+
+    # Removes a previously staged hardlink so restaging does not write through to its other names.
+    # Hardlinks are only made by dedupe, so without dedupe or a dedupe manifest there is nothing to check.
+    def unlink_shared(self, destination, dedupe=False):
+        if not dedupe and not self.get_staged_digests():
+            return
+        try:
+            if os.lstat(destination).st_nlink > 1:
+                os.remove(destination)
+        except FileNotFoundError:
+            pass
+
+    # Dedupe keys are 'SHA-256:<hex>' whatever Fedora recorded, so identical content matches whether or not its
+    # FOXML has a digest.  A FOXML SHA-256 digest is used as is; any other source is hashed.
+    def dedupe_digest(self, digest, source):
+        import Throttle as TH
+        algorithm, _, value = (digest or '').partition(':')
+        if algorithm.upper() == 'SHA-256' and value:
+            return f"SHA-256:{value.lower()}"
+        TH.consume(files=1, nbytes=os.path.getsize(source))
+        return self.hash_file(source)
+
+    # Hashes file content for datastreams without a usable FOXML digest.
+    def hash_file(self, path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), b''):
+                sha.update(chunk)
+        return f"SHA-256:{sha.hexdigest()}"
+
+    # Maps digests to the first staged copy, seeded from the manifest of earlier runs.
+    def get_staged_digests(self):
+        if self.staged_digests is None:
+            self.staged_digests = {}
+            manifest = f"{self.staging_dir}/{self.namespace}_dedupe_manifest.csv"
+            if os.path.exists(manifest):
+                with open(manifest, newline='') as f:
+                    for row in csv.DictReader(f):
+                        self.manifest_rows.add((row['destination'], row['original'], row['digest']))
+                        if row['original'] == row['destination'] and os.path.exists(row['original']):
+                            self.staged_digests[row['digest']] = row['original']
+        return self.staged_digests
+
+    # Appends a staged file to the dedupe manifest, unless an earlier run already recorded it.
+    # The first copy of a digest is its own original.  The manifest stays open until close_dedupe_manifest.
+    def record_staged_digest(self, digest, destination, original):
+        self.get_staged_digests().setdefault(digest, original)
+        if (destination, original, digest) in self.manifest_rows:
+            return
+        self.manifest_rows.add((destination, original, digest))
+        if self.manifest_writer is None:
+            manifest = f"{self.staging_dir}/{self.namespace}_dedupe_manifest.csv"
+            is_new = not os.path.exists(manifest)
+            self.manifest_file = open(manifest, 'a', newline='')
+            self.manifest_writer = csv.DictWriter(self.manifest_file, fieldnames=['destination', 'original', 'digest'])
+            if is_new:
+                self.manifest_writer.writeheader()
+        self.manifest_writer.writerow({'destination': destination, 'original': original, 'digest': digest})
+        # Flushed per row, so a crash loses no row of a file that is already staged.
+        self.manifest_file.flush()
+
+    def close_dedupe_manifest(self):
+        if self.manifest_file is not None:
+            self.manifest_file.close()
+            self.manifest_file = None
+            self.manifest_writer = None
+
+    # Hardlinks destination to an already staged copy of digest.  Returns False if there is none yet.
+    def link_duplicate(self, digest, destination):
+        original = self.get_staged_digests().get(digest)
+        if original is None or original == destination:
+            return False
+        if os.path.lexists(destination):
+            os.remove(destination)
+        try:
+            os.link(original, destination)
+        except OSError:
+            shutil.copy(original, destination)
+        self.record_staged_digest(digest, destination, original)
+        print(f"{destination} duplicates {original}")
+        return True
+
+    # Writes one concatenated text file per book or newspaper issue under collection, pages in sequence order.
+    # Each page contributes the first of datastreams it has, streamed from the datastreamStore or its inline
+    # binaryContent, so no page text is held in memory.  Books are processed in parallel by worker processes.
+    @PR.profiled()
+    @IU.ImportUtilities.timeit
+    def aggregate_full_text(self, collection, datastreams=None, workers=4, output_dir=None):
+        from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+        datastreams = datastreams or ['FULL_TEXT', 'OCR']
+        output_dir = output_dir or self.staging_dir
+        pages = self.iu.get_collection_pages(self.namespace, collection)
+        totals = {'parents': 0, 'pages': 0, 'missing': 0, 'skipped': 0}
+        with ProcessPoolExecutor(workers, initializer=init_full_text_worker,
+                                 initargs=(self.namespace, self.objectStore, self.datastreamStore)) as pool:
+            pending = set()
+            for parent_pid, parent_pages in itertools.groupby(pages, key=lambda page: page['parent_pid']):
+                parent_pages = list(parent_pages)
+                page_pids = [page['pid'] for page in parent_pages]
+                parent_nid = parent_pages[0]['parent_nid']
+                if not parent_nid:
+                    print(f"Skipping {parent_pid}: no node id")
+                    continue
+                destination = f"{output_dir}/{parent_nid}_FULL_TEXT.txt"
+                pending.add(pool.submit(aggregate_parent_text, parent_nid, page_pids, datastreams, destination))
+                # Only a few books are queued ahead of the workers, so memory stays bounded.
+                if len(pending) >= workers * 4:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    self.collect_full_text(done, totals)
+            self.collect_full_text(pending, totals)
+        print(f"Full text for {totals['parents']} parents from {totals['pages']} pages; "
+              f"{totals['missing']} pages had no text; {totals['skipped']} parents skipped")
+        return totals
+
+    def collect_full_text(self, futures, totals):
+        for future in futures:
+            parent_nid, destination, pages, missing = future.result()
+            totals['pages'] += pages
+            totals['missing'] += missing
+            if destination is None:
+                totals['skipped'] += 1
+                continue
+            totals['parents'] += 1
+            self.record_media(parent_nid, 'FULL_TEXT', destination)
+
+    # Streams the text of page_pids into destination through a .part file.  Pages are separated by a blank line.
+    # A parent whose pages have no text, or whose text cannot be written, gets no file; destination is then None.
+    def write_parent_text(self, parent_nid, page_pids, datastreams, destination):
+        import Throttle as TH
+        pages = 0
+        missing = 0
+        part = f"{destination}.part"
+        try:
+            with open(part, 'wb') as out:
+                for pid in page_pids:
+                    fw = self.get_foxml_from_pid(pid, skip_binary=True)
+                    if fw is None:
+                        missing += 1
+                        continue
+                    all_files = fw.get_file_data()
+                    inline_files = fw.get_inline_binary_data()
+                    datastream = next((ds for ds in datastreams if ds in all_files or ds in inline_files), None)
+                    if datastream is None:
+                        missing += 1
+                        continue
+                    if pages:
+                        out.write(b'\n\n')
+                    if datastream in all_files:
+                        source = f"{self.datastreamStore}/{self.iu.dereference(all_files[datastream]['filename'])}"
+                        TH.copy_into(source, out)
+                    else:
+                        fw.write_binary_content(datastream, out)
+                    pages += 1
+        except Exception as e:
+            print(f"Failed to write full text of {parent_nid}: {e}")
+            if os.path.exists(part):
+                os.remove(part)
+            return parent_nid, None, 0, missing
+        if not pages:
+            os.remove(part)
+            print(f"No page text for {parent_nid}")
+            return parent_nid, None, 0, missing
+        os.replace(part, destination)
+        print(f"{destination}: {pages} pages")
+        return parent_nid, destination, pages, missing
 
     # Builds record directly from objectStore
     @IU.ImportUtilities.timeit
     def build_record_from_pids(self, namespace, output_file):
-        pids = self.get_pids_from_objectstore(namespace)
+        import FoxmlWorker as FW
+        pids = self.iter_pids_from_objectstore(namespace)
         headers = [
             'title',
             'pid',
@@ -145,7 +536,7 @@ class ImportServerUtilities:
                 foxml_file = self.iu.dereference(pid)
                 foxml = f"{self.objectStore}/{foxml_file}"
                 if (foxml):
-                    fw = FW.FWorker(foxml)
+                    fw = FW.FWorker(foxml, skip_binary=True)
                     if fw.get_state() != 'Active':
                         continue
                     relations = fw.get_rels_ext_values()
@@ -162,107 +553,58 @@ class ImportServerUtilities:
     # Adds all MODS records from datastreamStore to database.
     @IU.ImportUtilities.timeit
     def add_mods_to_database(self, table):
+        import FoxmlWorker as FW
+        import Throttle as TH
         cursor = self.iu.conn.cursor()
-        pids = self.get_pids_from_objectstore(table)
+        pids = self.iter_pids_from_objectstore(table)
         for pid in pids:
             foxml_file = self.iu.dereference(pid)
             foxml = f"{self.objectStore}/{foxml_file}"
-            fw = FW.FWorker(foxml)
+            fw = FW.FWorker(foxml, skip_binary=True)
             if fw.get_state() != 'Active':
                 continue
             mapping = fw.get_file_data()
             mods_info = mapping.get('MODS')
             if mods_info:
                 mods_path = f"{self.datastreamStore}/{self.iu.dereference(mods_info['filename'])}"
-                mods_xml = Path(mods_path).read_text()
+                mods_xml = TH.read_text(mods_path)
             else:
                 mods_xml = fw.get_inline_mods()
             if mods_xml:
-                mods_xml = mods_xml.replace("'", "''")
-                command = f"""UPDATE {table} set mods = '{mods_xml}' where pid = '{pid}'"""
-                cursor.execute(command)
+                command = f"UPDATE {self.iu.table(table)} set mods = ? where pid = ?"
+                cursor.execute(command, (mods_xml, pid))
         self.iu.conn.commit()
 
-    def get_dsids_with_count(self, namespace):
-        dsids = {}
-        pids = self.get_pids_from_objectstore('ivoices')
-        for pid in pids:
-            foxml_file = self.iu.dereference(pid)
-            foxml = f"{self.objectStore}/{foxml_file}"
-            if (foxml):
-                fw = FW.FWorker(foxml)
-                if fw.get_state() != 'Active':
-                    continue
-                datastreams = fw.get_datastream_types()
-                for datastream in datastreams.keys():
-                    count = dsids.get(datastream)
-                    if count is not None:
-                        dsids[datastream] = count + 1
-                    else:
-                        dsids[datastream] = 1
-        with open("dsid.json", "w") as file:
-            json.dump(dsids, file, indent=4)
+    def get_dsids_with_count(self, namespace=None):
+        import FoxmlExtractors as FE
+        self.run_extractors([FE.DsidCountExtractor()], namespace)
 
     def get_inline_datastreams(self):
-        cursor = self.iu.conn.cursor()
-        statement = f"select pid from {self.namespace}"
-        headers = ['pid', 'dublin_core', 'pb_core', 'mods']
-        csv_file_path = f"{self.staging_dir}/{self.namespace}_inline.csv"
-        with open(csv_file_path, mode="w", newline="", encoding="utf-8") as file:
-            writer = csv.DictWriter(file, fieldnames=headers)  # Pass the file object here
-            writer.writeheader()
-            for row in cursor.execute(statement):
-                pid = row['pid']
-                foxml_file = self.iu.dereference(pid)
-                foxml = f"{self.objectStore}/{foxml_file}"
-                try:
-                    fw = FW.FWorker(foxml)
-                except:
-                    print(f"No record found for {pid}")
-                    continue
-                dc = fw.get_dc()
-                pb = fw.get_inline_pbcore()
-                mods = fw.get_inline_mods()
-                writer.writerow({'pid': pid, 'dublin_core': dc, 'pb_core': pb, 'mods': mods})
+        import FoxmlExtractors as FE
+        self.run_extractors([FE.InlineDatastreamExtractor()])
 
     def stage_inline_pb(self):
-        cursor = self.iu.conn.cursor()
-        statement = f"select pid, nid from {self.namespace} where pbcore = ''"
-        for row in cursor.execute(statement):
-            pid = row['pid']
-            foxml_file = self.iu.dereference(pid)
-            foxml = f"{self.objectStore}/{foxml_file}"
-            try:
-                fw = FW.FWorker(foxml)
-            except:
-                print(f"No record found for {pid}")
-                continue
-            pb = fw.get_inline_pbcore()
-            if pb:
-                f = open(f"{self.staging_dir}/{row['nid']}_PBCORE.xml")
-                f.write(pb)
-                f.close()
+        import FoxmlExtractors as FE
+        self.run_extractors([FE.InlineStreamStager('PBCORE')])
 
     def stage_inline_mxml(self):
-        cursor = self.iu.conn.cursor()
-        statement = f"select pid, nid from {self.namespace}"
-        for row in cursor.execute(statement):
-            pid = row['pid']
-            foxml_file = self.iu.dereference(pid)
-            foxml = f"{self.objectStore}/{foxml_file}"
-            try:
-                fw = FW.FWorker(foxml)
-            except:
-                print(f"No record found for {pid}")
-                continue
-            mx = fw.get_inline_pbcore()
-            if mx:
-                f = open(f"{self.staging_dir}/{row['nid']}_MusicXML.xml")
-                f.write(mx)
-                f.close()
+        import FoxmlExtractors as FE
+        self.run_extractors([FE.InlineStreamStager('MusicXML')])
+
+    # Runs the DC, inline datastream, DSID count and inline PBCORE/MusicXML passes in a single traversal.
+    def extract_all(self):
+        import FoxmlExtractors as FE
+        self.run_extractors([
+            FE.DCExtractor(),
+            FE.InlineDatastreamExtractor(),
+            FE.DsidCountExtractor(),
+            FE.InlineStreamStager('PBCORE'),
+            FE.InlineStreamStager('MusicXML'),
+        ])
 
     @IU.ImportUtilities.timeit
     def stage_bio(self):
+        import FoxmlWorker as FW
         pids = self.iu.get_pids_by_content_model(self.namespace, 'islandora:entityCModel')
         headers = 'term_id', 'description'
         csv_file_path = f"{self.staging_dir}/{self.namespace}_BIO.csv"
@@ -273,7 +615,7 @@ class ImportServerUtilities:
                 foxml_file = self.iu.dereference(pid)
                 foxml = f"{self.objectStore}/{foxml_file}"
                 try:
-                    fw = FW.FWorker(foxml)
+                    fw = FW.FWorker(foxml, skip_binary=True)
                 except:
                     print(f"No record found for {pid}")
                     continue
@@ -7,18 +7,26 @@ import urllib
 import urllib.parse
 from typing import Any
 
-import lxml.etree as ET
 import re
 import time
 import functools
-import pickle
-import ModsTransformer as MT
+import ConnectionManager as CM
+import PidSet as PS
+
+
+# Table names cannot be bound as parameters, so only well-formed identifiers are interpolated into SQL.
+def identifier(name):
+    if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', name):
+        raise ValueError(f"Invalid table name '{name}'")
+    return name
 
 
 class ImportUtilities:
-    def __init__(self, namespace):
-        self.conn = sqlite3.connect(f'{namespace}.db')
-        self.conn.row_factory = sqlite3.Row
+    def __init__(self, namespace, connections=None):
+        if connections is None:
+            connections = CM.get_manager(namespace)
+        self.connections = connections
+        self.conn = connections.writer()
         self.fields = ['PID', 'model', 'RELS_EXT_isMemberOfCollection_uri_ms', 'RELS_EXT_isPageOf_uri_ms']
         self.objectStore = '/usr/local/fedora/data/objectStore/'
         self.datastreamStore = '/usr/local/fedora/data/datastreamStore/'
@@ -31,7 +39,32 @@ class ImportUtilities:
             'isConstituentOf': 'constituent_of',
             'mods': 'mods'
         }
+        # RELS-EXT predicates kept in the {table}_relationships edge table, and the column each one fills.
+        self.edge_predicates = {
+            'isMemberOfCollection': 'collection_pid',
+            'isMemberOf': 'collection_pid',
+            'isPageOf': 'page_of',
+            'isConstituentOf': 'constituent_of',
+        }
+        self.member_predicates = ('isMemberOfCollection', 'isMemberOf')
         self.namespace = namespace
+        self.mt = None
+        self.graph = None
+        self.tables = set()
+
+    # Only identifiers naming existing tables are interpolated; must_exist=False only checks the identifier.
+    def table(self, table, must_exist=True):
+        if table in self.tables:
+            return table
+        identifier(table)
+        if must_exist:
+            # A partial in-memory snapshot keeps the tables it did not copy in the attached database file.
+            if not any(self.conn.execute(f"SELECT name FROM {schema}.sqlite_master WHERE type IN ('table', 'view') "
+                                         f"AND name = ? COLLATE NOCASE", (table,)).fetchone()
+                       for schema in self.connections.schemas):
+                raise ValueError(f"Unknown table '{table}'")
+            self.tables.add(table)
+        return table
 
     def human_readable_time(seconds):
         """Convert seconds to a human-readable format (hours, minutes, seconds, milliseconds)."""
@@ -71,7 +104,7 @@ class ImportUtilities:
         with open(csv_file, newline='') as csvfile:
             reader = csv.DictReader(csvfile)
             for row in reader:
-                command = f"UPDATE {table} SET nid = ? WHERE pid = ?"
+                command = f"UPDATE {self.table(table)} SET nid = ? WHERE pid = ?"
                 cursor.execute(command, (row['ID'], row['PID']))
         self.conn.commit()
 
@@ -82,7 +115,7 @@ class ImportUtilities:
         with open(csv_file, newline='') as csvfile:
             reader = csv.DictReader(csvfile)
             for row in reader:
-                command = f"UPDATE {table} SET dublin_core = ? WHERE pid = ? and dublin_core is NULL"
+                command = f"UPDATE {self.table(table)} SET dublin_core = ? WHERE pid = ? and dublin_core is NULL"
                 cursor.execute(command, (row['dublin_core'], row['pid']))
         self.conn.commit()
 
@@ -111,37 +144,283 @@ class ImportUtilities:
         encoded = urllib.parse.quote(full, safe='').replace('_', '%5F')
         return f"{subbed}/{encoded}"
 
+    # Loads the namespace hierarchy into an in-memory RepositoryGraph once and reuses it.
+    def get_graph(self, table=None, reload=False):
+        if self.graph is None or reload:
+            import RepositoryGraph as RG
+            table = table or self.namespace
+            self.graph = RG.RepositoryGraph.from_connection(self.conn, self.table(table), self.relationships(table))
+        return self.graph
+
+    # Side tables hold the rows of each object that do not fit one column of the namespace table: its relationships,
+    # content models, datastreams and search text.  Each has create_X_table, an accessor that backfills an existing
+    # harvest on first use, set_X for one object and build_X_table for the backfill.  The cursor given to create_X_table
+    # and set_X may belong to another database, such as a harvest shard, so only tables created through self.conn are
+    # recorded in self.tables.
+    def add_side_table(self, name, cursor):
+        if cursor.connection is self.conn:
+            self.tables.add(name)
+        return name
+
+    # Returns the side table of table with the given suffix, calling build(table) if it does not exist yet.
+    def side_table(self, table, suffix, build):
+        name = f"{self.table(table)}{suffix}"
+        if name not in self.tables:
+            try:
+                self.table(name)
+            except ValueError:
+                build(table)
+        return name
+
+    # Replaces the rows of one object in a side table.
+    def replace_side_rows(self, table, suffix, pid_column, pid, columns, rows, cursor=None):
+        cursor = cursor or self.conn.cursor()
+        name = f"{self.table(table, must_exist=False)}{suffix}"
+        cursor.execute(f"DELETE FROM {name} WHERE {pid_column} = ?", (pid,))
+        cursor.executemany(f"INSERT OR IGNORE INTO {name} ({', '.join(columns)}) "
+                           f"VALUES ({', '.join('?' * len(columns))})", rows)
+
+    # Creates the (child_pid, predicate, parent_pid, ordinal) edge table for a namespace table.
+    def create_relationships_table(self, table, cursor=None):
+        relationships = f"{self.table(table, must_exist=False)}_relationships"
+        cursor = cursor or self.conn.cursor()
+        cursor.execute(f"""
+            CREATE TABLE if not exists {relationships}(
+            child_pid TEXT,
+            predicate TEXT,
+            parent_pid TEXT,
+            ordinal INTEGER,
+            PRIMARY KEY (child_pid, predicate, parent_pid)
+            )""")
+        cursor.execute(f"CREATE INDEX if not exists {relationships}_parent ON {relationships}(parent_pid, predicate)")
+        return self.add_side_table(relationships, cursor)
+
+    # Returns the edge table for table, building it from the namespace table columns if it does not exist yet.
+    def relationships(self, table):
+        return self.side_table(table, '_relationships', self.build_relationships_table)
+
+    # Replaces the stored edges of one object.  edges are (predicate, parent_pid, ordinal) from FWorker.
+    def set_relationships(self, table, pid, edges, cursor=None):
+        self.replace_side_rows(table, '_relationships', 'child_pid', pid,
+                               ('child_pid', 'predicate', 'parent_pid', 'ordinal'),
+                               [(pid, predicate, parent, ordinal) for predicate, parent, ordinal in edges
+                                if predicate in self.edge_predicates], cursor)
+
+    # Backfills the edge table from the '|' joined relationship columns of an existing harvest.
+    # The columns do not record whether membership came from isMemberOf or isMemberOfCollection;
+    # backfilled membership is stored as isMemberOfCollection.
+    @timeit
+    def build_relationships_table(self, table):
+        relationships = self.create_relationships_table(table)
+        cursor = self.conn.cursor()
+        columns = {'collection_pid': 'isMemberOfCollection', 'page_of': 'isPageOf',
+                   'constituent_of': 'isConstituentOf'}
+        rows = cursor.execute(f"SELECT pid, collection_pid, page_of, constituent_of FROM {self.table(table)}").fetchall()
+        for row in rows:
+            edges = []
+            for column, predicate in columns.items():
+                for ordinal, parent in enumerate(value for value in (row[column] or '').split('|') if value):
+                    edges.append((row['pid'], predicate, parent, ordinal))
+            cursor.executemany(f"INSERT OR IGNORE INTO {relationships} VALUES (?, ?, ?, ?)", edges)
+        self.conn.commit()
+
+    # Creates the one row per model per object content model table for a namespace table.
+    def create_content_models_table(self, table, cursor=None):
+        content_models = f"{self.table(table, must_exist=False)}_content_models"
+        cursor = cursor or self.conn.cursor()
+        cursor.execute(f"""
+            CREATE TABLE if not exists {content_models}(
+            pid TEXT,
+            content_model TEXT,
+            PRIMARY KEY (pid, content_model)
+            )""")
+        cursor.execute(f"CREATE INDEX if not exists {content_models}_model ON {content_models}(content_model, pid)")
+        return self.add_side_table(content_models, cursor)
+
+    # Returns the content model table for table, building it from the content_model column if it does not exist yet.
+    def content_models(self, table):
+        return self.side_table(table, '_content_models', self.build_content_models_table)
+
+    # Replaces the stored content models of one object.
+    def set_content_models(self, table, pid, models, cursor=None):
+        self.replace_side_rows(table, '_content_models', 'pid', pid, ('pid', 'content_model'),
+                               [(pid, model) for model in models], cursor)
+
+    # Backfills the content model table from the '|' joined content_model column of an existing harvest.
+    @timeit
+    def build_content_models_table(self, table):
+        content_models = self.create_content_models_table(table)
+        cursor = self.conn.cursor()
+        rows = cursor.execute(f"SELECT pid, content_model FROM {self.table(table)}").fetchall()
+        cursor.executemany(f"INSERT OR IGNORE INTO {content_models} (pid, content_model) VALUES (?, ?)",
+                           [(row['pid'], model) for row in rows
+                            for model in (row['content_model'] or '').split('|') if model])
+        self.conn.commit()
+
+    # Creates the one row per datastream table for a namespace table, recording what staging would copy.
+    def create_datastreams_table(self, table, cursor=None):
+        datastreams = f"{self.table(table, must_exist=False)}_datastreams"
+        cursor = cursor or self.conn.cursor()
+        cursor.execute(f"""
+            CREATE TABLE if not exists {datastreams}(
+            pid TEXT,
+            dsid TEXT,
+            mimetype TEXT,
+            control_group TEXT,
+            location TEXT,
+            size INTEGER,
+            digest TEXT,
+            inline INTEGER,
+            PRIMARY KEY (pid, dsid)
+            )""")
+        cursor.execute(f"CREATE INDEX if not exists {datastreams}_dsid ON {datastreams}(dsid, pid)")
+        return self.add_side_table(datastreams, cursor)
+
+    # Returns the datastream table for table, building it from the objectStore if it does not exist yet.
+    # A merge or an older harvest can leave the table empty while the namespace table has rows; every object
+    # has datastreams, so that is also backfilled.
+    def datastreams(self, table):
+        datastreams = self.side_table(table, '_datastreams', self.build_datastreams_table)
+        if (self.conn.execute(f"SELECT 1 FROM {datastreams} LIMIT 1").fetchone() is None
+                and self.conn.execute(f"SELECT 1 FROM {self.table(table)} LIMIT 1").fetchone() is not None):
+            self.build_datastreams_table(table)
+        return datastreams
+
+    # Replaces the stored datastreams of one object.  records come from FWorker.get_datastream_records.
+    def set_datastreams(self, table, pid, records, cursor=None):
+        self.replace_side_rows(table, '_datastreams', 'pid', pid,
+                               ('pid', 'dsid', 'mimetype', 'control_group', 'location', 'size', 'digest', 'inline'),
+                               [(pid, *record) for record in records], cursor)
+
+    # Backfills the datastream table of an existing harvest.  The columns of the namespace table do not hold
+    # datastream metadata, so every object is parsed once, without its inline binary content.
+    @timeit
+    def build_datastreams_table(self, table):
+        import FoxmlWorker as FW
+        datastreams = self.create_datastreams_table(table)
+        cursor = self.conn.cursor()
+        for row in self.conn.execute(f"SELECT pid FROM {self.table(table)}").fetchall():
+            try:
+                fw = FW.FWorker(f"{self.objectStore}/{self.dereference(row['pid'])}", skip_binary=True)
+            except (ValueError, RuntimeError) as e:
+                print(f"Skipping {row['pid']}: {e}")
+                continue
+            self.set_datastreams(table, row['pid'], fw.get_datastream_records(), cursor)
+        self.conn.commit()
+        return datastreams
+
+    # Creates the optional FTS5 full text index over pid, title and the text of DC and MODS.
+    # Returns None if SQLite lacks FTS5.
+    def create_search_table(self, table, cursor=None):
+        search = f"{self.table(table, must_exist=False)}_search"
+        cursor = cursor or self.conn.cursor()
+        try:
+            cursor.execute(f"""
+                CREATE VIRTUAL TABLE if not exists {search} USING fts5(
+                pid, title, dublin_core, mods, tokenize = 'unicode61 remove_diacritics 2'
+                )""")
+        except sqlite3.OperationalError as e:
+            print(f"Search index not available: {e}")
+            return None
+        return self.add_side_table(search, cursor)
+
+    # Returns the search table for table, building it from the stored DC and MODS if it does not exist yet.
+    def search_table(self, table):
+        return self.side_table(table, '_search', self.build_search_table)
+
+    # Element text of an XML record, so markup and namespaces are not indexed.
+    def xml_text(self, xml):
+        if not xml:
+            return ''
+        import lxml.etree as ET
+        try:
+            root = ET.fromstring(xml.encode('utf-8'))
+        except ET.XMLSyntaxError:
+            return xml
+        return ' '.join(text.strip() for text in root.itertext() if text.strip())
+
+    # FTS5 can only find a row quickly by rowid, so each pid is indexed under a rowid derived from the pid.
+    def search_rowid(self, pid):
+        return int.from_bytes(hashlib.sha256(pid.encode('utf-8')).digest()[:8], 'big') >> 1
+
+    # Replaces the indexed text of one object.
+    def set_search_row(self, table, row, cursor=None):
+        cursor = cursor or self.conn.cursor()
+        search = f"{self.table(table, must_exist=False)}_search"
+        rowid = self.search_rowid(row['pid'])
+        cursor.execute(f"DELETE FROM {search} WHERE rowid = ?", (rowid,))
+        cursor.execute(f"INSERT INTO {search} (rowid, pid, title, dublin_core, mods) VALUES (?, ?, ?, ?, ?)",
+                       (rowid, row['pid'], row['title'] or '', self.xml_text(row['dublin_core']),
+                        self.xml_text(row['mods'])))
+
+    # Backfills the search table from an existing harvest.
+    @timeit
+    def build_search_table(self, table):
+        search = self.create_search_table(table)
+        if search is None:
+            raise ValueError("This SQLite build has no FTS5 support")
+        cursor = self.conn.cursor()
+        cursor.execute(f"DELETE FROM {search}")
+        for row in self.conn.execute(f"SELECT pid, title, dublin_core, mods FROM {self.table(table)}").fetchall():
+            self.set_search_row(table, row, cursor)
+        self.conn.commit()
+
+    # Full text search over pid, title, DC and MODS.  query uses FTS5 syntax, e.g. 'title:hockey AND 1952'
+    # or 'pid:batch*'.  Returns (pid, content_model) rows, best matches first.
+    def search(self, table, query, content_model=None, limit=None):
+        search = self.search_table(table)
+        command = f"""
+            SELECT n.pid, n.content_model FROM {search}
+            JOIN {self.table(table)} AS n ON n.pid = {search}.pid
+            WHERE {search} MATCH ?
+        """
+        parameters = [query]
+        if content_model is not None:
+            command += f" AND n.pid IN (SELECT pid FROM {self.content_models(table)} WHERE content_model = ?)"
+            parameters.append(content_model)
+        command += f" ORDER BY bm25({search})"
+        if limit is not None:
+            command += " LIMIT ?"
+            parameters.append(limit)
+        return self.connections.reader().execute(command, parameters).fetchall()
+
+    # Gets pid and content model of the direct members of a collection, over every membership predicate.
+    def get_members(self, table, collection, predicates=None):
+        predicates = predicates or self.member_predicates
+        placeholders = ', '.join('?' for _ in predicates)
+        command = f"""
+            SELECT DISTINCT n.pid, n.content_model FROM {self.relationships(table)} AS r
+            JOIN {self.table(table)} AS n ON n.pid = r.child_pid
+            WHERE r.parent_pid = ? AND r.predicate IN ({placeholders})
+        """
+        return self.conn.execute(command, (collection, *predicates)).fetchall()
+
     # Gets all pages from book
     def get_pages(self, table, book_pid):
         cursor = self.conn.cursor()
-        command = f"SELECT PID from {table} where page_of = '{book_pid}'"
+        command = f"SELECT child_pid from {self.relationships(table)} where parent_pid = ? AND predicate = ?"
         pids = []
-        for row in cursor.execute(command):
+        for row in cursor.execute(command, (book_pid, 'isPageOf')):
             pids.append(row[0])
         return pids
 
     # Gets all books in the repository.
     def get_books(self, table, collection):
-        cursor = self.conn.cursor()
-        command = f"SELECT PID, CONTENT_MODEL from {table} where collection_pid = '{collection}' AND CONTENT_MODEL = 'islandora:bookCModel' "
-        pids = []
-        for row in cursor.execute(command):
-            pids.append(row[0])
-        return pids
+        return [row[0] for row in self.get_members(table, collection) if row[1] == 'islandora:bookCModel']
 
     # Processes CSV returned from direct objectStore harvest
     def process_full_institution(self, csv_file, table):
         cursor = self.conn.cursor()
         cursor.execute(f"""
-            CREATE TABLE if not exists {table}(
+            CREATE TABLE if not exists {self.table(table, must_exist=False)}(
             title TEXT,
             pid TEXT PRIMARY KEY,
             nid TEXT,
             content_model TEXT,
             collection_pid TEXT,
             page_of TEXT,
-            sequence TEXT,
-            constituent_of TEXT
+            sequence INTEGER,
+            constituent_of TEXT,
             dublin_core TEXT,
             mods TEXT
             )""")
@@ -149,9 +428,10 @@ class ImportUtilities:
         with open(csv_file, newline='') as csvfile:
             reader = csv.DictReader(csvfile)
             for row in reader:
+                row['sequence'] = self.sequence_number(row.get('sequence'))
                 try:
                     command = f"""
-                        INSERT OR REPLACE INTO {table} 
+                        INSERT OR REPLACE INTO {self.table(table)} 
                         (title, pid, content_model, collection_pid, page_of, sequence, constituent_of) 
                         VALUES (:title, :pid, :content_model, :collection_pid, :page_of, :sequence, :constituent_of)
                     """
@@ -162,7 +442,120 @@ class ImportUtilities:
                     print(f"Parameters: {row}")
         self.conn.commit()
 
-    # Get all collection contents within namespace
+    # isSequenceNumber is stored as an integer so pages sort numerically; anything else is stored as NULL.
+    def sequence_number(self, value):
+        value = str(value or '').split('|')[0].strip()
+        return int(value) if value.isdigit() else None
+
+    def has_integer_sequence(self, table, cursor=None):
+        cursor = cursor or self.conn.cursor()
+        table = self.table(table, must_exist=False)
+        columns = {row[1]: row[2] for row in cursor.execute(f"PRAGMA table_info({table})")}
+        return columns.get('sequence', '').upper() == 'INTEGER'
+
+    # Databases harvested before sequence was an INTEGER column hold it as text, which sorts "10" before "2".
+    # The column is converted in place; non-numeric values become NULL.  Harvesting into the table upgrades it,
+    # as does 'Migrate.py upgrade'.  With a cursor the caller commits.
+    def upgrade_sequence_column(self, table, cursor=None):
+        if cursor is None:
+            with self.connections.write_lock:
+                self.upgrade_sequence_column(table, self.conn.cursor())
+                self.conn.commit()
+            return
+        if self.has_integer_sequence(table, cursor):
+            return
+        table = self.table(table, must_exist=False)
+        print(f"Converting {table}.sequence to INTEGER")
+        cursor.execute(f"ALTER TABLE {table} RENAME COLUMN sequence TO sequence_text")
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN sequence INTEGER")
+        cursor.execute(f"""
+            UPDATE {table} SET sequence = CAST(trim(sequence_text) AS INTEGER)
+            WHERE trim(sequence_text) != '' AND trim(sequence_text) NOT GLOB '*[^0-9]*'
+        """)
+        cursor.execute(f"ALTER TABLE {table} DROP COLUMN sequence_text")
+
+    # Every page of every book or newspaper issue in a collection, ordered by parent then page sequence.
+    # Membership is followed through sub-collections and newspapers, so a newspaper collection yields all issue pages.
+    def get_collection_pages(self, table, collection):
+        if not self.has_integer_sequence(table):
+            raise ValueError(f"{table}.sequence is stored as text and would sort pages wrongly; "
+                             f"run 'Migrate.py upgrade {table}' first")
+        relationships = self.relationships(table)
+        member_in = ', '.join('?' for _ in self.member_predicates)
+        command = f"""
+            WITH RECURSIVE members(pid) AS (
+                SELECT child_pid FROM {relationships} WHERE parent_pid = ? AND predicate IN ({member_in})
+                UNION
+                SELECT r.child_pid FROM {relationships} AS r
+                JOIN members AS m ON r.parent_pid = m.pid AND r.predicate IN ({member_in})
+            )
+            SELECT r.parent_pid AS parent_pid, parent.nid AS parent_nid, page.pid AS pid, page.nid AS nid,
+                page.title AS title, page.sequence AS sequence
+            FROM members
+            JOIN {relationships} AS r ON r.parent_pid = members.pid AND r.predicate = ?
+            JOIN {self.table(table)} AS page ON page.pid = r.child_pid
+            JOIN {self.table(table)} AS parent ON parent.pid = r.parent_pid
+            ORDER BY r.parent_pid, page.sequence IS NULL, page.sequence, page.pid
+        """
+        parameters = (collection, *self.member_predicates, *self.member_predicates, 'isPageOf')
+        cursor = self.connections.reader().cursor()
+        try:
+            yield from cursor.execute(command, parameters)
+        finally:
+            cursor.close()
+
+    # (content_model, dsid) pairs of a stream map, as a VALUES table for the staging plan queries.
+    def stream_map_values(self, stream_map):
+        pairs = [(model, dsid) for model, dsids in stream_map.items() for dsid in dsids]
+        if not pairs:
+            raise ValueError("The stream map names no datastreams")
+        values = ', '.join('(?, ?)' for _ in pairs)
+        return f"plan(content_model, dsid) AS (VALUES {values})", [value for pair in pairs for value in pair]
+
+    # Yields the copy tasks of a staging plan: every datastream the stream map lists for an object's content model,
+    # for ingested objects that actually have it as managed or inline content.  An object with several listed
+    # models gets each datastream once.  Tasks come in pid order, so the inline tasks of one object are adjacent.
+    def get_staging_tasks(self, table, stream_map):
+        plan, parameters = self.stream_map_values(stream_map)
+        command = f"""
+            WITH {plan}
+            SELECT d.pid AS pid, n.nid AS nid, min(m.content_model) AS content_model, d.dsid AS dsid,
+                d.mimetype AS mimetype, d.location AS location, d.size AS size, d.digest AS digest, d.inline AS inline
+            FROM plan
+            JOIN {self.content_models(table)} AS m ON m.content_model = plan.content_model
+            JOIN {self.table(table)} AS n ON n.pid = m.pid
+            JOIN {self.datastreams(table)} AS d ON d.pid = m.pid AND d.dsid = plan.dsid
+            WHERE n.nid IS NOT NULL AND n.nid != '' AND (d.location IS NOT NULL OR d.inline = 1)
+            GROUP BY d.pid, d.dsid
+            ORDER BY d.pid, d.dsid
+        """
+        cursor = self.connections.reader().cursor()
+        try:
+            yield from cursor.execute(command, parameters)
+        finally:
+            cursor.close()
+
+    # Totals of a staging plan per content model: objects, tasks, bytes, tasks without a recorded size,
+    # and listed datastreams the objects do not have.  A datastream listed for two models of one object counts twice.
+    def get_staging_totals(self, table, stream_map):
+        plan, parameters = self.stream_map_values(stream_map)
+        command = f"""
+            WITH {plan}
+            SELECT plan.content_model AS content_model, count(DISTINCT n.pid) AS objects, count(d.dsid) AS tasks,
+                coalesce(sum(d.size), 0) AS bytes, sum(d.dsid IS NOT NULL AND d.size IS NULL) AS unsized,
+                sum(d.dsid IS NULL) AS missing
+            FROM plan
+            JOIN {self.content_models(table)} AS m ON m.content_model = plan.content_model
+            JOIN {self.table(table)} AS n ON n.pid = m.pid
+            LEFT JOIN {self.datastreams(table)} AS d ON d.pid = m.pid AND d.dsid = plan.dsid
+                AND (d.location IS NOT NULL OR d.inline = 1)
+            WHERE n.nid IS NOT NULL AND n.nid != ''
+            GROUP BY plan.content_model
+            ORDER BY plan.content_model
+        """
+        return self.connections.reader().execute(command, parameters).fetchall()
+
+    # Get all collection contents within namespace, written to filename as a PidSet file.
     def get_collection_content_pids(self, table, collection, filename):
         collection_pids = [collection]
         parent_types = ['islandora:bookCModel', 'islandora:collectionCModel', ]
@@ -170,23 +563,24 @@ class ImportUtilities:
         cursor = self.conn.cursor()
         while collection_pids:
             collection = collection_pids.pop()
-            command = f"SELECT * from {table} where collection_pid = '{collection}'"
-            for row in cursor.execute(command):
+            for row in self.get_members(table, collection):
                 if row['content_model'] in parent_types:
                     collection_pids.append(row['pid'])
                 pids.append(row['pid'])
-        with open(filename, 'wb') as file:
-            pickle.dump(pids, file)
+        count = PS.write_pid_set(filename, pids)
+        print(f"Wrote {count} pids to {filename}")
 
     # Utility function to prepare database selections for workbench
     def get_worksheet_details(self, content_model=None):
-        command = f"Select * from {self.namespace}"
+        command = f"Select * from {self.table(self.namespace)}"
+        parameters = ()
         if content_model is not None:
-            command = f"{command} where content_model = '{content_model}'"
+            command = f"{command} where content_model = ?"
+            parameters = (content_model,)
 
         cursor = self.conn.cursor()
         details = []
-        for row in cursor.execute(command):
+        for row in cursor.execute(command, parameters):
             keys = row.keys()
             line = {}
             for key in keys:
@@ -195,6 +589,17 @@ class ImportUtilities:
             details.append(cleaned_line)
         return details
 
+    # Writes worksheet rows as dependency-level batch files so each level can be ingested in parallel.
+    # Rows are leveled by their field_pid within the namespace hierarchy and written parents first.
+    @timeit
+    def write_worksheet_batches(self, output_file, fieldnames, rows, max_rows=None, max_bytes=None):
+        import WorksheetBatches as WB
+        levels = self.get_graph().get_levels(row['field_pid'] for row in rows)
+        with WB.BatchWriter(output_file, fieldnames, max_rows, max_bytes) as batches:
+            for row in sorted(rows, key=lambda row: levels.get(row['field_pid'], 0)):
+                batches.writerow(levels.get(row['field_pid'], 0), row)
+        return batches.files
+
     # Map D7 values to D10
     def map_worksheet_values(self, line):
         map = {
@@ -233,8 +638,7 @@ class ImportUtilities:
         cleaned_line = {}
         for key, value in line.items():
             if key in map:
-                if value is None:
-                    value = ''
+                value = '' if value is None else str(value)
                 if value.strip():
                     cleaned_line[map[key]] = value
         if 'field_model' in cleaned_line:
@@ -244,28 +648,19 @@ class ImportUtilities:
 
     # Get all content models from map
     def get_collection_pid_model_map(self, table, collection):
-        cursor = self.conn.cursor()
-        command = f"SELECT PID, CONTENT_MODEL from {table} where collection_pid = '{collection}'"
         map = {}
-        for row in cursor.execute(command):
+        for row in self.get_members(table, collection):
             map[row[0]] = row[1]
         return map
 
     def get_subcollections(self, table, collection):
-        cursor = self.conn.cursor()
-        command = f"SELECT PID, CONTENT_MODEL from {table} where collection_pid = '{collection}' AND CONTENT_MODEL = 'islandora:collectionCModel' "
-        pids = []
-        for row in cursor.execute(command):
-            pids.append(row[0])
-        return pids
+        return [row[0] for row in self.get_members(table, collection) if row[1] == 'islandora:collectionCModel']
 
     def get_collection_recursive_pid_model_map(self, table, collection_pid):
         descendants = {}
-        cursor = self.conn.cursor()
-        command = f"select PID, CONTENT_MODEL from {table} where COLLECTION_PID = '{collection_pid}'"
         child_collections = []
         books = []
-        for row in cursor.execute(command):
+        for row in self.get_members(table, collection_pid):
             if row['content_model'] in ['islandora:collectionCModel', 'islandora:bookCModel']:
                 child_collections.append(row['PID'])
                 descendants[row['PID']] = row['content_model']
@@ -273,8 +668,7 @@ class ImportUtilities:
                 descendants[row['PID']] = row['content_model']
         while child_collections:
             child_collection = child_collections.pop(0)
-            command = f"select PID, CONTENT_MODEL from {table} where COLLECTION_PID = '{child_collection}' or page_of = '{child_collection}' "
-            for row in cursor.execute(command):
+            for row in self.get_members(table, child_collection, (*self.member_predicates, 'isPageOf')):
                 if row['content_model'] in ['islandora:collectionCModel', 'islandora:bookCModel']:
                     child_collections.append(row['PID'])
                     descendants[row['PID']] = row['content_model']
@@ -284,33 +678,39 @@ class ImportUtilities:
 
     def extract_from_mods(self, pid):
         cursor = self.conn.cursor()
-        command = f"SELECT MODS from MSVU where PID = '{pid}'"
-        result = cursor.execute(command).fetchone()
-        mods = result['MODS']
-        if mods is not None and len(mods) < 10:
+        command = f"SELECT MODS from {self.table(self.namespace)} where PID = ?"
+        result = cursor.execute(command, (pid,)).fetchone()
+        mods = result['MODS'] if result is not None else None
+        if mods is None or len(mods) < 10:
             return {}
+        if self.mt is None:
+            # Loaded on first use; ModsTransformer pulls in xmltodict and edtf_validate.
+            import ModsTransformer as MT
+            self.mt = MT.ModsTransformer()
         return self.mt.extract_from_mods(mods)
 
     # Get node_id associated with pid.
     def get_nid_from_pid(self, table, pid):
         cursor = self.conn.cursor()
-        command = f"SELECT nid from {table} where PID = '{pid}'"
-        result = cursor.execute(command).fetchone()
+        command = f"SELECT nid from {self.table(table)} where PID = ?"
+        result = cursor.execute(command, (pid,)).fetchone()
         return result['nid'] if result is not None else ''
 
     # Get pid associated with nid.
     def get_pid_from_nid(self, table: object, nid: object) -> str | Any:
         cursor = self.conn.cursor()
-        command = f"SELECT pid from {table} where nid = '{nid}'"
-        result = cursor.execute(command).fetchone()
+        command = f"SELECT pid from {self.table(table)} where nid = ?"
+        result = cursor.execute(command, (nid,)).fetchone()
         return result['pid'] if result is not None else ''
 
-    # Get all pids with content model.
+    # Get all pids with content model.  content_model may be a single model or a list of models.
     def get_pids_by_content_model(self, table, content_model):
+        content_models = [content_model] if isinstance(content_model, str) else list(content_model)
+        placeholders = ', '.join('?' for _ in content_models)
         cursor = self.conn.cursor()  # Manually create a cursor
         try:
-            command = f"SELECT PID FROM {table} WHERE CONTENT_MODEL LIKE ?"
-            cursor.execute(command, (f"%{content_model}%",))
+            command = f"SELECT DISTINCT pid FROM {self.content_models(table)} WHERE content_model IN ({placeholders})"
+            cursor.execute(command, content_models)
             return [row[0] for row in cursor.fetchall()]  # Extracts all PID values
         finally:
             cursor.close()  # Ensures the cursor is always closed
@@ -318,9 +718,10 @@ class ImportUtilities:
     # Get key - value pairs from stored dublin core.
     def get_dc_values(self, pid):
         cursor = self.conn.cursor()
-        result = cursor.execute(f"select dublin_core from {self.namespace} where pid = '{pid}'")
+        result = cursor.execute(f"select dublin_core from {self.table(self.namespace)} where pid = ?", (pid,))
         dc = result.fetchone()['dublin_core']
         if dc:
+            import lxml.etree as ET
             root = ET.fromstring(dc)
             namespaces = {
                 'dc': 'http://purl.org/dc/elements/1.1/'
@@ -334,11 +735,11 @@ class ImportUtilities:
 
     def add_title(self):
         cursor = self.conn.cursor()
-        command = f"SELECT PID, title from {self.namespace} where title is null"
+        command = f"SELECT PID, title from {self.table(self.namespace)} where title is null"
         pids = cursor.execute(command).fetchall()
         for pid in pids:
             dc = self.get_dc_values(pid['PID'])
-            query = f"UPDATE {self.namespace} SET title = ? WHERE pid = ?"
+            query = f"UPDATE {self.table(self.namespace)} SET title = ? WHERE pid = ?"
             values = (dc.get('title'), pid['PID'])
             cursor.execute(query, values)
         self.conn.commit()
@@ -346,11 +747,13 @@ class ImportUtilities:
     def get_relationships(self, table):
         cursor = self.conn.cursor()
         cursor.execute(f"""
-            SELECT child.nid, parent.nid, child.sequence, child.title
-            FROM {table} as child
-            JOIN {table} as parent
-            ON child.collection_pid = parent.pid
-        """)
+            SELECT child.nid, group_concat(parent.nid, '|'), child.sequence, child.title
+            FROM {self.relationships(table)} as r
+            JOIN {self.table(table)} as child ON child.pid = r.child_pid
+            JOIN {self.table(table)} as parent ON parent.pid = r.parent_pid
+            WHERE r.predicate IN (?, ?)
+            GROUP BY child.pid
+        """, self.member_predicates)
         rows = cursor.fetchall()
         relationships = [
             {'node_id': r[0], 'member_of': r[1], 'weight': r[2] if r[2] is not None else '', 'title': r[3]}
@@ -360,26 +763,22 @@ class ImportUtilities:
 
     import csv
 
-    def make_media_add_worksheet(self, input_file, output_file):
-        with open(output_file, mode="w", newline="") as out_file:
-            writer = csv.DictWriter(out_file, fieldnames=['node_id', 'file', 'media_use_tid'])
-            writer.writeheader()
-            with open(input_file, "r") as file:
-                for line in file:
-                    row = {
-                        'node_id': line.split('_')[0],
-                        'file': line.strip()
-                    }
-                    if 'MODS' in line:
-                        row['media_use_tid'] = 57
-                    if 'PBCORE' in line:
-                        row['media_use_tid'] = 56
-                    writer.writerow(row)
+    # Builds the media worksheet from a listing of already staged {nid}_{DSID}.{ext} files.
+    # Staging can write this worksheet directly; see ImportServerUtilities.open_media_worksheet.
+    def make_media_add_worksheet(self, input_file, output_file, media_use=None):
+        import MediaWorksheet as MW
+        with MW.MediaWorksheet(output_file, media_use) as worksheet, open(input_file, "r") as file:
+            for line in file:
+                name = line.strip()
+                if not name:
+                    continue
+                nid, _, datastream = name.rsplit('.', 1)[0].partition('_')
+                worksheet.add(nid, datastream, name)
 
     def make_archive_url_worksheet(self, output_file):
         cursor = self.conn.cursor()
-        statement = f"select pid, nid from {self.namespace} where pid like '%batch%'"
-        cursor.execute(statement)
+        statement = f"select pid, nid from {self.table(self.namespace)} where pid like ?"
+        cursor.execute(statement, ('%batch%',))
         results = cursor.fetchall()
         with open(output_file, mode="w", newline="") as out_file:
             writer = csv.DictWriter(out_file, fieldnames=['node_id', 'field_archival_alias'])
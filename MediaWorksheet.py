@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import csv
+import os
+
+"""
+MediaWorksheet.py writes the Workbench add_media worksheet while files are being staged,
+so no listing of the staging directory is needed afterwards.
+"""
+
+# Drupal media_use taxonomy term ids for staged datastreams.  Datastreams not listed get no media use.
+MEDIA_USE = {
+    'MODS': 57,
+    'PBCORE': 56,
+}
+
+
+class MediaWorksheet:
+    fieldnames = ['node_id', 'file', 'media_use_tid']
+
+    # With rows_per_file the worksheet rotates to {stem}_{n:03d}{ext} every rows_per_file rows.
+    def __init__(self, output_file, media_use=None, rows_per_file=None):
+        self.stem, self.ext = os.path.splitext(output_file)
+        self.ext = self.ext or '.csv'
+        self.output_file = output_file
+        self.media_use = MEDIA_USE if media_use is None else media_use
+        self.rows_per_file = rows_per_file
+        self.files = []
+        self.file = None
+        self.writer = None
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open_file(self):
+        if self.file is not None:
+            self.file.close()
+        if self.rows_per_file:
+            file_name = f"{self.stem}_{len(self.files) + 1:03d}{self.ext}"
+        else:
+            file_name = self.output_file
+        self.file = open(file_name, 'w', newline='', encoding='utf-8')
+        self.writer = csv.DictWriter(self.file, fieldnames=self.fieldnames)
+        self.writer.writeheader()
+        self.files.append(file_name)
+        self.rows = 0
+
+    # Adds the staged file for one datastream of a node.  file is written as given.
+    def add(self, nid, datastream, file):
+        if self.file is None or (self.rows_per_file and self.rows >= self.rows_per_file):
+            self.open_file()
+        self.writer.writerow({
+            'node_id': nid,
+            'file': file,
+            'media_use_tid': self.media_use.get(datastream, ''),
+        })
+        self.rows += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return self.files
+
+
+# Parses DSID=TID pairs, as given on the command line, into a media use mapping.
+def parse_media_use(pairs):
+    media_use = dict(MEDIA_USE)
+    for pair in pairs or []:
+        datastream, _, tid = pair.partition('=')
+        if not datastream or not tid.isdigit():
+            raise ValueError(f"Media use '{pair}' is not DSID=TID")
+        media_use[datastream] = int(tid)
+    return media_use
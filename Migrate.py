@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sys
+
+"""
+Migrate.py is the single command-line entry point for the migration tools.
+Each subcommand imports only the modules it needs, so short invocations stay cheap.
+"""
+
+
+def scan(args):
+    import ImportServerUtilities as SU
+    su = SU.ImportServerUtilities(args.namespace)
+    hash_dirs = shard_hash_dirs(args)
+    namespaces = set(args.scan_namespace or [args.namespace])
+    pids = su.iter_pids_from_objectstore(namespaces, hash_dirs=hash_dirs, content_models=args.content_model)
+    count = 0
+    output = open(args.output, 'w') if args.output else None
+    try:
+        for pid in pids:
+            if output is not None:
+                output.write(f"{pid}\n")
+            count += 1
+    finally:
+        if output is not None:
+            output.close()
+    print(f"Total number of PIDs found: {count}")
+
+
+def harvest(args):
+    import MigrationPrep as MP
+    mp = MP.MigrationPrepper(args.namespace)
+    mp.search_index = args.search_index
+    if args.route:
+        if args.shard is not None:
+            raise SystemExit("--route cannot be combined with --shard")
+        mp.harvest_namespaces([args.namespace, *(args.collections or [])], args.route == 'database')
+    elif args.shard is not None:
+        shard_db = mp.harvest_shard(args.shard, args.shards, args.collections, shard_db=args.shard_db)
+        print(f"Shard written to {shard_db}")
+    else:
+        mp.get_structure(args.collections)
+
+
+def merge_shards(args):
+    import MigrationPrep as MP
+    mp = MP.MigrationPrepper(args.namespace)
+    conflicts = mp.merge_shards(args.shard_files)
+    if conflicts:
+        print(f"{len(conflicts)} conflicting pids left unmerged")
+        return 1
+
+
+def extract(args):
+    import FoxmlExtractors as FE
+    import ImportServerUtilities as SU
+    su = SU.ImportServerUtilities(args.namespace)
+    extractors = []
+    if args.dc:
+        extractors.append(FE.DCExtractor())
+    if args.inline:
+        extractors.append(FE.InlineDatastreamExtractor())
+    if args.dsids:
+        extractors.append(FE.DsidCountExtractor())
+    for dsid in args.stage_inline or []:
+        extractors.append(FE.InlineStreamStager(dsid))
+    if args.media_worksheet:
+        import MediaWorksheet as MW
+        su.media_use = MW.parse_media_use(args.media_use)
+        su.open_media_worksheet(args.media_worksheet, args.media_rows)
+    try:
+        if not extractors:
+            su.extract_all()
+        else:
+            su.run_extractors(extractors)
+    finally:
+        su.close_media_worksheet()
+
+
+def add_mods(args):
+    import ImportServerUtilities as SU
+    su = SU.ImportServerUtilities(args.namespace)
+    su.add_mods_to_database(args.namespace)
+
+
+def add_dc(args):
+    import ImportUtilities as IU
+    iu = IU.ImportUtilities(args.namespace)
+    iu.add_dc_to_database(args.namespace, args.csv_file)
+
+
+def upgrade(args):
+    import ImportUtilities as IU
+    iu = IU.ImportUtilities(args.namespace)
+    iu.upgrade_sequence_column(iu.table(args.namespace))
+
+
+def nid_backfill(args):
+    import ImportUtilities as IU
+    iu = IU.ImportUtilities(args.namespace)
+    iu.add_node_ids(args.namespace, args.csv_file)
+
+
+def stage(args):
+    import ImportServerUtilities as SU
+    import MediaWorksheet as MW
+    su = SU.ImportServerUtilities(args.namespace)
+    if args.staging_dir:
+        su.staging_dir = args.staging_dir
+    su.media_use = MW.parse_media_use(args.media_use)
+    if args.pids_file:
+        with open(args.pids_file) as f:
+            pids = [line.strip() for line in f if line.strip()]
+        su.stage_files_from_list(args.datastreams, pids, dedupe=args.dedupe, journal=args.journal,
+                                 media_worksheet=args.media_worksheet, media_rows=args.media_rows)
+    else:
+        su.stage_files(content_model=args.content_model, datastreams=args.datastreams, dedupe=args.dedupe,
+                       journal=args.journal, media_worksheet=args.media_worksheet, media_rows=args.media_rows)
+
+
+def stage_plan(args):
+    import ImportProcessor as IP
+    import MediaWorksheet as MW
+    ip = IP.ImportProcessor(args.namespace)
+    if args.summary:
+        ip.plan_staging(args.content_model)
+        return
+    if args.staging_dir:
+        ip.ms.staging_dir = args.staging_dir
+    ip.ms.media_use = MW.parse_media_use(args.media_use)
+    ip.stage_by_content_model(args.content_model, dedupe=args.dedupe, journal=args.journal,
+                              media_worksheet=args.media_worksheet, media_rows=args.media_rows)
+
+
+# Throttle limits travel in the environment, so worker processes share them.
+def set_throttle(args):
+    import Throttle as TH
+    settings = {'UPEI_THROTTLE_BYTES': args.throttle_bytes, 'UPEI_THROTTLE_FILES': args.throttle_files,
+                'UPEI_THROTTLE_SCHEDULE': args.throttle_schedule}
+    for name, value in settings.items():
+        if value is not None:
+            os.environ[name] = value
+    TH.reset()
+    # Parses the settings now, so a bad value fails before any work starts.
+    TH.get_throttle()
+
+
+def throttle_status(args):
+    import Throttle as TH
+    totals = TH.status(args.state)
+    if not totals:
+        print("No throttled work recorded")
+    for kind, (consumed, throttled) in sorted(totals.items()):
+        amount = f"{consumed / 1048576:.1f} MiB" if kind == 'bytes' else f"{int(consumed)} files"
+        print(f"{kind}: {amount}, {throttled:.1f}s throttled")
+
+
+def add_media_arguments(parser):
+    parser.add_argument("--media-worksheet", help="Write a media worksheet row for every staged file to this CSV.")
+    parser.add_argument("--media-rows", type=int, help="Start a new media worksheet file every this many rows.")
+    parser.add_argument("--media-use", nargs='+', metavar="DSID=TID",
+                        help="media_use_tid for a datastream, in addition to MODS=57 and PBCORE=56.")
+
+
+def full_text(args):
+    import ImportServerUtilities as SU
+    su = SU.ImportServerUtilities(args.namespace)
+    if args.staging_dir:
+        su.staging_dir = args.staging_dir
+    if args.media_worksheet:
+        import MediaWorksheet as MW
+        su.media_use = MW.parse_media_use(args.media_use)
+        su.open_media_worksheet(args.media_worksheet, args.media_rows)
+    try:
+        su.aggregate_full_text(args.collection, args.datastreams, args.workers)
+    finally:
+        su.close_media_worksheet()
+
+
+def staging_progress(args):
+    import StagingJournal as SJ
+    journal = SJ.StagingJournal(f"{args.namespace}_staging_journal.db")
+    for status, totals in sorted(journal.progress().items()):
+        print(f"{status}: {totals['tasks']} tasks, {totals['bytes']} bytes")
+    if args.failures:
+        for failure in journal.get_failures():
+            print(f"{failure['pid']} {failure['dsid']}: {failure['error']}")
+
+
+def stage_bio(args):
+    import ImportServerUtilities as SU
+    su = SU.ImportServerUtilities(args.namespace)
+    su.stage_bio()
+
+
+def worksheet(args):
+    if args.kind in ('media', 'restricted') and not args.input:
+        raise SystemExit(f"worksheet {args.kind} needs --input")
+    if args.kind == 'pages' and not args.collection:
+        raise SystemExit("worksheet pages needs --collection")
+    if args.kind == 'initial':
+        import MigrationPrep as MP
+        MP.MigrationPrepper(args.namespace).prepare_initial_ingest_worksheet(args.output, args.max_rows,
+                                                                            args.max_bytes)
+    elif args.kind == 'collection':
+        import ImportProcessor as IP
+        IP.ImportProcessor(args.namespace).prepare_collection_worksheet(args.output)
+    elif args.kind == 'pages':
+        import ImportProcessor as IP
+        IP.ImportProcessor(args.namespace).prepare_page_worksheet(args.collection, args.output)
+    elif args.kind == 'relationship':
+        import ImportProcessor as IP
+        IP.ImportProcessor(args.namespace).prepare_relationship_worksheet(args.output)
+    elif args.kind == 'media':
+        import ImportUtilities as IU
+        IU.ImportUtilities(args.namespace).make_media_add_worksheet(args.input, args.output)
+    elif args.kind == 'restricted':
+        import ImportUtilities as IU
+        IU.ImportUtilities(args.namespace).prepare_restricted_worksheet(args.input, args.output)
+    elif args.kind == 'archive-url':
+        import ImportUtilities as IU
+        IU.ImportUtilities(args.namespace).make_archive_url_worksheet(args.output)
+
+
+def file_size(args):
+    import GetFileSize as GF
+    total_size = GF.total_size_of_files(args.pattern, args.directory)
+    print(f"Total size of all files containing '{args.pattern}' in '{args.directory}': {total_size}")
+
+
+def schedule(args):
+    import MigrationScheduler as MS
+    scheduler = MS.MigrationScheduler(args.database, args.work_dir, args.workers)
+    try:
+        for namespace in args.namespaces:
+            scheduler.add_namespace(namespace)
+        if args.status:
+            for task in sorted(scheduler.get_tasks().values(), key=lambda task: (task['namespace'], task['position'])):
+                print(f"{task['task_id']}: {task['status']}")
+            return
+        print(scheduler.run(retry_failed=args.retry_failed))
+    finally:
+        scheduler.close()
+
+
+def search(args):
+    import ImportUtilities as IU
+    iu = IU.ImportUtilities(args.namespace)
+    if args.rebuild:
+        iu.build_search_table(args.namespace)
+    for row in iu.search(args.namespace, args.query, args.content_model, args.limit):
+        print(f"{row['pid']},{row['content_model']}")
+
+
+def snapshot(args):
+    import HarvestDiff as HD
+    count = HD.write_snapshot(args.database or f"{args.namespace}.db", args.namespace, args.output)
+    print(f"Wrote {count} row hashes to {args.output}")
+
+
+def delta(args):
+    import MigrationPrep as MP
+    MP.MigrationPrepper(args.namespace).write_delta_worksheets(args.old, args.output_prefix, args.new)
+
+
+def pid_set_convert(args):
+    import PidSet as PS
+    count = PS.convert(args.input, args.output)
+    print(f"Wrote {count} pids to {args.output}")
+
+
+def pid_set_diff(args):
+    import PidSet as PS
+    with PS.PidSet(args.left) as left, PS.PidSet(args.right) as right:
+        for label, first, second, output in (('left', left, right, args.only_left),
+                                             ('right', right, left, args.only_right)):
+            pids = PS.difference(first, second)
+            if output:
+                count = PS.write_sorted(output, pids)
+            else:
+                count = 0
+                for pid in pids:
+                    if count < args.show:
+                        print(f"{'<' if label == 'left' else '>'} {pid}")
+                    count += 1
+            print(f"Only in {label}: {count}")
+        print(f"In both: {sum(1 for _ in PS.intersection(left, right))}")
+
+
+def pid_set_contains(args):
+    import PidSet as PS
+    with PS.PidSet(args.pid_set) as pid_set:
+        for pid in args.pids:
+            print(f"{pid} {'yes' if pid in pid_set else 'no'}")
+
+
+def shard_hash_dirs(args):
+    if args.shard is None:
+        return args.hash_dirs
+    import MigrationPrep as MP
+    return MP.MigrationPrepper.get_shard_hash_dirs(args.shard, args.shards)
+
+
+def add_shard_arguments(parser):
+    parser.add_argument("--shard", type=int, help="Index of the objectStore shard to process.")
+    parser.add_argument("--shards", type=int, default=1, help="Total number of shards.")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="UPEI Fedora 3 to Islandora 2 migration tools.")
+    parser.add_argument("--snapshot", choices=['all', 'structure'],
+                        help="Load namespace databases into memory first: all tables, or only the structural ones.")
+    parser.add_argument("--flush", action='store_true',
+                        help="Write changes made to the in-memory snapshot back to the database file at the end.")
+    parser.add_argument("--throttle-bytes", help="Limit Fedora storage reads to this many bytes per second, e.g. 20M.")
+    parser.add_argument("--throttle-files", help="Limit Fedora storage reads to this many files per second.")
+    parser.add_argument("--throttle-schedule",
+                        help="HH:MM-HH:MM=BYTES/FILES windows that replace the limits, e.g. '22:00-06:00=off'.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('scan', help="List pids found in the objectStore.")
+    p.add_argument("namespace")
+    p.add_argument("--scan-namespace", nargs='+',
+                   help="Pid namespaces to scan for, if different from the database namespace; '*' for all.")
+    p.add_argument("--content-model", nargs='+', help="Only list objects whose FOXML mentions one of these models.")
+    p.add_argument("--hash-dirs", nargs='+', help="Only scan these '##' objectStore directories.")
+    add_shard_arguments(p)
+    p.add_argument("--output", help="Write pids to this file, one per line.")
+    p.set_defaults(func=scan)
+
+    p = subparsers.add_parser('harvest', help="Harvest object structure into the namespace database.")
+    p.add_argument("namespace")
+    p.add_argument("--collections", nargs='+', help="Additional namespaces to harvest.")
+    p.add_argument("--route", choices=['table', 'database'],
+                   help="Harvest each namespace into its own table, or its own {namespace}.db, from one scan.")
+    p.add_argument("--search-index", action='store_true', help="Also build the FTS5 search index while harvesting.")
+    add_shard_arguments(p)
+    p.add_argument("--shard-db", help="Shard database file to write.")
+    p.set_defaults(func=harvest)
+
+    p = subparsers.add_parser('merge-shards', help="Merge shard databases into the namespace database.")
+    p.add_argument("namespace")
+    p.add_argument("shard_files", nargs='+')
+    p.set_defaults(func=merge_shards)
+
+    p = subparsers.add_parser('extract', help="Run FOXML extractors in one pass; all of them by default.")
+    p.add_argument("namespace")
+    p.add_argument("--dc", action='store_true', help="Write the Dublin Core CSV.")
+    p.add_argument("--inline", action='store_true', help="Write the inline datastreams CSV.")
+    p.add_argument("--dsids", action='store_true', help="Write datastream id counts.")
+    p.add_argument("--stage-inline", nargs='+', choices=['PBCORE', 'MusicXML', 'MODS'],
+                   help="Stage these inline xml datastreams.")
+    add_media_arguments(p)
+    p.set_defaults(func=extract)
+
+    p = subparsers.add_parser('add-mods', help="Load MODS records into the namespace database.")
+    p.add_argument("namespace")
+    p.set_defaults(func=add_mods)
+
+    p = subparsers.add_parser('add-dc', help="Load Dublin Core from a CSV into the namespace database.")
+    p.add_argument("namespace")
+    p.add_argument("csv_file")
+    p.set_defaults(func=add_dc)
+
+    p = subparsers.add_parser('nid-backfill', help="Load node ids from a Workbench CSV into the namespace database.")
+    p.add_argument("namespace")
+    p.add_argument("csv_file")
+    p.set_defaults(func=nid_backfill)
+
+    p = subparsers.add_parser('upgrade', help="Convert a database harvested by an older version to the current schema.")
+    p.add_argument("namespace")
+    p.set_defaults(func=upgrade)
+
+    p = subparsers.add_parser('stage', help="Copy datastreams into the staging directory.")
+    p.add_argument("namespace")
+    p.add_argument("--content-model", nargs='+', help="Stage objects with any of these content models.")
+    p.add_argument("--datastreams", nargs='+', default=['OBJ'])
+    p.add_argument("--pids-file", help="Stage only the pids listed in this file.")
+    p.add_argument("--staging-dir")
+    p.add_argument("--dedupe", action='store_true', help="Hardlink datastreams whose content is already staged.")
+    p.add_argument("--journal", action='store_true',
+                   help="Record tasks in {namespace}_staging_journal.db and skip those already staged.")
+    add_media_arguments(p)
+    p.set_defaults(func=stage)
+
+    p = subparsers.add_parser('stage-plan', help="Stage the datastreams the stream map lists for each content model.")
+    p.add_argument("namespace")
+    p.add_argument("--content-model", nargs='+', help="Plan only these content models of the stream map.")
+    p.add_argument("--summary", action='store_true', help="Print the totals per content model without staging.")
+    p.add_argument("--staging-dir")
+    p.add_argument("--dedupe", action='store_true', help="Hardlink datastreams whose content is already staged.")
+    p.add_argument("--journal", action='store_true',
+                   help="Record tasks in {namespace}_staging_journal.db and skip those already staged.")
+    add_media_arguments(p)
+    p.set_defaults(func=stage_plan)
+
+    p = subparsers.add_parser('full-text', help="Write one full text file per book or issue from its page text.")
+    p.add_argument("namespace")
+    p.add_argument("collection")
+    p.add_argument("--datastreams", nargs='+', default=['FULL_TEXT', 'OCR'],
+                   help="Page datastreams to use, in order of preference.")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--staging-dir")
+    add_media_arguments(p)
+    p.set_defaults(func=full_text)
+
+    p = subparsers.add_parser('staging-progress', help="Summarize the staging journal.")
+    p.add_argument("namespace")
+    p.add_argument("--failures", action='store_true', help="List failed tasks.")
+    p.set_defaults(func=staging_progress)
+
+    p = subparsers.add_parser('stage-bio', help="Write BIO datastreams of entities to a CSV.")
+    p.add_argument("namespace")
+    p.set_defaults(func=stage_bio)
+
+    p = subparsers.add_parser('worksheet', help="Write a Workbench worksheet.")
+    p.add_argument("kind", choices=['initial', 'collection', 'pages', 'relationship', 'media', 'restricted',
+                                    'archive-url'])
+    p.add_argument("namespace")
+    p.add_argument("output")
+    p.add_argument("--input", help="Input listing for the media and restricted worksheets.")
+    p.add_argument("--collection", help="Collection pid for the pages worksheet.")
+    p.add_argument("--max-rows", type=int, help="Split the initial worksheet into dependency-level batches of at most this many rows.")
+    p.add_argument("--max-bytes", type=int, help="Split the initial worksheet into dependency-level batches of at most this many bytes.")
+    p.set_defaults(func=worksheet)
+
+    p = subparsers.add_parser('schedule', help="Run the migration pipeline of several namespaces concurrently.")
+    p.add_argument("namespaces", nargs='+')
+    p.add_argument("--workers", type=int, default=2, help="Tasks run at the same time.")
+    p.add_argument("--work-dir", default='worksheets', help="Directory for worksheets and the Workbench output.")
+    p.add_argument("--database", default='migration_scheduler.db', help="Task state database.")
+    p.add_argument("--retry-failed", action='store_true', help="Run failed tasks again.")
+    p.add_argument("--status", action='store_true', help="Show task states without running anything.")
+    p.set_defaults(func=schedule)
+
+    p = subparsers.add_parser('search', help="Full text search of titles, DC and MODS; prints pid,content_model.")
+    p.add_argument("namespace")
+    p.add_argument("query", help="FTS5 query, e.g. 'title:hockey AND 1952' or 'pid:batch*'.")
+    p.add_argument("--content-model", help="Only return objects with this content model.")
+    p.add_argument("--limit", type=int)
+    p.add_argument("--rebuild", action='store_true', help="Rebuild the search index from the database first.")
+    p.set_defaults(func=search)
+
+    p = subparsers.add_parser('snapshot', help="Write the pid-sorted row hashes of a harvest.")
+    p.add_argument("namespace")
+    p.add_argument("output")
+    p.add_argument("--database", help="Namespace database to snapshot, if not {namespace}.db.")
+    p.set_defaults(func=snapshot)
+
+    p = subparsers.add_parser('delta', help="Write worksheets for objects added, changed or removed since a harvest.")
+    p.add_argument("namespace")
+    p.add_argument("old", help="Earlier namespace database or snapshot.")
+    p.add_argument("output_prefix")
+    p.add_argument("--new", help="Current namespace database, if not {namespace}.db.")
+    p.set_defaults(func=delta)
+
+    p = subparsers.add_parser('pid-set', help="Build, compare and query PID set files.")
+    pid_set_commands = p.add_subparsers(dest='pid_set_command', required=True)
+    q = pid_set_commands.add_parser('convert', help="Build a PID set from a text listing or a pickled list.")
+    q.add_argument("input")
+    q.add_argument("output")
+    q.set_defaults(func=pid_set_convert)
+    q = pid_set_commands.add_parser('diff', help="Compare two PID sets, such as harvested and ingested pids.")
+    q.add_argument("left")
+    q.add_argument("right")
+    q.add_argument("--only-left", help="Write pids only in left to this PID set file.")
+    q.add_argument("--only-right", help="Write pids only in right to this PID set file.")
+    q.add_argument("--show", type=int, default=20, help="Number of differing pids to print per side.")
+    q.set_defaults(func=pid_set_diff)
+    q = pid_set_commands.add_parser('contains', help="Check pids against a PID set.")
+    q.add_argument("pid_set")
+    q.add_argument("pids", nargs='+')
+    q.set_defaults(func=pid_set_contains)
+
+    p = subparsers.add_parser('throttle-status', help="Show work and throttled time of all throttled workers.")
+    p.add_argument("--state", help="Shared throttle database, default UPEI_THROTTLE_STATE or throttle.db.")
+    p.set_defaults(func=throttle_status)
+
+    p = subparsers.add_parser('file-size', help="Total size of files matching a pattern.")
+    p.add_argument("--pattern", required=True)
+    p.add_argument("--directory", required=True)
+    p.set_defaults(func=file_size)
+
+    return parser
+
+
+def main(argv=None):
+    import ConnectionManager as CM
+    args = build_parser().parse_args(argv)
+    # Set on every call, since the scheduler runs several commands in one worker process.
+    CM.use_snapshots(args.snapshot)
+    set_throttle(args)
+    result = args.func(args)
+    if args.snapshot and args.flush:
+        CM.flush_snapshots()
+    return result
+
+
+if __name__ == '__main__':
+    sys.exit(main())
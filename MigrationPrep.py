@@ -3,8 +3,9 @@
 import ImportUtilities as IU
 import ImportServerUtilities as SU
 import sqlite3
-import FoxmlWorker as FW
-from pathlib import Path
+import ConnectionManager as CM
+import HarvestDiff as HD
+import Profiling as PR
 import csv
 
 
@@ -13,124 +14,322 @@ class MigrationPrepper:
         self.namespace = namespace
         self.objectStore = '/usr/local/fedora/data/objectStore'
         self.datastreamStore = '/usr/local/fedora/data/datastreamStore'
-        self.conn = sqlite3.connect(f'{namespace}.db')
-        self.conn.row_factory = sqlite3.Row
-        self.su = SU.ImportServerUtilities(namespace)
-        self.iu = IU.ImportUtilities(self.namespace)
+        self.connections = CM.get_manager(namespace)
+        self.conn = self.connections.writer()
+        self.su = SU.ImportServerUtilities(namespace, self.connections)
+        self.iu = IU.ImportUtilities(self.namespace, self.connections)
+        # Per-pid tables written alongside the namespace table: (table suffix, pid column).
+        self.child_tables = [('_relationships', 'child_pid'), ('_content_models', 'pid'), ('_datastreams', 'pid'),
+                             ('_search', 'pid')]
+        # Also index title, DC and MODS in the {namespace}_search FTS5 table while harvesting.
+        self.search_index = False
 
 
-    # Harvests the structure of all objects in a namespace and persists them to a database.
-    def get_structure(self, collections=None):
-        namespaces = [self.namespace]
-        if collections:
-            namespaces.extend(collections)
-        cursor = self.conn.cursor()
+    # Creates the namespace table used by the structure harvest.
+    def create_structure_table(self, cursor, table):
+        table = self.iu.table(table, must_exist=False)
         cursor.execute(f"""
-            CREATE TABLE if not exists {self.namespace}(
+            CREATE TABLE if not exists {table}(
             title TEXT,
             pid TEXT PRIMARY KEY,
             nid TEXT,
             content_model TEXT,
             collection_pid TEXT,
             page_of TEXT,
-            sequence TEXT,
+            sequence INTEGER,
             constituent_of TEXT,
             dublin_core TEXT,
-            mods TEXT
+            mods TEXT,
+            row_hash TEXT
             )""")
-        self.conn.commit()
-        for namespace in namespaces:
-            pids = self.su.get_pids_from_objectstore(namespace)
-            for pid in pids:
-                foxml_file = self.iu.dereference(pid)
-                foxml = f"{self.objectStore}/{foxml_file}"
+        # Tables harvested before row_hash existed get the column; their rows are hashed when diffed.
+        columns = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+        if 'row_hash' not in columns:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN row_hash TEXT")
+        self.iu.upgrade_sequence_column(table, cursor)
+        self.iu.create_relationships_table(table, cursor)
+        self.iu.create_content_models_table(table, cursor)
+        self.iu.create_datastreams_table(table, cursor)
+        if self.search_index and self.iu.create_search_table(table, cursor) is None:
+            self.search_index = False
+
+    # Builds the database row for a single pid, or None if the object is missing or inactive.
+    def build_structure_row(self, pid):
+        import FoxmlWorker as FW
+        import Throttle as TH
+        foxml_file = self.iu.dereference(pid)
+        foxml = f"{self.objectStore}/{foxml_file}"
+        fw = None
+        if foxml:
+            try:
+                fw = FW.FWorker(foxml, skip_binary=True)
+            except (ValueError, RuntimeError) as e:
+                print(f"Skipping {foxml}: {e}")
                 fw = None
-                if foxml:
-                    try:
-                        fw = FW.FWorker(foxml)
-                    except (ValueError, RuntimeError) as e:
-                        print(f"Skipping {foxml}: {e}")
-                        fw = None
-                if (fw):
-                    if fw.get_state() != 'Active':
-                        continue
-                    relations = fw.get_rels_ext_values()
-                    mapping = fw.get_file_data()
-                    mods_info = mapping.get('MODS')
-                    if mods_info:
-                        mods_path = f"{self.datastreamStore}/{self.iu.dereference(mods_info['filename'])}"
-                        mods_xml = Path(mods_path).read_text()
-                    else:
-                        mods_xml = fw.get_inline_mods()
-                    if mods_xml:
-                        mods_xml = mods_xml.replace("'", "''")
-                    else:
-                        mods_xml = ""
-                    row = {
-                        "title": fw.get_label(),
-                        "pid": pid,
-                        "nid": '',
-                        "content_model": '',
-                        "collection_pid": "",
-                        "page_of": "",
-                        "sequence": "",
-                        "constituent_of": "",
-                        "dublin_core": fw.get_dc(),
-                        "mods": mods_xml
-                    }
-
-                    for relation, value in relations.items():
-                        if relation in self.iu.rels_map:
-                            row[self.iu.rels_map[relation]] = value
-                    try:
-                        command = f"""
-                            INSERT OR REPLACE INTO {self.namespace} 
-                            (title, pid, nid, content_model, collection_pid, page_of, sequence, constituent_of, dublin_core, mods) 
-                            VALUES (:title, :pid, :nid,:content_model, :collection_pid, :page_of, :sequence, :constituent_of, :dublin_core, :mods)
-                        """
-                        cursor.execute(command, row)
-                    except sqlite3.Error as e:
-                        print(f"SQLite Error: {e}")
-                        print(f"SQL Command: {command}")
-                        print(f"Parameters: {row}")
-
-                else:
-                    print(f"FoXML file for {pid} is missing")
+        if not fw:
+            print(f"FoXML file for {pid} is missing")
+            return None
+        if fw.get_state() != 'Active':
+            return None
+        relations = fw.get_rels_ext_values()
+        mapping = fw.get_file_data()
+        mods_info = mapping.get('MODS')
+        if mods_info:
+            mods_path = f"{self.datastreamStore}/{self.iu.dereference(mods_info['filename'])}"
+            mods_xml = TH.read_text(mods_path)
+        else:
+            mods_xml = fw.get_inline_mods()
+        if not mods_xml:
+            mods_xml = ""
+        row = {
+            "title": fw.get_label(),
+            "pid": pid,
+            "nid": '',
+            "content_model": '',
+            "collection_pid": "",
+            "page_of": "",
+            "sequence": "",
+            "constituent_of": "",
+            "dublin_core": fw.get_dc(),
+            "mods": mods_xml
+        }
+        for relation, value in relations.items():
+            if relation in self.iu.rels_map:
+                row[self.iu.rels_map[relation]] = value
+        row['sequence'] = self.iu.sequence_number(row['sequence'])
+        row['row_hash'] = HD.row_hash(row)
+        row['edges'] = fw.get_rels_ext_edges()
+        row['datastreams'] = fw.get_datastream_records()
+        return row
+
+    # Writes a harvested row, its relationship edges and its datastreams to table, the namespace table by default.
+    # A re-harvested object keeps the node id it already has.
+    def insert_structure_row(self, cursor, row, table=None):
+        # The table may be in a shard database, so only the identifier is checked.
+        table = self.iu.table(table or self.namespace, must_exist=False)
+        edges = row.pop('edges', [])
+        datastreams = row.pop('datastreams', [])
+        try:
+            command = f"""
+                INSERT INTO {table} 
+                (title, pid, nid, content_model, collection_pid, page_of, sequence, constituent_of, dublin_core, mods,
+                row_hash) 
+                VALUES (:title, :pid, :nid,:content_model, :collection_pid, :page_of, :sequence, :constituent_of, :dublin_core, :mods,
+                :row_hash)
+                ON CONFLICT(pid) DO UPDATE SET title = excluded.title, content_model = excluded.content_model,
+                collection_pid = excluded.collection_pid, page_of = excluded.page_of, sequence = excluded.sequence,
+                constituent_of = excluded.constituent_of, dublin_core = excluded.dublin_core, mods = excluded.mods,
+                row_hash = excluded.row_hash
+            """
+            cursor.execute(command, row)
+            self.iu.set_relationships(table, row['pid'], edges, cursor)
+            models = [parent for predicate, parent, _ in edges if predicate == 'hasModel']
+            self.iu.set_content_models(table, row['pid'], models, cursor)
+            self.iu.set_datastreams(table, row['pid'], datastreams, cursor)
+            if self.search_index:
+                self.iu.set_search_row(table, row, cursor)
+        except sqlite3.Error as e:
+            print(f"SQLite Error: {e}")
+            print(f"SQL Command: {command}")
+            print(f"Parameters: {row}")
+
+    # Harvests the structure of all objects in a namespace and persists them to a database.
+    # hash_dirs limits the scan to those objectStore directories and shard_db writes to a separate shard file.
+    # PIDs of all namespaces are harvested from one scan as it yields them; a collections entry of '*' harvests
+    # every namespace.
+    @PR.profiled()
+    def get_structure(self, collections=None, hash_dirs=None, shard_db=None):
+        namespaces = {self.namespace}
+        if collections:
+            namespaces.update(collections)
+        conn = self.conn
+        if shard_db:
+            shard_connections = CM.ConnectionManager(database=shard_db)
+            conn = shard_connections.writer()
+        cursor = conn.cursor()
+        self.create_structure_table(cursor, self.namespace)
+        conn.commit()
+        count = 0
+        for pid in self.su.iter_pids_from_objectstore(namespaces, hash_dirs=hash_dirs):
+            count += 1
+            row = self.build_structure_row(pid)
+            if row is None:
+                continue
+            self.insert_structure_row(cursor, row)
+        print(f"Total number of PIDs found: {count}")
+        conn.commit()
+        if shard_db:
+            shard_connections.close()
+
+    # Harvests several namespaces in one objectStore scan, routing each object by its pid prefix.
+    # Each namespace gets its own table in this database, or with separate_databases its own {namespace}.db.
+    # A namespace of '*' harvests every namespace the scan finds; one whose name cannot be a table is skipped.
+    @PR.profiled()
+    @IU.ImportUtilities.timeit
+    def harvest_namespaces(self, namespaces, separate_databases=False, hash_dirs=None):
+        named = [namespace for namespace in namespaces if namespace != '*']
+        targets = {namespace: self.open_harvest_target(namespace, separate_databases) for namespace in named}
+        counts = dict.fromkeys(named, 0)
+        scanned = None if '*' in namespaces else set(named)
+        for pid in self.su.iter_pids_from_objectstore(scanned, hash_dirs=hash_dirs):
+            namespace = pid.split(':', 1)[0]
+            if namespace not in targets:
+                try:
+                    targets[namespace] = self.open_harvest_target(namespace, separate_databases)
+                    counts[namespace] = 0
+                except ValueError as e:
+                    print(f"Skipping namespace {namespace}: {e}")
+                    targets[namespace] = None
+            if targets[namespace] is None:
+                continue
+            row = self.build_structure_row(pid)
+            if row is None:
+                continue
+            self.insert_structure_row(targets[namespace][1], row, namespace)
+            counts[namespace] += 1
+        for target in targets.values():
+            if target is not None:
+                target[0].commit()
+        for namespace, count in counts.items():
+            print(f"Harvested {count} objects into {namespace}")
+        return counts
+
+    # Creates the structure table of one routed namespace and returns its (connection, cursor).
+    def open_harvest_target(self, namespace, separate_databases):
+        connections = CM.get_manager(namespace) if separate_databases else self.connections
+        conn = connections.writer()
+        cursor = conn.cursor()
+        self.create_structure_table(cursor, namespace)
+        conn.commit()
+        return conn, cursor
+
+    # Returns the objectStore hash directories belonging to one shard of shard_count.
+    @staticmethod
+    def get_shard_hash_dirs(shard, shard_count):
+        if not 0 <= shard < shard_count <= 256:
+            raise ValueError(f"Invalid shard {shard} of {shard_count}")
+        return [f"{i:02x}" for i in range(256) if i % shard_count == shard]
+
+    # Harvests one shard of the objectStore into its own database file and returns its path.
+    @PR.profiled()
+    def harvest_shard(self, shard, shard_count, collections=None, shard_db=None):
+        if shard_db is None:
+            shard_db = f"{self.namespace}_shard_{shard:03d}_of_{shard_count:03d}.db"
+        hash_dirs = self.get_shard_hash_dirs(shard, shard_count)
+        self.get_structure(collections, hash_dirs=hash_dirs, shard_db=shard_db)
+        return shard_db
+
+    # Merges shard databases into the namespace database.
+    # A pid already present with different values is reported as a conflict and left untouched.
+    def merge_shards(self, shard_files):
+        cursor = self.conn.cursor()
+        self.create_structure_table(cursor, self.namespace)
         self.conn.commit()
+        table = self.iu.table(self.namespace)
+        columns = ['title', 'content_model', 'collection_pid', 'page_of', 'sequence', 'constituent_of',
+                   'dublin_core', 'mods']
+        differs = ' OR '.join(f"s.{column} IS NOT m.{column}" for column in columns)
+        conflicts = []
+        for shard_file in shard_files:
+            cursor.execute("ATTACH DATABASE ? AS shard", (shard_file,))
+            try:
+                command = f"""
+                    SELECT s.pid FROM shard.{table} AS s
+                    JOIN main.{table} AS m ON m.pid = s.pid
+                    WHERE {differs}
+                """
+                shard_conflicts = [row[0] for row in cursor.execute(command)]
+                for pid in shard_conflicts:
+                    print(f"Conflict on {pid} in {shard_file}")
+                conflicts.extend(shard_conflicts)
+                # Child rows go first, for pids the namespace table does not hold yet.
+                for suffix, pid_column in self.child_tables:
+                    child_table = self.iu.table(f"{table}{suffix}", must_exist=False)
+                    exists = cursor.execute("SELECT 1 FROM shard.sqlite_master WHERE type = 'table' AND name = ?",
+                                            (child_table,)).fetchone()
+                    if exists and suffix == '_search':
+                        exists = self.iu.create_search_table(self.namespace) is not None
+                    if exists:
+                        # Search rows keep their pid derived rowid.
+                        columns = 'rowid, *' if suffix == '_search' else '*'
+                        target = f"{child_table} (rowid, pid, title, dublin_core, mods)" if suffix == '_search' \
+                            else child_table
+                        cursor.execute(f"""
+                            INSERT OR IGNORE INTO main.{target} SELECT {columns} FROM shard.{child_table}
+                            WHERE {pid_column} NOT IN (SELECT pid FROM main.{table})
+                        """)
+                cursor.execute(f"""
+                    INSERT OR IGNORE INTO main.{table}
+                    (title, pid, nid, content_model, collection_pid, page_of, sequence, constituent_of, dublin_core, mods,
+                    row_hash)
+                    SELECT title, pid, nid, content_model, collection_pid, page_of, sequence, constituent_of,
+                    dublin_core, mods, row_hash FROM shard.{table}
+                """)
+                print(f"Merged {cursor.rowcount} rows from {shard_file}")
+                self.conn.commit()
+            finally:
+                cursor.execute("DETACH DATABASE shard")
+        return conflicts
+
+    # Compares an earlier harvest (database or snapshot file) with this one and writes delta worksheets:
+    # {output_prefix}_added.csv to create, _changed.csv to update and _removed.csv listing node ids to delete.
+    @PR.profiled()
+    @IU.ImportUtilities.timeit
+    def write_delta_worksheets(self, old, output_prefix, new=None):
+        new = new or self.connections.database
+        if new == self.connections.database:
+            iu = self.iu
+        else:
+            iu = IU.ImportUtilities(self.namespace, CM.get_manager(database=new))
+        worksheets = HD.DeltaWorksheets(iu, self.namespace, output_prefix, old)
+        try:
+            for status, pid in HD.diff(HD.iter_hashes(old, self.namespace), HD.iter_hashes(new, self.namespace)):
+                worksheets.add(status, pid)
+        finally:
+            counts = worksheets.close()
+        print(f"Added {counts['added']}, changed {counts['changed']}, removed {counts['removed']}")
+        return counts
 
     # Prepares CSV for initial workbench ingest.
-    def prepare_initial_ingest_worksheet(self, output_file):
+    # With max_rows or max_bytes the worksheet is split into dependency-level batches instead of one file.
+    @PR.profiled()
+    def prepare_initial_ingest_worksheet(self, output_file, max_rows=None, max_bytes=None):
         details = self.get_worksheet_details()
         if not details:
             print("No worksheet details found.")
             return
 
+        fieldnames = ['id', 'title', 'field_pid', 'field_model', 'field_weight', 'file']
+        rows = []
+        id = 1
+        for detail in details:
+            if not detail or not detail.get('field_pid'):  # Add safer checks for detail and field_pid
+                continue
+
+            # Prepare the row for CSV
+            rows.append({
+                'id': id,
+                'title': detail['title'],
+                'field_pid': detail['field_pid'],
+                'field_model': detail.get('field_model', 'Unknown'),
+                'field_weight': detail.get('field_weight', ''),
+            })
+            id += 1
+
+        if max_rows or max_bytes:
+            return self.iu.write_worksheet_batches(output_file, fieldnames, rows, max_rows, max_bytes)
         with open(output_file, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=['id', 'title', 'field_pid', 'field_model', 'field_weight', 'file'])
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
             writer.writeheader()
-            id = 1
-
-            for detail in details:
-                if not detail or not detail.get('field_pid'):  # Add safer checks for detail and field_pid
-                    continue
-
-                # Prepare the row for CSV
-                row = {
-                    'id': id,
-                    'title': detail['title'],
-                    'field_pid': detail['field_pid'],
-                    'field_model': detail.get('field_model', 'Unknown'),
-                    'field_weight': detail.get('field_weight', ''),
-                }
+            for row in rows:
                 try:
                     writer.writerow(row)
                 except Exception as e:
                     print(f"Failed to write row {row}: {e}")
-                id += 1
 
     # Utility function to prepare database selections for workbench,
     def get_worksheet_details(self):
-        command = f"Select * from {self.namespace}"
+        command = f"Select * from {self.iu.table(self.namespace)}"
         cursor = self.conn.cursor()
         details = []
         for row in cursor.execute(command):
@@ -181,8 +380,7 @@ class MigrationPrepper:
         cleaned_line = {}
         for key, value in line.items():
             if key in map:
-                if value is None:
-                    value = ''
+                value = '' if value is None else str(value)
                 if value.strip():
                     cleaned_line[map[key]] = value
         if 'field_model' in cleaned_line:
@@ -190,16 +388,17 @@ class MigrationPrepper:
         return cleaned_line
 
     def update_structure(self, collections=None):
+        import FoxmlWorker as FW
         namespaces = [self.namespace]
         for namespace in namespaces:
-            pids = self.su.get_pids_from_objectstore(namespace)
+            pids = self.su.iter_pids_from_objectstore(namespace)
             for pid in pids:
                 foxml_file = self.iu.dereference(pid)
                 foxml = f"{self.objectStore}/{foxml_file}"
                 fw = None
                 if foxml:
                     try:
-                        fw = FW.FWorker(foxml)
+                        fw = FW.FWorker(foxml, skip_binary=True)
                     except (ValueError, RuntimeError) as e:
                         print(f"Skipping {foxml}: {e}")
                         fw = None
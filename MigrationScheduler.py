@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import ConnectionManager as CM
+
+"""
+MigrationScheduler.py runs the migration steps of several namespaces as one dependency graph.
+Each step of each namespace is a task whose state is kept in SQLite, so independent namespaces overlap
+(staging one while another is still harvesting) and a rerun resumes after the last completed task.
+The unit is the namespace rather than the collection, because each namespace has its own database and
+worksheets; a collection that needs its own branch is harvested into its own namespace.
+Steps are Migrate.py command lines run in worker processes.  Ingest happens in Workbench, outside this tool;
+its task completes once the Workbench output CSV with node ids is found in the work directory.
+"""
+
+# (step, dependencies, Migrate.py arguments or None for the external ingest, file the external step waits for).
+# harvest stores MODS and DC with the structure, so the manual add-mods and add-dc passes are not steps here.
+PIPELINE = [
+    ('harvest', [], ['harvest', '{ns}'], None),
+    ('worksheet', ['harvest'], ['worksheet', 'initial', '{ns}', '{work}/{ns}_initial.csv'], None),
+    ('ingest', ['worksheet'], None, '{work}/{ns}_ingested.csv'),
+    ('nid-backfill', ['ingest'], ['nid-backfill', '{ns}', '{work}/{ns}_ingested.csv'], None),
+    ('stage', ['nid-backfill'], ['stage', '{ns}', '--journal', '--media-worksheet', '{work}/{ns}_media.csv'], None),
+]
+
+
+# Runs one task in a worker process.  Returns None on success or the error text.
+# Workers are reused, so the task's database connections are rolled back and closed before the next task,
+# as they would be if the task had run in a process of its own.
+def run_task(argv):
+    import Migrate
+    try:
+        Migrate.main(argv)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            return f"exited with {e.code}"
+    except Exception:
+        return traceback.format_exc()
+    finally:
+        CM.close_managers()
+    return None
+
+
+class MigrationScheduler:
+    def __init__(self, database='migration_scheduler.db', work_dir='worksheets', workers=2):
+        self.work_dir = work_dir
+        self.workers = workers
+        self.connections = CM.ConnectionManager(database=database)
+        self.conn = self.connections.writer()
+        self.conn.execute("""
+            CREATE TABLE if not exists scheduler_tasks(
+            task_id TEXT PRIMARY KEY,
+            namespace TEXT,
+            step TEXT,
+            position INTEGER,
+            depends TEXT,
+            argv TEXT,
+            wait_for TEXT,
+            status TEXT,
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            started REAL,
+            finished REAL
+            )""")
+        self.conn.commit()
+
+    # Adds the pipeline of a namespace.  Existing tasks keep their state, so this is safe on every run.
+    def add_namespace(self, namespace):
+        values = {'ns': namespace, 'work': self.work_dir}
+        # Steps no longer in the pipeline are dropped, so no task waits on them.
+        steps = [step for step, _, _, _ in PIPELINE]
+        placeholders = ', '.join('?' for _ in steps)
+        self.conn.execute(f"DELETE FROM scheduler_tasks WHERE namespace = ? AND step NOT IN ({placeholders})",
+                          (namespace, *steps))
+        for position, (step, depends, argv, wait_for) in enumerate(PIPELINE):
+            self.conn.execute("""
+                INSERT INTO scheduler_tasks (task_id, namespace, step, position, depends, argv, wait_for, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 'pending')
+                ON CONFLICT(task_id) DO UPDATE SET depends = excluded.depends, argv = excluded.argv,
+                wait_for = excluded.wait_for, position = excluded.position
+            """, (f"{namespace}:{step}", namespace, step, position,
+                  json.dumps([f"{namespace}:{depend}" for depend in depends]),
+                  json.dumps([arg.format(**values) for arg in argv]) if argv else None,
+                  wait_for.format(**values) if wait_for else None))
+        self.conn.commit()
+
+    # Tasks that were running when the last run died are run again; failed tasks only when asked.
+    def recover(self, retry_failed=False):
+        statuses = ('running', 'failed') if retry_failed else ('running',)
+        placeholders = ', '.join('?' for _ in statuses)
+        self.conn.execute(f"UPDATE scheduler_tasks SET status = 'pending' WHERE status IN ({placeholders})", statuses)
+        self.conn.commit()
+
+    def set_status(self, task_id, status, error=None):
+        now = time.time()
+        if status == 'running':
+            self.conn.execute("""
+                UPDATE scheduler_tasks SET status = ?, attempts = attempts + 1, error = NULL, started = ?
+                WHERE task_id = ?
+            """, (status, now, task_id))
+        else:
+            self.conn.execute("UPDATE scheduler_tasks SET status = ?, error = ?, finished = ? WHERE task_id = ?",
+                              (status, error, now, task_id))
+        self.conn.commit()
+        print(f"{task_id}: {status}" + (f"\n{error}" if error else ''))
+
+    def get_tasks(self):
+        return {row['task_id']: dict(row) for row in self.conn.execute("SELECT * FROM scheduler_tasks")}
+
+    # Tasks whose dependencies are all done.  Later pipeline steps come first, so started namespaces finish sooner.
+    def get_ready(self, running):
+        tasks = self.get_tasks()
+        ready = [task for task in tasks.values()
+                 if task['status'] in ('pending', 'waiting') and task['task_id'] not in running
+                 and all(tasks[depend]['status'] == 'done' for depend in json.loads(task['depends']))]
+        return sorted(ready, key=lambda task: (-task['position'], task['namespace']))
+
+    # Runs every ready task until nothing more can run, then returns task counts per status.
+    def run(self, retry_failed=False):
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.recover(retry_failed)
+        running = {}
+        with ProcessPoolExecutor(self.workers) as pool:
+            while True:
+                for task in self.get_ready(running.values()):
+                    if task['argv'] is None:
+                        # External steps are done once the file they wait for exists.
+                        if os.path.exists(task['wait_for']):
+                            self.set_status(task['task_id'], 'done')
+                        elif task['status'] != 'waiting':
+                            self.set_status(task['task_id'], 'waiting')
+                            print(f"{task['task_id']} waits for {task['wait_for']}")
+                        continue
+                    if len(running) >= self.workers:
+                        continue
+                    self.set_status(task['task_id'], 'running')
+                    running[pool.submit(run_task, json.loads(task['argv']))] = task['task_id']
+                if not running:
+                    # A completed external step can make more tasks ready.
+                    if any(task['argv'] is not None or os.path.exists(task['wait_for'])
+                           for task in self.get_ready(())):
+                        continue
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task_id = running.pop(future)
+                    error = future.result()
+                    self.set_status(task_id, 'failed' if error else 'done', error)
+        return self.progress()
+
+    def progress(self):
+        return {row['status']: row['tasks'] for row in
+                self.conn.execute("SELECT status, count(*) AS tasks FROM scheduler_tasks GROUP BY status")}
+
+    def close(self):
+        self.connections.close()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+import heapq
+import mmap
+import os
+import struct
+
+"""
+PidSet.py stores a set of PIDs as a sorted, prefix-compressed file that is read through mmap.
+
+Entries are grouped in blocks of BLOCK_SIZE.  The first entry of a block is stored whole and every other entry
+as (shared prefix length, suffix), so PIDs of one namespace cost only their differing tail.
+The footer holds the offset of every block, so membership is a binary search over block heads followed by
+a scan of one block, and files are written in one streaming pass.
+
+    data blocks | block offsets (uint64 each) | count, block size, index offset (uint64 each) | MAGIC
+"""
+
+MAGIC = b'PIDSET01'
+BLOCK_SIZE = 16
+FOOTER = struct.Struct('<QQQ')
+
+
+def write_varint(out, value):
+    if value < 0x80:
+        out.append(value)
+        return
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+# Length of the common prefix of two byte strings, by binary search over slice comparisons.
+def shared_prefix(first, second):
+    low, high = 0, min(len(first), len(second))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if first[:middle] == second[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def read_varint(buffer, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+# Writes strictly increasing PIDs to a set file.  Use write_pid_set for unsorted input.
+class PidSetWriter:
+    def __init__(self, path, block_size=BLOCK_SIZE):
+        self.path = path
+        self.block_size = block_size
+        self.file = open(f"{path}.part", 'wb')
+        self.buffer = bytearray()
+        self.offsets = []
+        self.count = 0
+        self.position = 0
+        self.previous = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(f"{self.path}.part")
+
+    def add(self, pid):
+        key = pid.encode('utf-8')
+        if self.previous is not None and key <= self.previous:
+            raise ValueError(f"PIDs must be written in increasing order: '{pid}' follows '{self.previous.decode()}'")
+        if self.count % self.block_size == 0:
+            if len(self.buffer) >= 1048576:
+                self.file.write(self.buffer)
+                self.position += len(self.buffer)
+                self.buffer.clear()
+            self.offsets.append(self.position + len(self.buffer))
+            shared = 0
+        else:
+            shared = shared_prefix(self.previous, key)
+        write_varint(self.buffer, shared)
+        write_varint(self.buffer, len(key) - shared)
+        self.buffer += key[shared:]
+        self.previous = key
+        self.count += 1
+
+    def close(self):
+        self.file.write(self.buffer)
+        index_offset = self.position + len(self.buffer)
+        self.file.write(struct.pack(f'<{len(self.offsets)}Q', *self.offsets))
+        self.file.write(FOOTER.pack(self.count, self.block_size, index_offset))
+        self.file.write(MAGIC)
+        self.file.close()
+        os.replace(f"{self.path}.part", self.path)
+        return self.count
+
+
+# Writes any iterable of PIDs, sorting and removing duplicates first.
+def write_pid_set(path, pids):
+    with PidSetWriter(path) as writer:
+        for pid in sorted(set(pids)):
+            writer.add(pid)
+    return writer.count
+
+
+# Read-only view of a set file.  Supports len(), 'in', iteration in sorted order and the set operations below.
+class PidSet:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < FOOTER.size + len(MAGIC):
+            self.file.close()
+            raise ValueError(f"{path} is not a PID set file")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[-len(MAGIC):] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a PID set file")
+        footer_start = size - len(MAGIC) - FOOTER.size
+        self.count, self.block_size, self.index_offset = FOOTER.unpack_from(self.buffer, footer_start)
+        self.block_count = (footer_start - self.index_offset) // 8
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    def __len__(self):
+        return self.count
+
+    def block_offset(self, block):
+        return struct.unpack_from('<Q', self.buffer, self.index_offset + block * 8)[0]
+
+    # The first key of a block is stored whole.
+    def block_head(self, block):
+        position = self.block_offset(block)
+        _, position = read_varint(self.buffer, position)
+        length, position = read_varint(self.buffer, position)
+        return self.buffer[position:position + length]
+
+    # Yields the keys of blocks start onward as bytes.
+    def iter_keys(self, start=0):
+        position = self.block_offset(start) if start < self.block_count else self.index_offset
+        key = b''
+        while position < self.index_offset:
+            shared, position = read_varint(self.buffer, position)
+            length, position = read_varint(self.buffer, position)
+            key = key[:shared] + self.buffer[position:position + length]
+            position += length
+            yield key
+
+    def __iter__(self):
+        for key in self.iter_keys():
+            yield key.decode('utf-8')
+
+    def __contains__(self, pid):
+        key = pid.encode('utf-8')
+        low, high = 0, self.block_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.block_head(middle) <= key:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return False
+        for index, candidate in enumerate(self.iter_keys(low - 1)):
+            if candidate >= key or index == self.block_size - 1:
+                return candidate == key
+        return False
+
+
+# Streaming set operations over sorted PID iterables such as PidSet objects.  Each yields PIDs in sorted order.
+def union(*sets):
+    previous = None
+    for pid in heapq.merge(*sets):
+        if pid != previous:
+            yield pid
+            previous = pid
+
+
+def intersection(left, right):
+    right = iter(right)
+    other = next(right, None)
+    for pid in left:
+        while other is not None and other < pid:
+            other = next(right, None)
+        if other is None:
+            return
+        if other == pid:
+            yield pid
+
+
+def difference(left, right):
+    right = iter(right)
+    other = next(right, None)
+    for pid in left:
+        while other is not None and other < pid:
+            other = next(right, None)
+        if other != pid:
+            yield pid
+
+
+# Writes the result of a set operation straight to a new set file.
+def write_sorted(path, pids):
+    with PidSetWriter(path) as writer:
+        for pid in pids:
+            writer.add(pid)
+    return writer.count
+
+
+# Reads a PID listing into a set file.  Text listings hold one PID per line; legacy pickled lists are also accepted.
+def convert(input_file, output_file):
+    with open(input_file, 'rb') as f:
+        is_pickle = f.read(1) == b'\x80'
+    if is_pickle:
+        import pickle
+        with open(input_file, 'rb') as f:
+            return write_pid_set(output_file, pickle.load(f))
+    with open(input_file, encoding='utf-8') as f:
+        return write_pid_set(output_file, (line.strip() for line in f if line.strip()))
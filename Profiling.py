@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+"""
+Profiling.py is an opt-in profiler for the long running entry points, controlled entirely by environment variables
+so production sized runs can be profiled without editing code.
+
+    UPEI_PROFILE           unset or empty disables profiling; 'all' or a comma separated list of stage names enables it
+    UPEI_PROFILE_MODE      'sample' (default) samples the call stack; 'cprofile' traces every call deterministically
+    UPEI_PROFILE_INTERVAL  seconds between stack samples, default 0.005
+    UPEI_PROFILE_MEMORY    '1' also records allocations with tracemalloc
+    UPEI_PROFILE_TOP       number of entries in the text reports, default 25
+    UPEI_PROFILE_DIR       output directory, default 'profiles'
+
+Each profiled call writes {stage}_{timestamp}_{pid}.collapsed (sample mode; one 'frame;frame;frame count' line per stack,
+ready for flamegraph.pl or speedscope) or {stage}_{timestamp}_{pid}.prof plus a .txt summary (cprofile mode),
+and {stage}_{timestamp}_{pid}.alloc.txt with the top allocation sites when memory profiling is on.
+"""
+
+_active = threading.local()
+
+
+def enabled(stage):
+    stages = os.environ.get('UPEI_PROFILE', '').strip()
+    if not stages or stages == '0':
+        return False
+    return stages in ('1', 'all') or stage in [name.strip() for name in stages.split(',')]
+
+
+# Samples one thread's stack at a fixed interval from a background thread.
+class StackSampler:
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='StackSampler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def write_allocations(snapshot, path, top, peak):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"Peak traced memory: {peak / 1048576:.1f} MiB\n")
+        for statistic in snapshot.statistics('lineno')[:top]:
+            f.write(f"{statistic}\n")
+
+
+# Profiles one call of func when its stage is enabled.  Nested profiled calls run inside the outer profile.
+def run(stage, func, *args, **kwargs):
+    if getattr(_active, 'stage', None) is not None or not enabled(stage):
+        return func(*args, **kwargs)
+    # The profilers are only imported when profiling is on, so decorated modules stay cheap to import.
+    import cProfile
+    import pstats
+    import tracemalloc
+    output_dir = os.environ.get('UPEI_PROFILE_DIR', 'profiles')
+    os.makedirs(output_dir, exist_ok=True)
+    prefix = os.path.join(output_dir, f"{stage}_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}")
+    mode = os.environ.get('UPEI_PROFILE_MODE', 'sample')
+    top = int(os.environ.get('UPEI_PROFILE_TOP', '25'))
+    memory = os.environ.get('UPEI_PROFILE_MEMORY', '') == '1'
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    else:
+        profiler = StackSampler(threading.get_ident(), float(os.environ.get('UPEI_PROFILE_INTERVAL', '0.005')))
+        profiler.start()
+    _active.stage = stage
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _active.stage = None
+        if mode == 'cprofile':
+            profiler.disable()
+            profiler.dump_stats(f"{prefix}.prof")
+            with open(f"{prefix}.txt", 'w', encoding='utf-8') as f:
+                pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(top)
+            print(f"Profile for {stage} written to {prefix}.prof")
+        else:
+            profiler.stop()
+            profiler.write(f"{prefix}.collapsed")
+            print(f"Profile for {stage} written to {prefix}.collapsed")
+        if memory:
+            write_allocations(tracemalloc.take_snapshot(), f"{prefix}.alloc.txt", top,
+                              tracemalloc.get_traced_memory()[1])
+            if started_tracing:
+                tracemalloc.stop()
+
+
+# Decorator for entry points.  stage defaults to the function name.
+def profiled(stage=None):
+    def decorator(func):
+        name = stage or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return run(name, func, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
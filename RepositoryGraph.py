@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+from array import array
+from collections import deque
+
+"""
+RepositoryGraph.py is a compact in-memory copy of the repository hierarchy held in a namespace table.
+PIDs are interned to integer ids and each relationship is stored as CSR adjacency arrays,
+so hierarchy lookups never go back to SQLite.
+"""
+
+EDGES = {
+    'collection': 'collection_pid',
+    'page_of': 'page_of',
+    'constituent_of': 'constituent_of',
+}
+
+# RELS-EXT predicates of the {table}_relationships edge table and the graph edge each one belongs to.
+PREDICATES = {
+    'isMemberOfCollection': 'collection',
+    'isMemberOf': 'collection',
+    'isPageOf': 'page_of',
+    'isConstituentOf': 'constituent_of',
+}
+
+
+# Compressed sparse row adjacency: the neighbours of node i are targets[offsets[i]:offsets[i + 1]].
+class Adjacency:
+    def __init__(self, node_count, pairs, sort_key=None):
+        counts = array('l', [0]) * (node_count + 1)
+        for source, _ in pairs:
+            counts[source + 1] += 1
+        for i in range(node_count):
+            counts[i + 1] += counts[i]
+        self.offsets = counts
+        self.targets = array('l', [0]) * len(pairs)
+        fill = array('l', counts[:-1])
+        for source, target in pairs:
+            self.targets[fill[source]] = target
+            fill[source] += 1
+        if sort_key is not None:
+            for i in range(node_count):
+                start, end = self.offsets[i], self.offsets[i + 1]
+                if end - start > 1:
+                    self.targets[start:end] = array('l', sorted(self.targets[start:end], key=sort_key))
+
+    def neighbours(self, node):
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+
+class RepositoryGraph:
+    def __init__(self):
+        self.pids = []
+        self.ids = {}
+        self.models = []
+        self.sequences = array('l')
+        self.children = {}
+        self.parents = {}
+
+    # Builds the graph from a namespace table in one pass.
+    # Edges come from the relationships edge table when given, otherwise from the '|' joined columns.
+    @classmethod
+    def from_connection(cls, conn, table, relationships=None):
+        graph = cls()
+        pairs = {edge: [] for edge in EDGES}
+        rows = conn.execute(
+            f"SELECT pid, content_model, collection_pid, page_of, constituent_of, sequence FROM {table}")
+        for row in rows:
+            child = graph.intern(row[0])
+            graph.models[child] = row[1] or ''
+            sequence = str(row[5] if row[5] is not None else '').strip()
+            graph.sequences[child] = int(sequence) if sequence.isdigit() else -1
+            if relationships is None:
+                for index, edge in enumerate(EDGES, start=2):
+                    for parent in (row[index] or '').split('|'):
+                        if parent:
+                            pairs[edge].append((graph.intern(parent), child))
+        if relationships is not None:
+            for child, predicate, parent in conn.execute(
+                    f"SELECT child_pid, predicate, parent_pid FROM {relationships} ORDER BY child_pid, ordinal"):
+                edge = PREDICATES.get(predicate)
+                if edge is not None:
+                    pairs[edge].append((graph.intern(parent), graph.intern(child)))
+        graph.build(pairs)
+        return graph
+
+    # Returns the integer id for pid, adding it if it is new.
+    def intern(self, pid):
+        node = self.ids.get(pid)
+        if node is None:
+            node = len(self.pids)
+            self.ids[pid] = node
+            self.pids.append(pid)
+            self.models.append('')
+            self.sequences.append(-1)
+        return node
+
+    # Children are kept ordered by sequence, then pid, so ordered listings need no sorting at query time.
+    def build(self, pairs):
+        node_count = len(self.pids)
+
+        def order(node):
+            sequence = self.sequences[node]
+            return (sequence < 0, sequence, self.pids[node])
+
+        for edge, edge_pairs in pairs.items():
+            edge_pairs = list(dict.fromkeys(edge_pairs))
+            self.children[edge] = Adjacency(node_count, edge_pairs, sort_key=order)
+            self.parents[edge] = Adjacency(node_count, [(child, parent) for parent, child in edge_pairs])
+
+    def _edges(self, edges):
+        if edges is None:
+            return list(EDGES)
+        if isinstance(edges, str):
+            return [edges]
+        return edges
+
+    def _walk(self, pid, adjacency, edges):
+        node = self.ids.get(pid)
+        if node is None:
+            return []
+        seen = {node}
+        found = []
+        queue = deque([node])
+        while queue:
+            current = queue.popleft()
+            for edge in edges:
+                for neighbour in adjacency[edge].neighbours(current):
+                    if neighbour not in seen:
+                        seen.add(neighbour)
+                        found.append(neighbour)
+                        queue.append(neighbour)
+        return [self.pids[node] for node in found]
+
+    def content_model(self, pid):
+        node = self.ids.get(pid)
+        return self.models[node] if node is not None else None
+
+    # Direct children, ordered by sequence.
+    def get_children(self, pid, edges=None):
+        node = self.ids.get(pid)
+        if node is None:
+            return []
+        return [self.pids[child] for edge in self._edges(edges) for child in self.children[edge].neighbours(node)]
+
+    # Direct parents.
+    def get_parents(self, pid, edges=None):
+        node = self.ids.get(pid)
+        if node is None:
+            return []
+        return [self.pids[parent] for edge in self._edges(edges) for parent in self.parents[edge].neighbours(node)]
+
+    # All descendants, breadth first.
+    def get_descendants(self, pid, edges=None):
+        return self._walk(pid, self.children, self._edges(edges))
+
+    # All ancestors, nearest first.
+    def get_ancestors(self, pid, edges=None):
+        return self._walk(pid, self.parents, self._edges(edges))
+
+    # Other children of the same parents, in sequence order.
+    def get_siblings(self, pid, edges=None):
+        siblings = []
+        for parent in self.get_parents(pid, edges):
+            siblings.extend(sibling for sibling in self.get_children(parent, edges) if sibling != pid)
+        return siblings
+
+    # Pages of a book or issue, in sequence order.
+    def get_pages(self, book_pid):
+        return self.get_children(book_pid, 'page_of')
+
+    # Direct members of a collection with the given content model.
+    def get_members_by_model(self, collection_pid, content_model):
+        return [pid for pid in self.get_children(collection_pid, 'collection')
+                if self.models[self.ids[pid]] == content_model]
+
+    # Dependency level of each pid: 0 when none of its parents are in pids, otherwise one more than its deepest parent.
+    # Objects sharing a level never depend on each other, so each level can be ingested in parallel.
+    def get_levels(self, pids, edges=None):
+        edges = self._edges(edges)
+        wanted = set(pids)
+        levels = {}
+        for pid in wanted:
+            if pid in levels:
+                continue
+            stack = [pid]
+            active = {pid}
+            while stack:
+                current = stack[-1]
+                # The stack is the current path, so a parent already on it is a cycle and is ignored.
+                pending = next((parent for parent in self.get_parents(current, edges)
+                                if parent in wanted and parent not in levels and parent not in active), None)
+                if pending is not None:
+                    stack.append(pending)
+                    active.add(pending)
+                    continue
+                stack.pop()
+                active.discard(current)
+                parent_levels = [levels[parent] for parent in self.get_parents(current, edges) if parent in levels]
+                levels[current] = max(parent_levels) + 1 if parent_levels else 0
+        return levels
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import time
+
+import ConnectionManager as CM
+
+"""
+StagingJournal.py records every staging copy task in SQLite so an interrupted staging run can resume.
+Tasks move from 'copying' to 'done', 'failed' or 'missing'; anything left 'copying' after a crash is retried.
+A 'done' task counts as staged while its file has the recorded size and, when a digest was recorded, that digest.
+"""
+
+
+class StagingJournal:
+    def __init__(self, database):
+        self.database = database
+        self.connections = CM.ConnectionManager(database=database)
+        self.conn = self.connections.writer()
+        self.conn.execute("""
+            CREATE TABLE if not exists staging_tasks(
+            pid TEXT,
+            dsid TEXT,
+            source TEXT,
+            destination TEXT,
+            size INTEGER,
+            digest TEXT,
+            status TEXT,
+            error TEXT,
+            updated REAL,
+            PRIMARY KEY (pid, dsid)
+            )""")
+        self.conn.execute("CREATE INDEX if not exists staging_tasks_status ON staging_tasks(status)")
+        self.conn.commit()
+        self.recover()
+
+    # Removes partial files left by tasks that were copying when the last run died, and marks them pending.
+    def recover(self):
+        cursor = self.conn.cursor()
+        rows = cursor.execute("SELECT pid, dsid, destination FROM staging_tasks WHERE status = 'copying'").fetchall()
+        for row in rows:
+            part = f"{row['destination']}.part"
+            if os.path.exists(part):
+                os.remove(part)
+                print(f"Removed partial file {part}")
+        cursor.execute("UPDATE staging_tasks SET status = 'pending' WHERE status = 'copying'")
+        self.conn.commit()
+        if rows:
+            print(f"{len(rows)} interrupted staging tasks will be retried")
+
+    # True when the datastream was staged and its file is still intact, or when an earlier run found the object
+    # has no such datastream.
+    def is_staged(self, pid, dsid):
+        return self.is_missing(pid, dsid) or self.staged_destination(pid, dsid) is not None
+
+    def is_missing(self, pid, dsid):
+        row = self.get_task(pid, dsid)
+        return row is not None and row['status'] == 'missing'
+
+    # The staged file of a datastream whose file is still intact, or None.
+    def staged_destination(self, pid, dsid):
+        row = self.get_task(pid, dsid)
+        if row is None or row['status'] != 'done':
+            return None
+        return row['destination'] if self.is_intact(row['destination'], row['size'], row['digest']) else None
+
+    def get_task(self, pid, dsid):
+        command = "SELECT destination, size, digest, status FROM staging_tasks WHERE pid = ? AND dsid = ?"
+        return self.conn.execute(command, (pid, dsid)).fetchone()
+
+    # Checks a staged file against its recorded size and 'TYPE:HEX' digest, such as 'SHA-256:...' or 'MD5:...'.
+    # A digest of an algorithm hashlib does not know is not checked.
+    def is_intact(self, destination, size, digest):
+        try:
+            if os.path.getsize(destination) != size:
+                return False
+        except OSError:
+            return False
+        algorithm, _, expected = (digest or '').partition(':')
+        algorithm = algorithm.replace('-', '').lower()
+        if not expected or algorithm not in hashlib.algorithms_available:
+            return True
+        sha = hashlib.new(algorithm)
+        with open(destination, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), b''):
+                sha.update(chunk)
+        return sha.hexdigest() == expected.lower()
+
+    def start(self, pid, dsid, source, destination, digest=None):
+        self.conn.execute("""
+            INSERT OR REPLACE INTO staging_tasks (pid, dsid, source, destination, size, digest, status, error, updated)
+            VALUES (?, ?, ?, ?, NULL, ?, 'copying', NULL, ?)
+        """, (pid, dsid, source, destination, digest, time.time()))
+        self.conn.commit()
+
+    def finish(self, pid, dsid, size, digest=None):
+        self.conn.execute("""
+            UPDATE staging_tasks SET status = 'done', size = ?, digest = coalesce(?, digest), updated = ?
+            WHERE pid = ? AND dsid = ?
+        """, (size, digest, time.time(), pid, dsid))
+        self.conn.commit()
+
+    def fail(self, pid, dsid, error):
+        self.conn.execute("UPDATE staging_tasks SET status = 'failed', error = ?, updated = ? WHERE pid = ? AND dsid = ?",
+                          (error, time.time(), pid, dsid))
+        self.conn.commit()
+
+    def mark_missing(self, pid, dsid):
+        self.conn.execute("""
+            INSERT OR REPLACE INTO staging_tasks (pid, dsid, status, updated) VALUES (?, ?, 'missing', ?)
+        """, (pid, dsid, time.time()))
+        self.conn.commit()
+
+    # Returns task counts and staged bytes per status.
+    def progress(self):
+        progress = {}
+        command = "SELECT status, count(*) AS tasks, coalesce(sum(size), 0) AS bytes FROM staging_tasks GROUP BY status"
+        for row in self.conn.execute(command):
+            progress[row['status']] = {'tasks': row['tasks'], 'bytes': row['bytes']}
+        return progress
+
+    # Returns pid, dsid and error of every failed task.
+    def get_failures(self):
+        command = "SELECT pid, dsid, error FROM staging_tasks WHERE status = 'failed' ORDER BY pid, dsid"
+        return [dict(row) for row in self.conn.execute(command)]
+
+    def close(self):
+        self.connections.close()
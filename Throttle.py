@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+import atexit
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import ConnectionManager as CM
+
+"""
+Throttle.py limits the files and bytes per second that scanning, harvesting and staging read from the Fedora storage,
+so migration work can run against a live server.  Like Profiling.py it is controlled by environment variables,
+which worker processes inherit, and every process draws on the same token buckets, kept in a small SQLite database.
+
+    UPEI_THROTTLE_BYTES     bytes per second, with an optional K, M or G suffix; unset, empty or 'off' for no limit
+    UPEI_THROTTLE_FILES     files per second; unset, empty or 'off' for no limit
+    UPEI_THROTTLE_SCHEDULE  comma separated HH:MM-HH:MM=BYTES/FILES windows whose limits replace the ones above while
+                            they last, e.g. '22:00-06:00=off,12:00-13:00=50M/200'; 'off' or '-' lifts a limit
+    UPEI_THROTTLE_BURST     seconds of traffic that may be used in one burst, default 1
+    UPEI_THROTTLE_STATE     shared bucket database, default 'throttle.db'
+
+A bucket may go into debt: work is charged when it happens and the caller then sleeps until the debt is repaid,
+so files larger than a burst still pass.  Time spent sleeping is totalled in the shared database, where
+'Migrate.py throttle-status' reports it for all workers, and each process prints its own total when it exits.
+"""
+
+UNITS = {'K': 1024, 'M': 1048576, 'G': 1073741824}
+
+_throttle = None
+_throttle_pid = None
+_throttle_lock = threading.Lock()
+
+
+# Parses a rate such as '20M' or '150'.  None means no limit.
+def parse_rate(value):
+    value = (value or '').strip()
+    if value.lower() in ('', '-', 'off'):
+        return None
+    multiplier = UNITS.get(value[-1].upper(), 1)
+    if multiplier != 1:
+        value = value[:-1]
+    rate = float(value) * multiplier
+    if rate <= 0:
+        raise ValueError(f"Throttle rate '{value}' must be positive")
+    return rate
+
+
+def parse_minutes(value):
+    hours, _, minutes = value.partition(':')
+    return int(hours) * 60 + int(minutes or 0)
+
+
+# Parses schedule windows into (start minute, end minute, bytes per second, files per second).
+def parse_schedule(text):
+    windows = []
+    for window in (text or '').split(','):
+        if not window.strip():
+            continue
+        span, separator, limits = window.partition('=')
+        start, dash, end = span.strip().partition('-')
+        if not separator or not dash:
+            raise ValueError(f"Throttle window '{window}' is not HH:MM-HH:MM=BYTES/FILES")
+        byte_limit, _, file_limit = limits.partition('/')
+        windows.append((parse_minutes(start), parse_minutes(end), parse_rate(byte_limit), parse_rate(file_limit)))
+    return windows
+
+
+def in_window(minute, start, end):
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+class Throttle:
+    def __init__(self, bytes_rate=None, files_rate=None, schedule=None, burst=1.0, state='throttle.db'):
+        self.bytes_rate = bytes_rate
+        self.files_rate = files_rate
+        self.schedule = schedule or []
+        self.burst = burst
+        self.state = state
+        self.connections = CM.ConnectionManager(database=state)
+        self.conn = self.connections.writer()
+        self.conn.execute("""
+            CREATE TABLE if not exists throttle(
+            kind TEXT PRIMARY KEY,
+            tokens REAL,
+            updated REAL,
+            consumed REAL DEFAULT 0,
+            throttled REAL DEFAULT 0
+            )""")
+        self.conn.commit()
+        self.throttled = {'bytes': 0.0, 'files': 0.0}
+        self.consumed = {'bytes': 0, 'files': 0}
+
+    # Builds a throttle from the environment, or returns None when no limit is configured.
+    @classmethod
+    def from_environment(cls):
+        bytes_rate = parse_rate(os.environ.get('UPEI_THROTTLE_BYTES'))
+        files_rate = parse_rate(os.environ.get('UPEI_THROTTLE_FILES'))
+        schedule = parse_schedule(os.environ.get('UPEI_THROTTLE_SCHEDULE'))
+        if bytes_rate is None and files_rate is None and \
+                not any(window_bytes or window_files for _, _, window_bytes, window_files in schedule):
+            return None
+        return cls(bytes_rate, files_rate, schedule, float(os.environ.get('UPEI_THROTTLE_BURST', '1')),
+                   os.environ.get('UPEI_THROTTLE_STATE', 'throttle.db'))
+
+    # The (bytes, files) per second limits in force now.  The first matching window wins.
+    def limits(self, now=None):
+        now = time.localtime(now)
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, bytes_rate, files_rate in self.schedule:
+            if in_window(minute, start, end):
+                return bytes_rate, files_rate
+        return self.bytes_rate, self.files_rate
+
+    # True if byte limits can apply at some time of day, so copies should be done in metered chunks.
+    def limits_bytes(self):
+        return self.bytes_rate is not None or any(window[2] is not None for window in self.schedule)
+
+    # Charges work to the shared buckets and sleeps until the buckets are out of debt.  Returns the seconds slept.
+    def consume(self, files=0, nbytes=0):
+        bytes_rate, files_rate = self.limits()
+        charges = [(kind, amount, rate) for kind, amount, rate in
+                   (('files', files, files_rate), ('bytes', nbytes, bytes_rate)) if amount and rate is not None]
+        self.consumed['files'] += files
+        self.consumed['bytes'] += nbytes
+        if not charges:
+            return 0.0
+        balances = {}
+        waits = {}
+        with self.connections.write_lock:
+            now = time.time()
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for kind, amount, rate in charges:
+                    row = self.conn.execute("SELECT tokens, updated FROM throttle WHERE kind = ?", (kind,)).fetchone()
+                    capacity = rate * self.burst
+                    tokens = capacity if row is None else min(capacity, row['tokens'] + rate * (now - row['updated']))
+                    balances[kind] = tokens - amount
+                    waits[kind] = max(0.0, -balances[kind] / rate)
+                # The slowest bucket sets the wait, and the wait is counted against that bucket only.
+                limiting = max(waits, key=waits.get)
+                for kind, amount, _ in charges:
+                    self.conn.execute("""
+                        INSERT INTO throttle (kind, tokens, updated, consumed, throttled) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(kind) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated,
+                        consumed = consumed + excluded.consumed, throttled = throttled + excluded.throttled
+                    """, (kind, balances[kind], now, amount, waits[kind] if kind == limiting else 0.0))
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+        wait = waits[limiting]
+        if wait > 0:
+            self.throttled[limiting] += wait
+            time.sleep(wait)
+        return wait
+
+    def report(self):
+        total = sum(self.throttled.values())
+        if self.consumed['files'] or total:
+            print(f"Throttle: {self.consumed['files']} files, {self.consumed['bytes'] / 1048576:.1f} MiB, "
+                  f"{total:.1f}s throttled ({self.throttled['files']:.1f}s on files, "
+                  f"{self.throttled['bytes']:.1f}s on bytes)")
+
+
+# Returns the throttle of this process, or None when throttling is off.  The environment is read once per process.
+def get_throttle():
+    global _throttle, _throttle_pid
+    if _throttle_pid == os.getpid():
+        return _throttle
+    with _throttle_lock:
+        if _throttle_pid != os.getpid():
+            _throttle = Throttle.from_environment()
+            _throttle_pid = os.getpid()
+            if _throttle is not None:
+                atexit.register(_throttle.report)
+        return _throttle
+
+
+# Makes the next get_throttle call read the environment again.
+def reset():
+    global _throttle, _throttle_pid
+    with _throttle_lock:
+        _throttle = None
+        _throttle_pid = None
+
+
+# Charges files and bytes read from the Fedora storage to the shared limits.  Does nothing when throttling is off.
+def consume(files=0, nbytes=0):
+    throttle = get_throttle()
+    if throttle is not None:
+        throttle.consume(files, nbytes)
+
+
+# shutil.copy that is metered in chunks when a byte limit is configured, so large files do not burst.
+def copy(source, destination, chunk_size=1048576):
+    throttle = get_throttle()
+    if throttle is None or not throttle.limits_bytes():
+        shutil.copy(source, destination)
+        consume(files=1, nbytes=os.path.getsize(destination))
+        return
+    with open(destination, 'wb') as out:
+        copy_into(source, out, chunk_size)
+    shutil.copymode(source, destination)
+
+
+# Appends the content of source to an open binary file, metered like copy.
+def copy_into(source, out, chunk_size=1048576):
+    throttle = get_throttle()
+    with open(source, 'rb') as f:
+        if throttle is None:
+            shutil.copyfileobj(f, out, chunk_size)
+            return
+        throttle.consume(files=1)
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            out.write(chunk)
+            throttle.consume(nbytes=len(chunk))
+
+
+# Reads a small text file, such as a MODS datastream, and charges it.
+def read_text(path, encoding=None):
+    with open(path, encoding=encoding) as f:
+        text = f.read()
+    consume(files=1, nbytes=len(text))
+    return text
+
+
+# Shared totals of every worker: {kind: (consumed, seconds throttled)}.
+def status(state=None):
+    state = state or os.environ.get('UPEI_THROTTLE_STATE', 'throttle.db')
+    if not os.path.exists(state):
+        return {}
+    connections = CM.ConnectionManager(database=state)
+    try:
+        return {row['kind']: (row['consumed'], row['throttled'])
+                for row in connections.reader().execute("SELECT kind, consumed, throttled FROM throttle")}
+    except sqlite3.OperationalError:
+        return {}
+    finally:
+        connections.close()
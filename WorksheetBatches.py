@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import csv
+import io
+import os
+
+"""
+WorksheetBatches.py splits a Workbench worksheet into numbered batch files grouped by dependency level.
+Every object in a level only depends on objects in earlier levels, so all batches of one level
+can be ingested by separate Workbench processes at the same time.
+"""
+
+
+class BatchWriter:
+    # Batches are named {stem}_L{level:02d}_{batch:04d}{ext} next to output_file.
+    # A batch is closed once it holds max_rows rows or would grow past max_bytes.
+    def __init__(self, output_file, fieldnames, max_rows=None, max_bytes=None):
+        self.stem, self.ext = os.path.splitext(output_file)
+        self.ext = self.ext or '.csv'
+        self.fieldnames = fieldnames
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.open_batches = {}
+        self.batch_counts = {}
+        self.files = []
+        self.header = self.encode({field: field for field in fieldnames})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Renders one row exactly as csv.DictWriter would write it, so batch sizes are known before writing.
+    def encode(self, row):
+        buffer = io.StringIO()
+        csv.DictWriter(buffer, fieldnames=self.fieldnames, extrasaction='ignore').writerow(row)
+        return buffer.getvalue()
+
+    def is_full(self, batch, line):
+        if not batch['rows']:
+            return False
+        if self.max_rows and batch['rows'] >= self.max_rows:
+            return True
+        return bool(self.max_bytes) and batch['bytes'] + len(line.encode('utf-8')) > self.max_bytes
+
+    def open_batch(self, level):
+        number = self.batch_counts.get(level, 0) + 1
+        self.batch_counts[level] = number
+        file_name = f"{self.stem}_L{level:02d}_{number:04d}{self.ext}"
+        handle = open(file_name, 'w', newline='', encoding='utf-8')
+        handle.write(self.header)
+        self.files.append(file_name)
+        batch = {'file': file_name, 'handle': handle, 'rows': 0, 'bytes': len(self.header.encode('utf-8'))}
+        self.open_batches[level] = batch
+        return batch
+
+    def writerow(self, level, row):
+        line = self.encode(row)
+        batch = self.open_batches.get(level)
+        if batch is None or self.is_full(batch, line):
+            if batch is not None:
+                batch['handle'].close()
+            batch = self.open_batch(level)
+        batch['handle'].write(line)
+        batch['rows'] += 1
+        batch['bytes'] += len(line.encode('utf-8'))
+
+    # Closes every batch and returns the file names in ingest order.
+    def close(self):
+        for batch in self.open_batches.values():
+            batch['handle'].close()
+        self.open_batches = {}
+        self.files.sort()
+        for level in sorted(self.batch_counts):
+            print(f"Level {level}: {self.batch_counts[level]} batch file(s)")
+        return self.files
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import base64
+import io
+import os
+
+import lxml.etree as ET
+import pytest
+
+import FoxmlWorker as FW
+
+"""
+Tests for the streaming base64 decode of inline binaryContent in FoxmlWorker.py.
+"""
+
+PAYLOAD = bytes(range(256)) * 5 + b'tail'
+OLD_PAYLOAD = b'an older version that must not be written'
+
+
+def wrap(data, width=76):
+    encoded = base64.b64encode(data).decode('ascii')
+    return '\n'.join(encoded[start:start + width] for start in range(0, len(encoded), width))
+
+
+FOXML_DOCUMENT = f"""<?xml version="1.0" encoding="UTF-8"?>
+<foxml:digitalObject VERSION="1.1" PID="test:1" xmlns:foxml="info:fedora/fedora-system:def/foxml#">
+  <foxml:objectProperties>
+    <foxml:property NAME="info:fedora/fedora-system:def/model#state" VALUE="Active"/>
+    <foxml:property NAME="info:fedora/fedora-system:def/model#label" VALUE="Test"/>
+  </foxml:objectProperties>
+  <foxml:datastream ID="OBJ" STATE="A" CONTROL_GROUP="M">
+    <foxml:datastreamVersion ID="OBJ.0" MIMETYPE="image/jpeg" SIZE="{len(OLD_PAYLOAD)}">
+      <foxml:binaryContent>{wrap(OLD_PAYLOAD)}</foxml:binaryContent>
+    </foxml:datastreamVersion>
+    <foxml:datastreamVersion ID="OBJ.1" MIMETYPE="image/jpeg" SIZE="{len(PAYLOAD)}">
+      <foxml:binaryContent>
+        {wrap(PAYLOAD)}
+      </foxml:binaryContent>
+    </foxml:datastreamVersion>
+  </foxml:datastream>
+  <foxml:datastream ID="EMPTY" STATE="A" CONTROL_GROUP="M">
+    <foxml:datastreamVersion ID="EMPTY.0" MIMETYPE="text/plain" SIZE="0">
+      <foxml:binaryContent></foxml:binaryContent>
+    </foxml:datastreamVersion>
+  </foxml:datastream>
+</foxml:digitalObject>
+""".encode('utf-8')
+
+
+def decode(version_id, chunk_size):
+    out = io.BytesIO()
+    parser = ET.XMLParser(target=FW.BinaryContentTarget(version_id, out), huge_tree=True)
+    for start in range(0, len(FOXML_DOCUMENT), chunk_size):
+        parser.feed(FOXML_DOCUMENT[start:start + chunk_size])
+    return parser.close(), out.getvalue()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3, 7, 64, 65536])
+def test_decodes_only_the_requested_version_at_any_chunk_size(chunk_size):
+    assert decode('OBJ.1', chunk_size) == (len(PAYLOAD), PAYLOAD)
+    assert decode('OBJ.0', chunk_size) == (len(OLD_PAYLOAD), OLD_PAYLOAD)
+
+
+def test_unknown_version_writes_nothing():
+    assert decode('OBJ.9', 64) == (0, b'')
+
+
+def test_flush_keeps_incomplete_groups():
+    out = io.BytesIO()
+    target = FW.BinaryContentTarget('OBJ.0', out)
+    target.buffer = base64.b64encode(b'abcdef').decode('ascii')[:6]
+    target.flush()
+    assert out.getvalue() == b'abc'
+    assert target.buffer == 'ZG'
+
+
+@pytest.fixture
+def foxml_file(tmp_path):
+    path = tmp_path / 'test_1.xml'
+    path.write_bytes(FOXML_DOCUMENT)
+    return str(path)
+
+
+@pytest.mark.parametrize('skip_binary', [False, True])
+def test_write_binary_content_streams_the_current_version(foxml_file, tmp_path, skip_binary):
+    worker = FW.FWorker(foxml_file, skip_binary=skip_binary)
+    destination = tmp_path / 'OBJ.jpg'
+    assert worker.write_binary_content('OBJ', str(destination), chunk_size=5) == len(PAYLOAD)
+    assert destination.read_bytes() == PAYLOAD
+    out = io.BytesIO()
+    assert worker.write_binary_content('EMPTY', out) == 0
+    assert out.getvalue() == b''
+    assert worker.write_binary_content('MISSING', str(tmp_path / 'missing')) is None
+    assert not os.path.exists(tmp_path / 'missing')
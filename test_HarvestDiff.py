@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import sqlite3
+
+import pytest
+
+import HarvestDiff as HD
+
+"""
+Tests for HarvestDiff.py: the sort-merge diff, row hashing and reading hashes from databases and snapshots.
+"""
+
+
+def make_row(pid, **values):
+    row = {column: None for column in HD.HASH_COLUMNS}
+    row.update(pid=pid, title=f"Title of {pid}", content_model='islandora:sp_basic_image')
+    row.update(values)
+    return row
+
+
+def make_database(path, rows, with_row_hash=True):
+    conn = sqlite3.connect(path)
+    columns = ['pid TEXT PRIMARY KEY', 'nid INTEGER', *HD.HASH_COLUMNS] + (['row_hash TEXT'] if with_row_hash else [])
+    conn.execute(f"CREATE TABLE test ({', '.join(columns)})")
+    for row in rows:
+        values = {column: row.get(column) for column in ['pid', *HD.HASH_COLUMNS]}
+        if with_row_hash:
+            values['row_hash'] = HD.row_hash(row)
+        conn.execute(f"INSERT INTO test ({', '.join(values)}) VALUES ({', '.join('?' * len(values))})",
+                     list(values.values()))
+    conn.commit()
+    conn.close()
+    return str(path)
+
+
+def test_diff_merges_both_streams():
+    old = [('a', '1'), ('b', '2'), ('d', '4'), ('e', '5')]
+    new = [('b', '2'), ('c', '3'), ('d', 'x'), ('f', '6')]
+    assert list(HD.diff(old, new)) == [('removed', 'a'), ('added', 'c'), ('changed', 'd'), ('removed', 'e'),
+                                       ('added', 'f')]
+
+
+def test_diff_with_an_empty_side():
+    rows = [('a', '1'), ('b', '2')]
+    assert list(HD.diff([], rows)) == [('added', 'a'), ('added', 'b')]
+    assert list(HD.diff(rows, [])) == [('removed', 'a'), ('removed', 'b')]
+    assert list(HD.diff(rows, rows)) == []
+
+
+def test_row_hash_ignores_columns_outside_the_content():
+    row = make_row('test:1')
+    assert HD.row_hash(row) == HD.row_hash(dict(row, nid=42, pid='test:2'))
+    assert HD.row_hash(row) != HD.row_hash(dict(row, title='Other'))
+
+
+def test_row_hash_separates_columns():
+    first = make_row('test:1', title='ab', content_model='c')
+    second = make_row('test:1', title='a', content_model='bc')
+    assert HD.row_hash(first) != HD.row_hash(second)
+
+
+def test_row_hash_treats_none_as_empty():
+    assert HD.row_hash(make_row('test:1', sequence=None)) == HD.row_hash(make_row('test:1', sequence=''))
+
+
+def test_row_hash_undoubles_legacy_mods_quotes():
+    assert HD.row_hash(make_row('test:1', mods="<title>Bob''s</title>")) == \
+        HD.row_hash(make_row('test:1', mods="<title>Bob's</title>"))
+
+
+def test_database_and_snapshot_hashes_match(tmp_path):
+    rows = [make_row('test:2'), make_row('test:1', mods='<mods/>'), make_row('test:10')]
+    database = make_database(tmp_path / 'new.db', rows)
+    snapshot = str(tmp_path / 'new.snap')
+    assert HD.write_snapshot(database, 'test', snapshot) == 3
+    from_database = list(HD.iter_hashes(database, 'test'))
+    assert [pid for pid, _ in from_database] == ['test:1', 'test:10', 'test:2']
+    assert list(HD.iter_hashes(snapshot, 'test')) == from_database
+    assert list(HD.diff(HD.iter_hashes(snapshot, 'test'), from_database)) == []
+
+
+def test_legacy_database_is_hashed_as_read(tmp_path):
+    rows = [make_row('test:1'), make_row('test:2')]
+    legacy = make_database(tmp_path / 'old.db', rows, with_row_hash=False)
+    current = make_database(tmp_path / 'new.db', [rows[0], make_row('test:2', title='Changed'), make_row('test:3')])
+    assert list(HD.diff(HD.iter_hashes(legacy, 'test'), HD.iter_hashes(current, 'test'))) == \
+        [('changed', 'test:2'), ('added', 'test:3')]
+
+
+def test_missing_table_and_bad_names(tmp_path):
+    database = make_database(tmp_path / 'new.db', [])
+    with pytest.raises(ValueError):
+        list(HD.iter_hashes(database, 'other'))
+    with pytest.raises(ValueError):
+        list(HD.iter_hashes(database, 'test; DROP TABLE test'))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import pickle
+
+import pytest
+
+import PidSet as PS
+
+"""
+Tests for PidSet.py: round trips across block boundaries, membership, set operations and listing conversion.
+"""
+
+
+def write(tmp_path, name, pids, block_size=PS.BLOCK_SIZE):
+    path = str(tmp_path / name)
+    with PS.PidSetWriter(path, block_size) as writer:
+        for pid in sorted(set(pids)):
+            writer.add(pid)
+    return path
+
+
+def test_round_trip_keeps_sorted_unique_pids(tmp_path):
+    pids = [f"test:{number}" for number in range(200)] + ['other:1', 'test:5']
+    path = str(tmp_path / 'pids.set')
+    assert PS.write_pid_set(path, pids) == 201
+    with PS.PidSet(path) as pid_set:
+        assert len(pid_set) == 201
+        assert list(pid_set) == sorted(set(pids))
+
+
+@pytest.mark.parametrize('block_size', [1, 2, 3, 16])
+def test_membership_across_block_boundaries(tmp_path, block_size):
+    pids = [f"ns:{number:04d}" for number in range(0, 100, 2)]
+    with PS.PidSet(write(tmp_path, 'pids.set', pids, block_size)) as pid_set:
+        for pid in pids:
+            assert pid in pid_set
+        for missing in ['ns:0001', 'ns:0099', 'ns:9999', 'aa:0000', 'ns:', '']:
+            assert missing not in pid_set
+
+
+def test_empty_set(tmp_path):
+    with PS.PidSet(write(tmp_path, 'empty.set', [])) as pid_set:
+        assert len(pid_set) == 0
+        assert list(pid_set) == []
+        assert 'test:1' not in pid_set
+
+
+def test_non_ascii_pids(tmp_path):
+    pids = ['test:é', 'test:e', 'test:ü1', 'test:ü2']
+    with PS.PidSet(write(tmp_path, 'pids.set', pids, 2)) as pid_set:
+        assert set(pid_set) == set(pids)
+        assert all(pid in pid_set for pid in pids)
+
+
+def test_writer_rejects_unsorted_input_and_leaves_no_file(tmp_path):
+    path = tmp_path / 'pids.set'
+    with pytest.raises(ValueError):
+        with PS.PidSetWriter(str(path)) as writer:
+            writer.add('test:2')
+            writer.add('test:1')
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_rejects_other_files(tmp_path):
+    path = tmp_path / 'pids.txt'
+    path.write_text('test:1\ntest:2\ntest:3\ntest:4\ntest:5\n')
+    with pytest.raises(ValueError):
+        PS.PidSet(str(path))
+
+
+def test_set_operations(tmp_path):
+    left = [f"test:{number:03d}" for number in range(0, 60, 2)]
+    right = [f"test:{number:03d}" for number in range(0, 60, 3)]
+    with PS.PidSet(write(tmp_path, 'left.set', left, 4)) as first, \
+            PS.PidSet(write(tmp_path, 'right.set', right, 4)) as second:
+        assert list(PS.union(first, second)) == sorted(set(left) | set(right))
+        assert list(PS.intersection(first, second)) == sorted(set(left) & set(right))
+        assert list(PS.difference(first, second)) == sorted(set(left) - set(right))
+        assert list(PS.difference(second, first)) == sorted(set(right) - set(left))
+
+
+def test_write_sorted_stores_an_operation_result(tmp_path):
+    path = str(tmp_path / 'result.set')
+    assert PS.write_sorted(path, PS.difference(['a', 'b', 'c'], ['b'])) == 2
+    with PS.PidSet(path) as pid_set:
+        assert list(pid_set) == ['a', 'c']
+
+
+def test_convert_text_and_pickled_listings(tmp_path):
+    text = tmp_path / 'pids.txt'
+    text.write_text('test:2\n\ntest:1\ntest:2\n')
+    assert PS.convert(str(text), str(tmp_path / 'text.set')) == 2
+    pickled = tmp_path / 'pids.pickle'
+    pickled.write_bytes(pickle.dumps(['test:3', 'test:1']))
+    assert PS.convert(str(pickled), str(tmp_path / 'pickle.set')) == 2
+    with PS.PidSet(str(tmp_path / 'pickle.set')) as pid_set:
+        assert list(pid_set) == ['test:1', 'test:3']
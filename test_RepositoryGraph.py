@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import sqlite3
+
+import pytest
+
+import RepositoryGraph as RG
+
+"""
+Tests for RepositoryGraph.py over a small in-memory namespace table, read from both the '|' joined columns
+and the relationships edge table.
+"""
+
+ROWS = [
+    # pid, content_model, collection_pid, page_of, constituent_of, sequence
+    ('test:root', 'islandora:collectionCModel', None, None, None, None),
+    ('test:coll', 'islandora:collectionCModel', 'test:root', None, None, None),
+    ('test:book', 'islandora:bookCModel', 'test:coll', None, None, None),
+    ('test:page10', 'islandora:pageCModel', None, 'test:book', None, '10'),
+    ('test:page2', 'islandora:pageCModel', None, 'test:book', None, '2'),
+    ('test:page1', 'islandora:pageCModel', None, 'test:book', None, 1),
+    ('test:pdf', 'islandora:sp_pdf', 'test:coll|test:root', None, None, None),
+    ('test:compound', 'islandora:compoundCModel', 'test:coll', None, None, None),
+    ('test:part', 'islandora:sp_basic_image', None, None, 'test:compound', None),
+]
+
+
+def connection(with_relationships=False):
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE test (pid TEXT PRIMARY KEY, content_model TEXT, collection_pid TEXT, page_of TEXT, "
+                 "constituent_of TEXT, sequence)")
+    conn.executemany("INSERT INTO test VALUES (?, ?, ?, ?, ?, ?)", ROWS)
+    if with_relationships:
+        conn.execute("CREATE TABLE test_relationships (child_pid TEXT, predicate TEXT, parent_pid TEXT, "
+                     "ordinal INTEGER)")
+        predicates = {2: 'isMemberOfCollection', 3: 'isPageOf', 4: 'isConstituentOf'}
+        conn.executemany("INSERT INTO test_relationships VALUES (?, ?, ?, ?)",
+                         [(row[0], predicate, parent, ordinal) for row in ROWS
+                          for index, predicate in predicates.items()
+                          for ordinal, parent in enumerate((row[index] or '').split('|')) if parent])
+        conn.execute("INSERT INTO test_relationships VALUES ('test:book', 'hasModel', 'test:ignored', 0)")
+    return conn
+
+
+@pytest.fixture(params=[False, True], ids=['columns', 'relationships'])
+def graph(request):
+    conn = connection(request.param)
+    return RG.RepositoryGraph.from_connection(conn, 'test', 'test_relationships' if request.param else None)
+
+
+def test_pages_are_ordered_by_numeric_sequence(graph):
+    assert graph.get_pages('test:book') == ['test:page1', 'test:page2', 'test:page10']
+
+
+def test_children_parents_and_models(graph):
+    assert sorted(graph.get_children('test:coll', 'collection')) == ['test:book', 'test:compound', 'test:pdf']
+    assert sorted(graph.get_parents('test:pdf')) == ['test:coll', 'test:root']
+    assert graph.get_children('test:compound', 'constituent_of') == ['test:part']
+    assert graph.content_model('test:book') == 'islandora:bookCModel'
+    assert graph.content_model('test:missing') is None
+    assert graph.get_members_by_model('test:coll', 'islandora:bookCModel') == ['test:book']
+    assert 'test:ignored' not in graph.ids
+
+
+def test_descendants_and_ancestors(graph):
+    assert set(graph.get_descendants('test:root')) == {row[0] for row in ROWS} - {'test:root'}
+    assert graph.get_ancestors('test:page1') == ['test:book', 'test:coll', 'test:root']
+    assert graph.get_siblings('test:page2') == ['test:page1', 'test:page10']
+    assert graph.get_descendants('test:missing') == []
+
+
+def test_levels_put_parents_before_children(graph):
+    levels = graph.get_levels(row[0] for row in ROWS)
+    assert levels['test:root'] == 0
+    assert levels['test:coll'] == 1
+    assert levels['test:pdf'] == 2
+    assert levels['test:book'] == 2
+    assert levels['test:page1'] == 3
+    assert levels['test:part'] == 3
+
+
+def test_levels_ignore_parents_outside_the_batch(graph):
+    assert graph.get_levels(['test:book', 'test:page1']) == {'test:book': 0, 'test:page1': 1}
+
+
+def test_levels_survive_cycles():
+    graph = RG.RepositoryGraph()
+    for pid in ('a', 'b', 'c'):
+        graph.intern(pid)
+    graph.build({'collection': [(0, 1), (1, 2), (2, 0)], 'page_of': [], 'constituent_of': []})
+    levels = graph.get_levels(['a', 'b', 'c'])
+    assert set(levels) == {'a', 'b', 'c'}
+
+
+def test_adjacency_rows():
+    adjacency = RG.Adjacency(4, [(2, 0), (0, 3), (2, 1), (0, 1)], sort_key=lambda node: node)
+    assert list(adjacency.neighbours(0)) == [1, 3]
+    assert list(adjacency.neighbours(1)) == []
+    assert list(adjacency.neighbours(2)) == [0, 1]
+    assert list(adjacency.neighbours(3)) == []
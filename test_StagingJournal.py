@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import hashlib
+
+import pytest
+
+import StagingJournal as SJ
+
+"""
+Tests for StagingJournal.py: resuming after an interrupted run and the size and digest checks on staged files.
+"""
+
+CONTENT = b'staged datastream content'
+DIGEST = f"SHA-256:{hashlib.sha256(CONTENT).hexdigest()}"
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / 'journal.db')
+
+
+@pytest.fixture
+def journal(journal_path):
+    journal = SJ.StagingJournal(journal_path)
+    yield journal
+    journal.close()
+
+
+def stage(journal, destination, digest=DIGEST):
+    journal.start('test:1', 'OBJ', 'source/OBJ', str(destination), digest)
+    destination.write_bytes(CONTENT)
+    journal.finish('test:1', 'OBJ', len(CONTENT))
+
+
+def test_interrupted_copy_is_cleaned_up_and_retried(journal_path, tmp_path):
+    destination = tmp_path / '1_OBJ.jpg'
+    part = tmp_path / '1_OBJ.jpg.part'
+    journal = SJ.StagingJournal(journal_path)
+    journal.start('test:1', 'OBJ', 'source/OBJ', str(destination), DIGEST)
+    part.write_bytes(CONTENT[:5])
+    journal.close()
+
+    resumed = SJ.StagingJournal(journal_path)
+    try:
+        assert not part.exists()
+        assert resumed.get_task('test:1', 'OBJ')['status'] == 'pending'
+        assert not resumed.is_staged('test:1', 'OBJ')
+        assert resumed.progress() == {'pending': {'tasks': 1, 'bytes': 0}}
+    finally:
+        resumed.close()
+
+
+def test_finished_task_survives_a_restart(journal_path, tmp_path):
+    destination = tmp_path / '1_OBJ.jpg'
+    journal = SJ.StagingJournal(journal_path)
+    stage(journal, destination)
+    journal.close()
+
+    resumed = SJ.StagingJournal(journal_path)
+    try:
+        assert resumed.is_staged('test:1', 'OBJ')
+        assert resumed.staged_destination('test:1', 'OBJ') == str(destination)
+        assert resumed.progress() == {'done': {'tasks': 1, 'bytes': len(CONTENT)}}
+    finally:
+        resumed.close()
+
+
+def test_changed_or_removed_files_are_staged_again(journal, tmp_path):
+    destination = tmp_path / '1_OBJ.jpg'
+    stage(journal, destination)
+    destination.write_bytes(CONTENT.upper())
+    assert not journal.is_staged('test:1', 'OBJ')
+    destination.write_bytes(CONTENT + b'!')
+    assert not journal.is_staged('test:1', 'OBJ')
+    destination.unlink()
+    assert not journal.is_staged('test:1', 'OBJ')
+
+
+@pytest.mark.parametrize('digest', [None, 'DISABLED:none', 'UNKNOWN-ALGORITHM:abc'])
+def test_size_alone_is_checked_without_a_usable_digest(journal, tmp_path, digest):
+    destination = tmp_path / '1_OBJ.jpg'
+    stage(journal, destination, digest)
+    destination.write_bytes(CONTENT.upper())
+    assert journal.is_staged('test:1', 'OBJ')
+
+
+def test_digest_types_and_case(journal, tmp_path):
+    destination = tmp_path / '1_OBJ.jpg'
+    destination.write_bytes(CONTENT)
+    assert journal.is_intact(str(destination), len(CONTENT), f"MD5:{hashlib.md5(CONTENT).hexdigest().upper()}")
+    assert journal.is_intact(str(destination), len(CONTENT), f"SHA-1:{hashlib.sha1(CONTENT).hexdigest()}")
+    assert not journal.is_intact(str(destination), len(CONTENT), f"SHA-1:{hashlib.sha1(b'other').hexdigest()}")
+
+
+def test_missing_and_failed_tasks(journal, tmp_path):
+    journal.mark_missing('test:2', 'OCR')
+    assert journal.is_missing('test:2', 'OCR')
+    assert journal.is_staged('test:2', 'OCR')
+    journal.start('test:3', 'OBJ', 'source/OBJ', str(tmp_path / '3_OBJ.jpg'))
+    journal.fail('test:3', 'OBJ', 'No such file')
+    assert not journal.is_staged('test:3', 'OBJ')
+    assert journal.get_failures() == [{'pid': 'test:3', 'dsid': 'OBJ', 'error': 'No such file'}]
+    assert journal.get_task('test:4', 'OBJ') is None
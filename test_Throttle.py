@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+import time
+
+import pytest
+
+import Throttle as TH
+
+"""
+Tests for Throttle.py: rate and schedule parsing, windows across midnight and the debt of the shared token buckets.
+"""
+
+
+class Clock:
+    def __init__(self, now=1000000.0):
+        self.now = now
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(TH.time, 'time', clock.time)
+    monkeypatch.setattr(TH.time, 'sleep', clock.sleep)
+    return clock
+
+
+@pytest.fixture
+def make_throttle(tmp_path):
+    throttles = []
+
+    def make(bytes_rate=None, files_rate=None, schedule=None, burst=1.0):
+        throttle = TH.Throttle(bytes_rate, files_rate, schedule, burst, str(tmp_path / 'throttle.db'))
+        throttles.append(throttle)
+        return throttle
+
+    yield make
+    for throttle in throttles:
+        throttle.connections.close()
+
+
+def at(hour, minute):
+    now = time.localtime()
+    return time.mktime((now.tm_year, now.tm_mon, now.tm_mday, hour, minute, 0, 0, 0, -1))
+
+
+@pytest.mark.parametrize('value, rate', [
+    (None, None), ('', None), ('off', None), ('OFF', None), ('-', None),
+    ('150', 150.0), ('1.5', 1.5), ('2K', 2048.0), ('20m', 20971520.0), (' 1G ', 1073741824.0),
+])
+def test_parse_rate(value, rate):
+    assert TH.parse_rate(value) == rate
+
+
+@pytest.mark.parametrize('value', ['0', '-5M', 'fast', 'M'])
+def test_parse_rate_rejects_bad_values(value):
+    with pytest.raises(ValueError):
+        TH.parse_rate(value)
+
+
+def test_parse_schedule():
+    assert TH.parse_schedule('22:00-06:00=off, 12:00-13:30=50M/200,,9-10=-/5') == [
+        (1320, 360, None, None), (720, 810, 52428800.0, 200.0), (540, 600, None, 5.0)]
+    assert TH.parse_schedule(None) == []
+    with pytest.raises(ValueError):
+        TH.parse_schedule('12:00=50M')
+    with pytest.raises(ValueError):
+        TH.parse_schedule('12:00-13:00')
+
+
+def test_in_window_wraps_midnight():
+    assert TH.in_window(720, 720, 780)
+    assert not TH.in_window(780, 720, 780)
+    assert TH.in_window(1380, 1320, 360)
+    assert TH.in_window(0, 1320, 360)
+    assert not TH.in_window(360, 1320, 360)
+    assert not TH.in_window(700, 1320, 360)
+
+
+def test_first_matching_window_replaces_the_limits(make_throttle):
+    throttle = make_throttle(100.0, 10.0, TH.parse_schedule('22:00-06:00=off,23:00-23:30=1K/1'))
+    assert throttle.limits(at(12, 0)) == (100.0, 10.0)
+    assert throttle.limits(at(23, 15)) == (None, None)
+    assert throttle.limits(at(5, 59)) == (None, None)
+    assert throttle.limits_bytes()
+    assert not make_throttle(None, 10.0, TH.parse_schedule('22:00-06:00=-/5')).limits_bytes()
+
+
+def test_burst_is_free_and_debt_is_repaid_by_sleeping(make_throttle, clock):
+    throttle = make_throttle(bytes_rate=100.0, burst=2.0)
+    assert throttle.consume(nbytes=150) == 0.0
+    assert throttle.consume(nbytes=100) == pytest.approx(0.5)
+    assert clock.slept == [pytest.approx(0.5)]
+    # A file larger than a whole burst still passes, then waits out its debt.
+    clock.now += 10
+    assert throttle.consume(nbytes=500) == pytest.approx(3.0)
+    assert throttle.throttled['bytes'] == pytest.approx(3.5)
+    assert throttle.consumed == {'bytes': 750, 'files': 0}
+
+
+def test_slowest_bucket_sets_the_wait(make_throttle, clock):
+    throttle = make_throttle(bytes_rate=1000.0, files_rate=1.0)
+    throttle.consume(files=1, nbytes=1000)
+    assert throttle.consume(files=1, nbytes=100) == pytest.approx(1.0)
+    assert throttle.throttled == {'bytes': 0.0, 'files': pytest.approx(1.0)}
+    totals = TH.status(throttle.state)
+    assert totals['files'] == (2, pytest.approx(1.0))
+    assert totals['bytes'] == (1100, 0.0)
+
+
+def test_processes_share_the_buckets(make_throttle, clock):
+    first = make_throttle(files_rate=2.0)
+    second = make_throttle(files_rate=2.0)
+    assert first.consume(files=2) == 0.0
+    assert second.consume(files=1) == pytest.approx(0.5)
+
+
+def test_unlimited_work_is_counted_but_never_waits(make_throttle, clock):
+    throttle = make_throttle(files_rate=1.0)
+    assert throttle.consume(nbytes=10 ** 9) == 0.0
+    assert clock.slept == []
+    assert throttle.consumed['bytes'] == 10 ** 9
+
+
+def test_from_environment(monkeypatch, tmp_path):
+    for name in ('UPEI_THROTTLE_BYTES', 'UPEI_THROTTLE_FILES', 'UPEI_THROTTLE_SCHEDULE'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('UPEI_THROTTLE_STATE', str(tmp_path / 'throttle.db'))
+    assert TH.Throttle.from_environment() is None
+    monkeypatch.setenv('UPEI_THROTTLE_SCHEDULE', '22:00-06:00=off')
+    assert TH.Throttle.from_environment() is None
+    monkeypatch.setenv('UPEI_THROTTLE_BYTES', '20M')
+    monkeypatch.setenv('UPEI_THROTTLE_BURST', '3')
+    throttle = TH.Throttle.from_environment()
+    try:
+        assert (throttle.bytes_rate, throttle.files_rate, throttle.burst) == (20971520.0, None, 3.0)
+        assert throttle.schedule == [(1320, 360, None, None)]
+    finally:
+        throttle.connections.close()